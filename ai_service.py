@@ -1,52 +1,307 @@
 # ai_service.py
-from openai import OpenAI
-from db_manager import get_chat_history
-from datetime import datetime
+import asyncio
+import time
+from contextlib import asynccontextmanager
+import async_db_manager
+import metrics
+from log_service import get_logger
+from llm_scheduler import LLMScheduler, PRIORITY_FREE
+from llm_gateway import LLMGateway, LLMBackend, CircuitBreaker, HedgePolicy, LLMUnavailableError
+from context_builder import build_context, prompt_size_stats
+from prompt_builder import PERSONA_PREFIX, build_session_context, prompt_cache_stats
 from config import (
-    DEEPSEEK_API_KEY, 
-    DEEPSEEK_API_BASE, 
-    MODEL_NAME, 
-    SYSTEM_PROMPT
+    DEEPSEEK_API_KEY,
+    DEEPSEEK_API_BASE,
+    MODEL_NAME,
+    SUMMARY_PROMPT,
+    SUMMARY_MAX_TOKENS,
+    LLM_MAX_CONCURRENCY,
+    LLM_REQUEST_TIMEOUT,
+    LLM_QUEUE_TIMEOUT,
+    LLM_PRIORITY_WEIGHTS,
+    LLM_PER_USER_MAX_IN_FLIGHT,
+    HISTORY_TOKEN_BUDGET,
+    HISTORY_MAX_MESSAGES,
+    LOG_SAMPLE_RATE,
+    LLM_FALLBACK_BACKENDS,
+    LLM_MAX_ATTEMPTS,
+    LLM_ATTEMPT_TIMEOUT,
+    LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY,
+    LLM_BREAKER_FAILURES,
+    LLM_BREAKER_RESET_SECONDS,
+    LLM_HEDGE_ENABLED,
+    LLM_HEDGE_PERCENTILE,
+    LLM_HEDGE_MIN_DELAY,
+    LLM_HEDGE_MIN_SAMPLES,
+    LLM_HEDGE_BUDGET
 )
 
-client = OpenAI(
-    api_key=DEEPSEEK_API_KEY,
-    base_url=DEEPSEEK_API_BASE,
+log = get_logger(__name__)
+
+def _create_llm_gateway():
+    """Основной провайдер (DEEPSEEK_API_BASE, MODEL_NAME) и запасные из LLM_FALLBACK_BACKENDS."""
+    specs = [{'name': 'primary', 'base_url': DEEPSEEK_API_BASE, 'model': MODEL_NAME}]
+    specs.extend(LLM_FALLBACK_BACKENDS)
+    backends = [
+        LLMBackend(
+            spec.get('name') or f"fallback{index}",
+            spec['base_url'],
+            spec.get('api_key') or DEEPSEEK_API_KEY,
+            spec.get('model') or MODEL_NAME,
+            CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS),
+        )
+        for index, spec in enumerate(specs)
+    ]
+    return LLMGateway(
+        backends,
+        max_attempts=LLM_MAX_ATTEMPTS,
+        attempt_timeout=LLM_ATTEMPT_TIMEOUT,
+        base_delay=LLM_RETRY_BASE_DELAY,
+        max_delay=LLM_RETRY_MAX_DELAY,
+        hedge_policy=HedgePolicy(
+            percentile=LLM_HEDGE_PERCENTILE,
+            min_delay=LLM_HEDGE_MIN_DELAY,
+            budget_ratio=LLM_HEDGE_BUDGET,
+            min_samples=LLM_HEDGE_MIN_SAMPLES,
+        ) if LLM_HEDGE_ENABLED else None,
+    )
+
+
+# Асинхронные запросы идут через шлюз: ретраи, переключение провайдеров, circuit breaker
+# и (LLM_HEDGE_ENABLED) дублирование медленных ответов
+llm_gateway = _create_llm_gateway()
+
+# Глобальная очередь запросов к модели: не больше LLM_MAX_CONCURRENCY одновременно,
+# подписчики обслуживаются в приоритете
+llm_scheduler = LLMScheduler(
+    LLM_MAX_CONCURRENCY,
+    LLM_PRIORITY_WEIGHTS,
+    per_user_limit=LLM_PER_USER_MAX_IN_FLIGHT
+)
+
+
+# Ответы модели длятся секунды, поэтому свои бакеты
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0, 120.0)
+
+# kind: reply / stream / summary; outcome: ok / timeout / cancelled / unavailable / error
+LLM_REQUEST_SECONDS = metrics.histogram(
+    'bot_llm_request_seconds', 'LLM request duration after a slot was granted',
+    labels=('kind', 'outcome'), buckets=LLM_BUCKETS
+)
+LLM_FIRST_TOKEN_SECONDS = metrics.histogram(
+    'bot_llm_first_token_seconds', 'Time to the first streamed token', buckets=LLM_BUCKETS
+)
+LLM_QUEUE_WAIT_SECONDS = metrics.histogram(
+    'bot_llm_queue_wait_seconds', 'Wait for a slot in llm_scheduler', labels=('priority',)
+)
+metrics.gauge('bot_llm_in_flight', 'LLM requests in progress', function=lambda: llm_scheduler.in_flight)
+metrics.gauge(
+    'bot_llm_queue_waiting', 'Requests waiting for an LLM slot', labels=('priority',),
+    function=lambda: {(cls,): info['waiting'] for cls, info in llm_scheduler.stats()['classes'].items()}
+)
+# 0 - closed, 1 - half-open, 2 - open
+_CIRCUIT_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+metrics.gauge(
+    'bot_llm_backend_circuit_state', 'Circuit breaker state per LLM backend (0 closed, 1 half-open, 2 open)',
+    labels=('backend',),
+    function=lambda: {(backend.name,): _CIRCUIT_STATES[backend.breaker.state] for backend in llm_gateway.backends}
 )
+metrics.gauge(
+    'bot_llm_hedge_delay_seconds', 'Current delay after which an LLM request is hedged', labels=('kind',),
+    function=lambda: {(kind,): value for kind, value in (get_llm_hedge_stats() or {}).get('delays', {}).items()}
+)
+metrics.gauge(
+    'bot_llm_backend_latency_seconds', 'Smoothed latency used to route LLM requests', labels=('backend', 'kind'),
+    function=lambda: {
+        (backend.name, kind): value for backend in llm_gateway.backends for kind, value in backend.latency.items()
+    }
+)
+
+
+def get_llm_in_flight():
+    """Возвращает количество запросов к модели, выполняющихся прямо сейчас."""
+    return llm_scheduler.in_flight
+
+
+def get_llm_backend_stats():
+    """Состояние провайдеров: circuit breaker и оценка задержки."""
+    return llm_gateway.stats()
+
 
-def generate_ai_response(user_id, user_message, user_display_name):
+def get_llm_hedge_stats():
+    """Текущие задержки дублирования и остаток бюджета (None, если дублирование выключено)."""
+    return llm_gateway.hedge_policy.stats() if llm_gateway.hedge_policy is not None else None
+
+
+def get_prompt_size_stats():
+    """Размер промптов (оценка в токенах) и сколько раз история не поместилась целиком."""
+    return prompt_size_stats.stats()
+
+
+def get_prompt_cache_stats():
+    """Сколько токенов промпта провайдер отдал из своего кэша (по usage в ответах)."""
+    return prompt_cache_stats.stats()
+
+
+def _build_messages(user_id, user_message, user_display_name, history, memory=None, facts=None):
     """
-    Формирует промпт с памятью и личностью, вызывает DeepSeek API.
+    Собирает список сообщений для chat completions.
+    memory - сводка старых разговоров, facts - факты из векторной памяти, близкие к сообщению.
     """
-    # Получаем историю последних 10 сообщений
-    history = get_chat_history(user_id, limit=10)
-    
-    current_date = datetime.now().strftime('%d.%m.%Y')
+    # Персона - неизменный префикс (кэшируется провайдером), дата, имя и память - в конце
+    session_context = build_session_context(user_id, user_display_name, memory, facts)
 
-    # Персонализированный промпт
-    personalized_system_prompt = SYSTEM_PROMPT.format(
-        user_name=user_display_name,
-        date=current_date
+    # Формируем сообщения: история обрезается с начала, чтобы промпт поместился в бюджет токенов
+    messages, prompt_tokens, dropped = build_context(
+        PERSONA_PREFIX, history, user_message, HISTORY_TOKEN_BUDGET, session_context
     )
-    
-    # Изоляция пользователей
-    isolation_prompt = f"\n\n[КОНТЕКСТ СЕССИИ: User ID {user_id}. Это приватный диалог только с {user_display_name}. Забудь все предыдущие разговоры с другими людьми.]"
-    personalized_system_prompt += isolation_prompt
+    prompt_size_stats.record(prompt_tokens, dropped)
+    if dropped:
+        log.info("Prompt truncated to the token budget", sample=LOG_SAMPLE_RATE, user_id=user_id,
+                 prompt_tokens=prompt_tokens, history_kept=len(history) - dropped, history_total=len(history))
+    return messages
 
-    # Формируем сообщения
-    messages = [{"role": "system", "content": personalized_system_prompt}]
-    messages.extend(history)
-    messages.append({"role": "user", "content": user_message})
 
+@asynccontextmanager
+async def _llm_slot(user_id, priority, kind):
+    """Занимает слот в очереди llm_scheduler на время запроса. kind - метка запроса в метриках."""
+    # Ждем свободный слот, но не бесконечно
+    queued = time.perf_counter()
     try:
-        completion = client.chat.completions.create(
-            model=MODEL_NAME,
+        await llm_scheduler.acquire(user_id, priority, timeout=LLM_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        LLM_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued, priority=priority)
+        log.warning("LLM queue timeout", user_id=user_id, priority=priority,
+                    timeout=LLM_QUEUE_TIMEOUT, in_flight=llm_scheduler.in_flight)
+        raise
+
+    started = time.perf_counter()
+    LLM_QUEUE_WAIT_SECONDS.observe(started - queued, priority=priority)
+    outcome = 'ok'
+    try:
+        yield
+    except asyncio.TimeoutError:
+        outcome = 'timeout'
+        log.warning("LLM API timeout", user_id=user_id, kind=kind, timeout=LLM_REQUEST_TIMEOUT)
+        raise
+    except asyncio.CancelledError:
+        outcome = 'cancelled'
+        log.info("LLM request cancelled", sample=LOG_SAMPLE_RATE, user_id=user_id, kind=kind)
+        raise
+    except LLMUnavailableError:
+        outcome = 'unavailable'
+        log.warning("LLM backends unavailable", sample=LOG_SAMPLE_RATE, user_id=user_id, kind=kind)
+        raise
+    except Exception as e:
+        outcome = 'error'
+        log.error("LLM API error", user_id=user_id, kind=kind, error=repr(e))
+        raise
+    finally:
+        llm_scheduler.release(user_id)
+        LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, kind=kind, outcome=outcome)
+
+
+async def generate_ai_response_async(user_id, user_message, user_display_name, history=None,
+                                     priority=PRIORITY_FREE, memory=None, facts=None):
+    """
+    Формирует промпт с памятью и личностью и получает ответ модели целиком.
+    Не блокирует event loop; число одновременных запросов ограничено LLM_MAX_CONCURRENCY,
+    очередь к модели учитывает priority (см. llm_scheduler).
+    Отмена вызывающей задачи прерывает HTTP-запрос и освобождает слот.
+    Ошибки провайдера повторяются через llm_gateway, пока не истечет LLM_REQUEST_TIMEOUT.
+    """
+    if history is None:
+        history = await async_db_manager.get_chat_history(user_id, limit=HISTORY_MAX_MESSAGES)
+
+    messages = _build_messages(user_id, user_message, user_display_name, history, memory, facts)
+
+    async with _llm_slot(user_id, priority, 'reply'):
+        completion = await llm_gateway.complete(
+            LLM_REQUEST_TIMEOUT,
             messages=messages,
             temperature=0.7,
             user=f"user_{user_id}",  # Изоляция на уровне API
         )
+        prompt_cache_stats.record(completion.usage)
         return completion.choices[0].message.content
 
-    except Exception as e:
-        print(f"DeepSeek API error for user {user_id}: {e}")
-        raise
\ No newline at end of file
+
+async def stream_ai_response(user_id, user_message, user_display_name, history=None,
+                             priority=PRIORITY_FREE, memory=None, facts=None):
+    """
+    Потоковая версия generate_ai_response_async: асинхронный генератор,
+    который отдает фрагменты текста по мере их прихода от модели.
+    LLM_REQUEST_TIMEOUT ограничивает весь поток целиком. На другого провайдера
+    запрос переключается, только пока не пришел первый фрагмент.
+    """
+    if history is None:
+        history = await async_db_manager.get_chat_history(user_id, limit=HISTORY_MAX_MESSAGES)
+
+    messages = _build_messages(user_id, user_message, user_display_name, history, memory, facts)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LLM_REQUEST_TIMEOUT
+
+    async with _llm_slot(user_id, priority, 'stream'):
+        started = time.perf_counter()
+        first_token = True
+        stream = await llm_gateway.open_stream(
+            max(0.0, deadline - loop.time()),
+            messages=messages,
+            temperature=0.7,
+            user=f"user_{user_id}",  # Изоляция на уровне API
+            # Последний фрагмент приносит usage, в том числе число закэшированных токенов
+            stream_options={"include_usage": True},
+        )
+        chunks = stream.__aiter__()
+        try:
+            while True:
+                # Таймаут на каждый фрагмент, чтобы не накрывать им код потребителя между yield
+                try:
+                    chunk = await asyncio.wait_for(
+                        chunks.__anext__(),
+                        timeout=max(0.0, deadline - loop.time())
+                    )
+                except StopAsyncIteration:
+                    break
+
+                if chunk.usage is not None:
+                    prompt_cache_stats.record(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token:
+                        LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                        first_token = False
+                    yield delta
+        finally:
+            await stream.close()
+
+
+async def summarize_conversation(user_id, previous_summary, turns):
+    """
+    Сворачивает реплики turns (от старых к новым) вместе с прежней сводкой в новую сводку памяти.
+    Запрос идет через общую очередь с низшим приоритетом, чтобы не отнимать слоты у ответов.
+    """
+    transcript = "\n".join(
+        f"{'Собеседник' if turn['role'] == 'user' else 'Ты'}: {turn['content']}"
+        for turn in turns
+    )
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": f"Прежняя заметка:\n{previous_summary or '(пусто)'}\n\nНовые реплики:\n{transcript}"},
+    ]
+
+    async with _llm_slot(user_id, PRIORITY_FREE, 'summary'):
+        # Сводки не спешат: дублировать их - лишний расход
+        completion = await llm_gateway.complete(
+            LLM_REQUEST_TIMEOUT,
+            kind='summary',
+            hedge=False,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            user=f"user_{user_id}",
+        )
+        return (completion.choices[0].message.content or "").strip()
@@ -0,0 +1,1393 @@
+# async_db_manager.py - Асинхронный слой доступа к PostgreSQL (asyncpg)
+import asyncio
+import asyncpg
+from contextlib import asynccontextmanager
+from datetime import datetime, date, timedelta
+import json
+import re
+import secrets
+from config import (
+    DB_CONFIG,
+    DB_SSL_MODE,
+    DAILY_LIMIT,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_STATEMENT_TIMEOUT_MS,
+    DB_COMMAND_TIMEOUT,
+    DB_STATEMENT_CACHE_SIZE,
+    DB_POOL_MAX_QUERIES,
+    DB_POOL_MAX_INACTIVE_LIFETIME,
+    USER_STATE_CACHE_SIZE,
+    USER_STATE_CACHE_TTL,
+    MESSAGE_WRITE_BEHIND,
+    MESSAGE_FLUSH_BATCH_SIZE,
+    MESSAGE_FLUSH_INTERVAL,
+    MESSAGE_BUFFER_MAX_SIZE,
+    MESSAGE_FLUSH_MAX_RETRIES,
+    HISTORY_WINDOW_SIZE,
+    HISTORY_CACHE_MAX_BYTES,
+    HISTORY_CACHE_TTL,
+    USER_AFFINITY,
+    CLEANUP_BATCH_SIZE,
+    CLEANUP_BATCH_PAUSE,
+    MESSAGES_PARTITION_AHEAD_DAYS,
+    SUMMARY_KEEP_RECENT,
+    SUMMARY_MAX_BATCH,
+    REENCRYPT_BATCH_SIZE,
+    REENCRYPT_BATCH_PAUSE,
+    PAYMENT_EXPIRATION_MINUTES
+)
+import metrics
+from log_service import get_logger
+from cache import TTLCache, ConversationWindowCache
+from crypto_service import crypto, encrypt_data, decrypt_data
+
+log = get_logger(__name__)
+
+# Async connection pool
+_pool = None
+
+
+def _pool_usage():
+    if _pool is None:
+        return {}
+    size, idle = _pool.get_size(), _pool.get_idle_size()
+    return {('busy',): size - idle, ('idle',): idle, ('max',): _pool.get_max_size()}
+
+
+# Время каждой функции доступа к данным (вместе с кэшами: видно, сколько на самом деле ждет обработчик)
+DB_CALL_SECONDS = metrics.histogram(
+    'bot_db_call_seconds', 'Duration of async_db_manager functions', labels=('function',)
+)
+DB_POOL_ACQUIRE_SECONDS = metrics.histogram(
+    'bot_db_pool_acquire_seconds', 'Time spent waiting for a free asyncpg pool connection'
+)
+metrics.gauge(
+    'bot_db_pool_connections', 'asyncpg pool connections by state', labels=('state',), function=_pool_usage
+)
+MESSAGES_DROPPED = metrics.counter(
+    'bot_messages_dropped_total', 'Buffered messages dropped because the database rejected the row'
+)
+
+
+class _TimedPool(asyncpg.Pool):
+    """
+    asyncpg.Pool с замером ожидания свободного соединения.
+    fetch/execute/copy и acquire() берут соединение через _acquire, поэтому замер видит все запросы.
+    """
+
+    async def _acquire(self, timeout):
+        with DB_POOL_ACQUIRE_SECONDS.time():
+            return await super()._acquire(timeout)
+
+
+# Write-through кэш состояния пользователя: user_id -> {'end_date', 'count', 'date'}.
+# Подписка меняется только при оплате, а дневной счетчик пишет только этот процесс
+# (при USER_AFFINITY каждый пользователь принадлежит одному процессу),
+# поэтому большинство проверок квоты обходятся без БД. Записи живут не дольше
+# USER_STATE_CACHE_TTL и не переживают полночь. Без USER_AFFINITY кэш выключен (maxsize=0).
+_user_state_cache = TTLCache(maxsize=USER_STATE_CACHE_SIZE if USER_AFFINITY else 0)
+
+
+def _seconds_until_midnight():
+    now = datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return max(1.0, (midnight - now).total_seconds())
+
+
+def _cache_user_state(user_id, end_date, count, limit_date):
+    """Кладет в кэш полное состояние пользователя (не дольше чем до ближайшей полуночи)."""
+    state = {'end_date': end_date, 'count': count or 0, 'date': limit_date}
+    _user_state_cache.set(
+        user_id, state,
+        ttl=min(_seconds_until_midnight(), USER_STATE_CACHE_TTL or float('inf'))
+    )
+    return state
+
+
+def _update_cached_user_state(user_id, **changes):
+    """Обновляет поля уже закэшированного состояния (write-through после записи в БД)."""
+    state = _user_state_cache.get(user_id)
+    if state is not None:
+        state.update(changes)
+
+
+def _effective_count(state, today=None):
+    """Счетчик с учетом смены дня: дневной расход обнуляется, купленные сообщения сохраняются."""
+    today = today or date.today()
+    if state['date'] == today or state['count'] < 0:
+        return state['count']
+    return 0
+
+
+async def _get_user_state(user_id):
+    """Состояние пользователя из кэша или одним запросом из БД."""
+    state = _user_state_cache.get(user_id)
+    if state is not None:
+        return state
+
+    row = await _pool.fetchrow("""
+        SELECT s.end_date, l.count, l.date
+        FROM (SELECT $1::BIGINT AS user_id) u
+        LEFT JOIN subscriptions s ON s.user_id = u.user_id
+        LEFT JOIN limits l ON l.user_id = u.user_id
+    """, user_id)
+    return _cache_user_state(user_id, row['end_date'], row['count'], row['date'])
+
+
+def get_user_state_cache_stats():
+    """Счетчики кэша состояния пользователей."""
+    return _user_state_cache.stats()
+
+
+async def init_db():
+    """Создает async connection pool и необходимые таблицы в PostgreSQL."""
+    global _pool
+
+    # То же, что asyncpg.create_pool, но с замером ожидания соединения
+    _pool = await _TimedPool(
+        host=DB_CONFIG['host'],
+        port=int(DB_CONFIG['port']),
+        database=DB_CONFIG['database'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password'],
+        ssl=DB_SSL_MODE,  # По умолчанию принудительное SSL/TLS шифрование
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        max_queries=DB_POOL_MAX_QUERIES,
+        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        server_settings={'statement_timeout': str(DB_STATEMENT_TIMEOUT_MS)},
+        connection_class=asyncpg.Connection,
+        record_class=asyncpg.Record,
+        loop=None,
+    )
+
+    async with _pool.acquire() as conn:
+        # Messages table (секционирована по дням, см. _create_messages_table)
+        await _create_messages_table(conn)
+
+        if await _messages_is_partitioned(conn):
+            await ensure_message_partitions(conn)
+        else:
+            # Индекс на большой таблице строится минутами - это делает migrate_messages.py,
+            # а не старт бота с его statement_timeout
+            if not await _timestamp_index_is_valid(conn):
+                log.warning("Table messages has no valid timestamp index, cleanup will scan the table. "
+                            "Run migrate_messages.py --index-only to build it")
+            log.warning("Table messages is not partitioned. Run migrate_messages.py to enable partition-drop retention")
+
+        # Limits table
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS limits (
+                user_id BIGINT PRIMARY KEY,
+                date DATE NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+        # Subscriptions table
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                user_id BIGINT PRIMARY KEY,
+                start_date TIMESTAMP NOT NULL,
+                end_date TIMESTAMP NOT NULL
+            )
+        """)
+
+        # Payment intents table (для безопасности платежей)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS payment_intents (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                payment_token TEXT UNIQUE NOT NULL,
+                payment_type TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                package_details JSONB,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT NOW(),
+                expires_at TIMESTAMP NOT NULL,
+                used_at TIMESTAMP
+            )
+        """)
+
+        # Index для быстрого поиска токенов
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_payment_token
+            ON payment_intents(payment_token)
+        """)
+
+        # Долговременная память: сжатая сводка старых реплик (зашифрована).
+        # summarized_until - timestamp последнего сообщения, вошедшего в сводку
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_memory (
+                user_id BIGINT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                summarized_until TIMESTAMP NOT NULL,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+
+        # Докуда дошла перешифровка каждой таблицы ключом key_version (см. reencrypt_messages)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS reencrypt_cursor (
+                table_name TEXT PRIMARY KEY,
+                key_version INTEGER NOT NULL,
+                last_key BIGINT NOT NULL
+            )
+        """)
+
+    if MESSAGE_WRITE_BEHIND:
+        _message_buffer.start()
+
+    log.info("Async PostgreSQL pool initialized", min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
+
+
+async def _create_messages_table(conn, table='messages'):
+    """
+    Создает таблицу messages, секционированную по timestamp (одна секция на день).
+    Устаревшие сообщения удаляются сбросом целых секций, без DELETE и bloat.
+    Если таблица уже существует (в т.ч. старая несекционированная), ничего не меняет.
+    table - другое имя (и индексы idx_<table>_...) для таблицы, в которую идет миграция.
+    """
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id BIGSERIAL,
+            user_id BIGINT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+
+    # Index for faster queries
+    await conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{table}_user_id
+        ON {table}(user_id, id DESC)
+    """)
+
+    if await _messages_is_partitioned(conn, table):
+        # На секционированной таблице CONCURRENTLY недоступен; индекс наследуют все секции
+        await conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_{table}_timestamp
+            ON {table}(timestamp)
+        """)
+
+
+@asynccontextmanager
+async def _maintenance_connection():
+    """
+    Отдельное соединение для долгих операций обслуживания (миграции, построение индексов):
+    без statement_timeout и command_timeout пула, чтобы их не прервали на полпути.
+    """
+    conn = await asyncpg.connect(
+        host=DB_CONFIG['host'],
+        port=int(DB_CONFIG['port']),
+        database=DB_CONFIG['database'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password'],
+        ssl=DB_SSL_MODE,
+        command_timeout=None,
+        server_settings={'statement_timeout': '0'}
+    )
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+async def _timestamp_index_is_valid(conn):
+    """None - индекса нет, False - он остался INVALID после прерванного CREATE INDEX CONCURRENTLY."""
+    return await conn.fetchval("""
+        SELECT i.indisvalid
+        FROM pg_index i
+        WHERE i.indexrelid = to_regclass('idx_messages_timestamp')
+    """)
+
+
+async def build_messages_timestamp_index(attempts: int = 2):
+    """
+    Строит индекс messages(timestamp) для очистки пачками на несекционированной таблице.
+    CREATE INDEX CONCURRENTLY не блокирует вставки, но при прерывании оставляет INVALID индекс,
+    который IF NOT EXISTS пропустил бы навсегда: такой индекс удаляется и строится заново.
+    """
+    async with _maintenance_connection() as conn:
+        if await _messages_is_partitioned(conn):
+            # У секционированной таблицы индекс создается вместе с ней (_create_messages_table)
+            return True
+
+        for attempt in range(1, attempts + 1):
+            valid = await _timestamp_index_is_valid(conn)
+            if valid:
+                return True
+            if valid is False:
+                log.warning("Dropping invalid index idx_messages_timestamp", attempt=attempt)
+                await conn.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_messages_timestamp", timeout=None)
+            try:
+                await conn.execute("""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_timestamp
+                    ON messages(timestamp)
+                """, timeout=None)
+            except asyncpg.PostgresError as e:
+                log.warning("Failed to build idx_messages_timestamp", attempt=attempt, error=repr(e))
+
+        valid = bool(await _timestamp_index_is_valid(conn))
+        if valid:
+            log.info("Index idx_messages_timestamp is built")
+        else:
+            log.error("Index idx_messages_timestamp is still invalid", attempts=attempts)
+        return valid
+
+
+async def _messages_is_partitioned(conn, table='messages'):
+    relkind = await conn.fetchval("SELECT relkind FROM pg_class WHERE oid = to_regclass($1)", table)
+    return relkind == 'p'
+
+
+def _partition_name(day):
+    return f"messages_p{day:%Y%m%d}"
+
+
+_PARTITION_NAME_RE = re.compile(r'^messages_p(\d{8})$')
+
+
+async def ensure_message_partitions(conn=None, start_day=None, days_ahead=MESSAGES_PARTITION_AHEAD_DAYS,
+                                    table='messages'):
+    """Создает недостающие дневные секции messages от start_day (по умолчанию сегодня) на days_ahead дней вперед."""
+    if conn is None:
+        async with _pool.acquire() as conn:
+            return await ensure_message_partitions(conn, start_day, days_ahead, table)
+
+    # Старая несекционированная таблица (ежедневная задача запускается и до миграции)
+    if not await _messages_is_partitioned(conn, table):
+        return
+
+    day = start_day or date.today()
+    end_day = date.today() + timedelta(days=days_ahead)
+
+    while day <= end_day:
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {_partition_name(day)}
+            PARTITION OF {table}
+            FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')
+        """)
+        day += timedelta(days=1)
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def drop_expired_message_partitions(cutoff):
+    """
+    Удаляет секции messages, целиком лежащие раньше cutoff (только метаданные, без DELETE).
+    Возвращает (число секций, оценка числа удаленных строк).
+    """
+    async with _pool.acquire() as conn:
+        if not await _messages_is_partitioned(conn):
+            return 0, 0
+
+        partitions = await conn.fetch("""
+            SELECT c.relname, GREATEST(c.reltuples, 0)::BIGINT AS estimated_rows
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'messages'::regclass
+        """)
+
+        dropped = 0
+        dropped_rows = 0
+        for partition in partitions:
+            match = _PARTITION_NAME_RE.match(partition['relname'])
+            if not match:
+                continue
+            day = datetime.strptime(match.group(1), '%Y%m%d')
+            # Секция покрывает [day, day + 1 день)
+            if day + timedelta(days=1) <= cutoff:
+                await conn.execute(f"DROP TABLE IF EXISTS {partition['relname']}")
+                dropped += 1
+                dropped_rows += partition['estimated_rows']
+
+    return dropped, dropped_rows
+
+
+# Таблица, в которую копируются сообщения при переходе на секционирование
+_MIGRATION_TABLE = 'messages_partitioned'
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def migrate_messages_to_partitioned(days_to_keep: int = 7, batch_size: int = 10000,
+                                          pause: float = CLEANUP_BATCH_PAUSE):
+    """
+    Переводит существующую несекционированную таблицу messages на секционирование.
+    Переносятся только сообщения в пределах срока хранения (остальные все равно удалились бы).
+
+    Сообщения копируются в новую таблицу пачками по диапазонам id, пока бот продолжает писать
+    в старую. Эксклюзивная блокировка берется только в конце: дописать сообщения, пришедшие
+    во время копирования, убрать удаленные за это время и поменять таблицы местами.
+    Все идет через отдельное соединение без statement_timeout пула.
+    """
+    cutoff = datetime.now() - timedelta(days=days_to_keep)
+    new_table = _MIGRATION_TABLE
+
+    async with _maintenance_connection() as conn:
+        if await _messages_is_partitioned(conn):
+            log.info("Table messages is already partitioned")
+            return 0
+
+        # Остатки прерванной миграции (секции удаляются вместе с родительской таблицей)
+        await conn.execute(f"DROP TABLE IF EXISTS {new_table}", timeout=None)
+        await _create_messages_table(conn, new_table)
+
+        min_id, max_id, first_timestamp = await conn.fetchrow("""
+            SELECT min(id), max(id), min(timestamp) FROM messages WHERE timestamp >= $1
+        """, cutoff, timeout=None)
+        start_day = first_timestamp.date() if first_timestamp else date.today()
+        await ensure_message_partitions(conn, start_day=start_day, table=new_table)
+
+        migrated = 0
+        if min_id is not None:
+            lower = min_id
+            while lower <= max_id:
+                status = await conn.execute(f"""
+                    INSERT INTO {new_table} (id, user_id, role, content, timestamp)
+                    SELECT id, user_id, role, content, timestamp
+                    FROM messages
+                    WHERE id >= $1 AND id < $2 AND timestamp >= $3
+                """, lower, lower + batch_size, cutoff, timeout=None)
+                migrated += int(status.split()[-1])
+                lower += batch_size
+                if pause:
+                    await asyncio.sleep(pause)
+            log.info("Messages copied, switching tables", copied=migrated, max_id=max_id)
+
+        async with conn.transaction():
+            await conn.execute("SET LOCAL statement_timeout = 0")
+            # Не вставать надолго в очередь за чужими запросами: при неудаче миграцию можно повторить
+            await conn.execute("SET LOCAL lock_timeout = '30s'")
+            await conn.execute("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE", timeout=None)
+
+            # Сообщения, пришедшие во время копирования
+            status = await conn.execute(f"""
+                INSERT INTO {new_table} (id, user_id, role, content, timestamp)
+                SELECT id, user_id, role, content, timestamp
+                FROM messages
+                WHERE id > $1 AND timestamp >= $2
+            """, max_id or 0, cutoff, timeout=None)
+            migrated += int(status.split()[-1])
+            # Сообщения, удаленные за это время (например, /reset), не должны воскреснуть
+            await conn.execute(f"""
+                DELETE FROM {new_table} n
+                WHERE n.id <= $1
+                  AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.id = n.id)
+            """, max_id or 0, timeout=None)
+
+            await conn.execute("ALTER TABLE messages RENAME TO messages_legacy")
+            # Имена индексов уникальны в схеме - освобождаем их для новой таблицы
+            await conn.execute("ALTER INDEX IF EXISTS messages_pkey RENAME TO messages_legacy_pkey")
+            await conn.execute("ALTER INDEX IF EXISTS idx_messages_user_id RENAME TO idx_messages_legacy_user_id")
+            await conn.execute("ALTER INDEX IF EXISTS idx_messages_timestamp RENAME TO idx_messages_legacy_timestamp")
+
+            await conn.execute(f"ALTER TABLE {new_table} RENAME TO messages")
+            await conn.execute(f"ALTER INDEX IF EXISTS {new_table}_pkey RENAME TO messages_pkey")
+            await conn.execute(f"ALTER INDEX idx_{new_table}_user_id RENAME TO idx_messages_user_id")
+            await conn.execute(f"ALTER INDEX idx_{new_table}_timestamp RENAME TO idx_messages_timestamp")
+
+            # Новые id продолжают старую нумерацию
+            await conn.execute("""
+                SELECT setval(
+                    pg_get_serial_sequence('messages', 'id'),
+                    GREATEST((SELECT max(id) FROM messages_legacy), 1)
+                )
+            """)
+
+        await conn.execute("DROP TABLE messages_legacy", timeout=None)
+
+    log.info("Table messages migrated to daily partitions", messages_kept=migrated)
+    return migrated
+
+
+async def close_db():
+    """Закрывает пул соединений при остановке бота."""
+    global _pool
+    if _pool is not None:
+        # Сначала дописываем все, что накопилось в буфере сообщений
+        await _message_buffer.stop()
+        await _pool.close()
+        _pool = None
+        log.info("Async PostgreSQL pool closed")
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def get_user_status(user_id):
+    """
+    Возвращает кортеж (days_left, messages_info).
+    days_left - дней подписки (None без подписки), messages_info - см. _messages_info.
+    """
+    state = await _get_user_state(user_id)
+
+    now = datetime.now()
+    end_date = state['end_date']
+    days_left = None
+    if end_date and end_date > now:
+        days_left = max(0, (end_date - now).days)
+
+    # Если дата совпадает ИЛИ счетчик отрицательный (есть купленные сообщения), используем текущий счетчик
+    return days_left, _messages_info(_effective_count(state))
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def is_user_subscribed(user_id):
+    """Проверяет, активна ли подписка у пользователя."""
+    end_date = (await _get_user_state(user_id))['end_date']
+    if end_date:
+        return end_date > datetime.now()
+    return False
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def activate_subscription(user_id, duration_days=30):
+    """Активирует или продлевает подписку на N дней."""
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            current_end = await conn.fetchval(
+                "SELECT end_date FROM subscriptions WHERE user_id = $1 FOR UPDATE",
+                user_id
+            )
+            now = datetime.now()
+            start_from = current_end if current_end and current_end > now else now
+            new_end = start_from + timedelta(days=duration_days)
+
+            await conn.execute("""
+                INSERT INTO subscriptions (user_id, start_date, end_date)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id)
+                DO UPDATE SET end_date = EXCLUDED.end_date
+            """, user_id, now, new_end)
+
+    _update_cached_user_state(user_id, end_date=new_end)
+
+
+# Ошибки, при которых строку стоит записать позже: БД недоступна, перегружена или запрос
+# прерван по таймауту. Остальные (ошибки в данных, нет партиции) повтор не исправит
+_TRANSIENT_DB_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.InsufficientResourcesError,
+    asyncpg.OperatorInterventionError,
+)
+
+
+class MessageWriteBuffer:
+    """
+    Write-behind буфер для save_message.
+    Сообщения копятся в памяти и пишутся в БД одним COPY по достижении
+    batch_size или раз в flush_interval секунд. Пока сообщение не записано,
+    get_chat_history видит его через pending_for (read-your-writes).
+
+    В буфере не больше max_size сообщений (см. full). Если пачка не записалась из-за ошибки
+    в данных или max_retries раз подряд, она пишется по одной строке: строки с ошибкой
+    в данных логируются и отбрасываются, остальные записываются или (БД недоступна) ждут в буфере.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_size=MESSAGE_BUFFER_MAX_SIZE,
+                 max_retries=MESSAGE_FLUSH_MAX_RETRIES):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self._pending = []   # (user_id, role, content, timestamp), content в открытом виде
+        self._in_flight = []  # пачка, которая пишется прямо сейчас
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._failures = 0  # неудачных COPY подряд
+
+        self.flushed_batches = 0
+        self.flushed_messages = 0
+        self.failed_flushes = 0
+        self.row_fallbacks = 0
+        self.dropped_messages = 0
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    @property
+    def full(self):
+        return len(self._pending) >= self.max_size
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую запись и сбрасывает остаток буфера в БД."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def add(self, user_id, role, content, timestamp=None):
+        self._pending.append((user_id, role, content, timestamp or datetime.now()))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def pending_for(self, user_id):
+        """Еще не записанные сообщения пользователя, от старых к новым."""
+        return [item for item in self._in_flight + self._pending if item[0] == user_id]
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    @metrics.timed(DB_CALL_SECONDS, function='flush_messages')
+    async def flush(self):
+        """Пишет накопленные сообщения одним COPY. Возвращает число записанных строк."""
+        async with self._flush_lock:
+            if not self._pending or _pool is None:
+                return 0
+
+            self._in_flight, self._pending = self._pending, []
+            try:
+                # Пачка шифруется в пуле потоков crypto_service, event loop не блокируется
+                encrypted = await crypto.encrypt_many(content for _, _, content, _ in self._in_flight)
+                records = [
+                    (user_id, role, content, timestamp)
+                    for (user_id, role, _, timestamp), content in zip(self._in_flight, encrypted)
+                ]
+                await _pool.copy_records_to_table(
+                    'messages',
+                    records=records,
+                    columns=['user_id', 'role', 'content', 'timestamp']
+                )
+            except Exception as e:
+                self.failed_flushes += 1
+                self._failures += 1
+                if isinstance(e, _TRANSIENT_DB_ERRORS) and self._failures < self.max_retries:
+                    # Возвращаем пачку в начало очереди, чтобы не потерять сообщения и порядок
+                    self._pending[:0] = self._in_flight
+                    log.error("Failed to flush buffered messages", batch=len(self._in_flight),
+                              pending=len(self._pending), attempt=self._failures, error=repr(e))
+                    return 0
+                log.error("Failed to flush buffered messages, writing rows one by one",
+                          batch=len(self._in_flight), attempt=self._failures, error=repr(e))
+                return await self._insert_rows(self._in_flight)
+            finally:
+                self._in_flight = []
+
+            self._failures = 0
+            self.flushed_batches += 1
+            self.flushed_messages += len(records)
+            return len(records)
+
+    async def _insert_rows(self, rows):
+        """
+        Пишет пачку по одной строке, чтобы одна плохая строка не держала остальные.
+        Вызывается под _flush_lock. Возвращает число записанных строк.
+        """
+        self.row_fallbacks += 1
+        written = 0
+        for index, (user_id, role, content, timestamp) in enumerate(rows):
+            try:
+                await _pool.execute("""
+                    INSERT INTO messages (user_id, role, content, timestamp)
+                    VALUES ($1, $2, $3, $4)
+                """, user_id, role, encrypt_data(content), timestamp)
+            except _TRANSIENT_DB_ERRORS as e:
+                # БД недоступна: оставшиеся строки ждут следующей записи в прежнем порядке
+                self._pending[:0] = rows[index:]
+                log.error("Buffered messages kept until the database is available",
+                          kept=len(rows) - index, error=repr(e))
+                break
+            except Exception as e:
+                self.dropped_messages += 1
+                MESSAGES_DROPPED.inc()
+                # Окно в кэше уже содержит эту реплику - перечитаем его из БД
+                _history_cache.invalidate(user_id)
+                log.error("Buffered message dropped after a write error", user_id=user_id,
+                          role=role, timestamp=timestamp, error=repr(e))
+            else:
+                written += 1
+        else:
+            self._failures = 0
+
+        self.flushed_messages += written
+        return written
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'flushed_batches': self.flushed_batches,
+            'flushed_messages': self.flushed_messages,
+            'failed_flushes': self.failed_flushes,
+            'row_fallbacks': self.row_fallbacks,
+            'dropped_messages': self.dropped_messages,
+        }
+
+
+_message_buffer = MessageWriteBuffer(MESSAGE_FLUSH_BATCH_SIZE, MESSAGE_FLUSH_INTERVAL)
+metrics.gauge(
+    'bot_message_buffer_pending', 'Messages waiting in the write-behind buffer',
+    function=lambda: len(_message_buffer._pending)
+)
+
+
+def get_message_buffer_stats():
+    """Счетчики write-behind буфера сообщений."""
+    return _message_buffer.stats()
+
+
+# Окно последних расшифрованных реплик каждого пользователя: на каждом ходе
+# не нужно заново читать и расшифровывать одни и те же строки.
+# Без USER_AFFINITY кэш выключен: реплики, записанные другим процессом, в нем не появятся
+_history_cache = ConversationWindowCache(
+    HISTORY_CACHE_MAX_BYTES if USER_AFFINITY else 0, HISTORY_WINDOW_SIZE, ttl=HISTORY_CACHE_TTL or None
+)
+# user_id -> была ли запись в историю, пока окно загружалось из БД
+_history_loading = {}
+
+
+def get_history_cache_stats():
+    """Счетчики кэша окна диалога."""
+    return _history_cache.stats()
+
+
+def _touch_history(user_id):
+    """Помечает идущую загрузку окна устаревшей, чтобы она не попала в кэш."""
+    if user_id in _history_loading:
+        _history_loading[user_id] = True
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def get_chat_history(user_id, limit=5, since=None):
+    """
+    Возвращает последние N сообщений. Content РАСШИФРОВЫВАЕТСЯ.
+    since - отбросить сообщения не новее этого момента (они уже есть в сводке памяти).
+    """
+    cached = _history_cache.get(user_id, limit, since)
+    if cached is not None:
+        return cached
+
+    # Загружаем сразу целое окно, чтобы следующие ходы обслуживались из кэша
+    fetch_limit = max(limit, HISTORY_WINDOW_SIZE)
+    loading_here = user_id not in _history_loading
+    if loading_here:
+        _history_loading[user_id] = False
+    try:
+        history, complete = await _fetch_chat_history(user_id, fetch_limit)
+        if loading_here and not _history_loading[user_id]:
+            _history_cache.put(user_id, history, complete)
+    finally:
+        if loading_here:
+            del _history_loading[user_id]
+
+    return [
+        {"role": message['role'], "content": message['content']}
+        for message in (history[-limit:] if limit else [])
+        if since is None or message['timestamp'] > since
+    ]
+
+
+async def _fetch_chat_history(user_id, limit):
+    """
+    Читает последние limit сообщений из БД вместе с еще не записанными из буфера.
+    Возвращает (history, complete), complete=True если в БД меньше limit сообщений.
+    """
+    # Снимок буфера берем до запроса: если пачка запишется во время запроса,
+    # дубликаты отсеются по (role, timestamp)
+    pending = _message_buffer.pending_for(user_id)
+
+    rows = await _pool.fetch("""
+        SELECT role, content, timestamp
+        FROM messages
+        WHERE user_id = $1
+        ORDER BY id DESC
+        LIMIT $2
+    """, user_id, limit)
+
+    rows = list(reversed(rows))
+    contents = await crypto.decrypt_many(row['content'] for row in rows)
+    history = [
+        {"role": row['role'], "content": content, "timestamp": row['timestamp']}
+        for row, content in zip(rows, contents)
+    ]
+
+    if pending:
+        stored = {(row['role'], row['timestamp']) for row in rows}
+        history.extend(
+            {"role": role, "content": content, "timestamp": timestamp}
+            for _, role, content, timestamp in pending
+            if (role, timestamp) not in stored
+        )
+        history = history[-limit:]
+
+    return history, len(rows) < limit
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def save_message(user_id, role, content):
+    """Сохраняет сообщение. Content ШИФРУЕТСЯ перед записью."""
+    # Время ставим сами, чтобы кэш окна и сводка памяти сравнивали одни и те же значения
+    timestamp = datetime.now()
+    _history_cache.append(user_id, role, content, timestamp)
+    _touch_history(user_id)
+
+    if _message_buffer.running:
+        if _message_buffer.full:
+            # БД не успевает или недоступна: ждем записи сами, а не копим сообщения в памяти
+            await _message_buffer.flush()
+        if not _message_buffer.full:
+            _message_buffer.add(user_id, role, content, timestamp)
+            return
+        # Буфер так и не освободился - пишем напрямую (при недоступной БД ошибка уйдет вызывающему)
+
+    await _pool.execute("""
+        INSERT INTO messages (user_id, role, content, timestamp)
+        VALUES ($1, $2, $3, $4)
+    """, user_id, role, encrypt_data(content), timestamp)
+
+
+def _messages_info(count, daily_limit=DAILY_LIMIT):
+    """
+    Переводит значение limits.count в остатки для пользователя.
+    count: положительное = сообщений потрачено сегодня, отрицательное = купленные сообщения.
+    """
+    purchased_remaining = -count if count < 0 else 0
+    used_today = count if count > 0 else 0
+    remaining_daily = max(0, daily_limit - used_today)
+    return {
+        'total': remaining_daily + purchased_remaining,
+        'daily': remaining_daily,
+        'purchased': purchased_remaining
+    }
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def consume_message_quota(user_id, daily_limit):
+    """
+    Гейт квоты для входящего сообщения за один запрос к БД.
+
+    Атомарно (одним SQL-выражением):
+      - проверяет активную подписку (подписчики квоту не тратят);
+      - при смене дня обнуляет дневной счетчик, сохраняя купленные (отрицательные) сообщения;
+      - сначала тратит купленные сообщения, затем дневной лимит, и инкрементирует счетчик.
+
+    Возвращает кортеж (allowed, subscribed, messages_info), где messages_info -
+    остатки после списания в формате get_user_status.
+
+    Если состояние пользователя есть в кэше, подписчики и исчерпавшие лимит
+    получают ответ без обращения к БД; списание всегда пишется в БД.
+    """
+    today = date.today()
+    now = datetime.now()
+
+    state = _user_state_cache.get(user_id)
+    if state is not None:
+        if state['end_date'] and state['end_date'] > now:
+            return True, True, None
+        if _effective_count(state, today) >= daily_limit:
+            return False, False, _messages_info(daily_limit, daily_limit)
+
+    # cur видит снимок limits до обновления, поэтому отказ и подписка тоже дают полное состояние для кэша
+    row = await _pool.fetchrow("""
+        WITH sub AS (
+            SELECT (SELECT end_date FROM subscriptions WHERE user_id = $1) AS end_date
+        ),
+        spent AS (
+            INSERT INTO limits AS l (user_id, date, count)
+            SELECT $1::BIGINT, $3::DATE, 1 FROM sub
+            WHERE (sub.end_date IS NULL OR sub.end_date <= $4) AND $2::INTEGER >= 1
+            ON CONFLICT (user_id) DO UPDATE
+            SET date = EXCLUDED.date,
+                count = CASE
+                    WHEN l.date = EXCLUDED.date OR l.count < 0 THEN l.count + 1
+                    ELSE 1
+                END
+            WHERE (CASE WHEN l.date = EXCLUDED.date OR l.count < 0 THEN l.count ELSE 0 END) < $2
+            RETURNING l.count
+        )
+        SELECT sub.end_date, (SELECT count FROM spent) AS new_count,
+               cur.count AS old_count, cur.date AS old_date
+        FROM sub
+        LEFT JOIN limits cur ON cur.user_id = $1
+    """, user_id, daily_limit, today, now)
+
+    end_date = row['end_date']
+    new_count = row['new_count']
+
+    if end_date and end_date > now:
+        _cache_user_state(user_id, end_date, row['old_count'], row['old_date'])
+        return True, True, None
+
+    if new_count is None:
+        # Лимит исчерпан: ни дневных, ни купленных сообщений не осталось
+        _cache_user_state(user_id, end_date, row['old_count'], row['old_date'])
+        return False, False, _messages_info(daily_limit, daily_limit)
+
+    _cache_user_state(user_id, end_date, new_count, today)
+    return True, False, _messages_info(new_count, daily_limit)
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def increase_limit(user_id, count_to_add):
+    """Сбрасывает часть счетчика, effectively добавляя лимит."""
+    today = date.today()
+
+    try:
+        async with _pool.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.fetchrow(
+                    "SELECT count, date FROM limits WHERE user_id = $1 FOR UPDATE",
+                    user_id
+                )
+
+                # Если наступил новый день, но счетчик отрицательный (купленные сообщения),
+                # не обнуляем его, чтобы сохранить купленный лимит.
+                if result and (result['date'] == today or result['count'] < 0):
+                    current_count = result['count']
+                else:
+                    current_count = 0
+
+                new_count = current_count - count_to_add
+
+                await conn.execute("""
+                    INSERT INTO limits (user_id, date, count)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (user_id)
+                    DO UPDATE SET date = EXCLUDED.date, count = EXCLUDED.count
+                """, user_id, today, new_count)
+
+        _update_cached_user_state(user_id, count=new_count, date=today)
+
+        log.info("Limit updated", user_id=user_id, added=count_to_add, effective_count=new_count)
+
+    except Exception:
+        log.exception("Failed to increase limit", user_id=user_id, added=count_to_add)
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def clear_user_history(user_id):
+    """Удаляет всю историю сообщений пользователя."""
+    # Дописываем буфер, иначе пачка, записанная после DELETE, "воскресит" историю
+    await _message_buffer.flush()
+    await _pool.execute("DELETE FROM messages WHERE user_id = $1", user_id)
+    await _pool.execute("DELETE FROM user_memory WHERE user_id = $1", user_id)
+    _history_cache.reset(user_id)
+    _touch_history(user_id)
+    _memory_cache.set(user_id, (None, None))
+    log.debug("История сообщений пользователя очищена", user_id=user_id)
+
+
+# ==================== LONG-TERM MEMORY ====================
+
+# user_id -> (summary, summarized_until); (None, None) - сводки нет.
+# Как и окно диалога, включен только при USER_AFFINITY
+_memory_cache = TTLCache(
+    maxsize=USER_STATE_CACHE_SIZE if USER_AFFINITY else 0, default_ttl=HISTORY_CACHE_TTL or None
+)
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def get_user_memory(user_id):
+    """Возвращает (summary, summarized_until) или (None, None). Summary РАСШИФРОВЫВАЕТСЯ."""
+    cached = _memory_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    row = await _pool.fetchrow(
+        "SELECT summary, summarized_until FROM user_memory WHERE user_id = $1",
+        user_id
+    )
+    memory = (decrypt_data(row['summary']), row['summarized_until']) if row else (None, None)
+    _memory_cache.set(user_id, memory)
+    return memory
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def save_user_memory(user_id, summary, summarized_until):
+    """Сохраняет сводку памяти. Summary ШИФРУЕТСЯ перед записью."""
+    await _pool.execute("""
+        INSERT INTO user_memory (user_id, summary, summarized_until, updated_at)
+        VALUES ($1, $2, $3, NOW())
+        ON CONFLICT (user_id)
+        DO UPDATE SET summary = EXCLUDED.summary,
+                      summarized_until = EXCLUDED.summarized_until,
+                      updated_at = NOW()
+    """, user_id, encrypt_data(summary), summarized_until)
+    _memory_cache.set(user_id, (summary, summarized_until))
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def get_messages_to_summarize(user_id, since=None, keep_recent=SUMMARY_KEEP_RECENT,
+                                    limit=SUMMARY_MAX_BATCH):
+    """
+    Сообщения новее since, которые пора свернуть в сводку: все, кроме keep_recent последних,
+    не больше limit самых старых. Возвращает список словарей role/content/timestamp.
+    """
+    # Сообщения из буфера должны получить место в таблице, иначе keep_recent отсчитается неверно
+    await _message_buffer.flush()
+
+    rows = await _pool.fetch("""
+        SELECT role, content, timestamp
+        FROM (
+            SELECT id, role, content, timestamp
+            FROM messages
+            WHERE user_id = $1 AND timestamp > $2
+            ORDER BY id DESC
+            OFFSET $3
+        ) older
+        ORDER BY id
+        LIMIT $4
+    """, user_id, since or datetime.min, keep_recent, limit)
+
+    contents = await crypto.decrypt_many(row['content'] for row in rows)
+    return [
+        {"role": row['role'], "content": content, "timestamp": row['timestamp']}
+        for row, content in zip(rows, contents)
+    ]
+
+
+# ==================== SECURE PAYMENT FUNCTIONS ====================
+
+@metrics.timed(DB_CALL_SECONDS)
+async def create_payment_intent(user_id, payment_type, amount, package_details=None):
+    """
+    Создает уникальный платежный ID для верификации.
+    Возвращает secure_payload для invoice.
+    """
+    payment_token = secrets.token_urlsafe(32)
+    expires_at = datetime.now() + timedelta(minutes=PAYMENT_EXPIRATION_MINUTES)
+
+    token = await _pool.fetchval("""
+        INSERT INTO payment_intents
+        (user_id, payment_token, payment_type, amount, package_details, expires_at)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        RETURNING payment_token
+    """, user_id, payment_token, payment_type, amount,
+        json.dumps(package_details) if package_details else None, expires_at)
+
+    log.info("Payment intent created", user_id=user_id, payment_type=payment_type, amount=amount)
+    return token
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def verify_and_consume_payment(payment_token, user_id):
+    """
+    Проверяет валидность платежного токена и помечает его использованным.
+    Возвращает (valid, payment_data) или (False, None).
+    """
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            # FOR UPDATE защищает от двойного использования токена параллельными апдейтами
+            result = await conn.fetchrow("""
+                SELECT user_id, payment_type, amount, package_details, status, expires_at
+                FROM payment_intents
+                WHERE payment_token = $1
+                FOR UPDATE
+            """, payment_token)
+
+            if not result:
+                log.warning("Security: payment token not found", user_id=user_id, payment_token=payment_token)
+                return False, None
+
+            if result['user_id'] != user_id:
+                log.warning("Security: payment token belongs to another user",
+                            user_id=user_id, token_user_id=result['user_id'])
+                return False, None
+
+            if result['status'] != 'pending':
+                log.warning("Security: payment token already used", user_id=user_id, status=result['status'])
+                return False, None
+
+            if datetime.now() > result['expires_at']:
+                log.warning("Security: payment token expired", user_id=user_id, expires_at=result['expires_at'])
+                return False, None
+
+            await conn.execute("""
+                UPDATE payment_intents
+                SET status = 'completed', used_at = NOW()
+                WHERE payment_token = $1
+            """, payment_token)
+
+    payment_data = {
+        'payment_type': result['payment_type'],
+        'amount': result['amount'],
+        'package_details': None
+    }
+
+    # asyncpg по умолчанию возвращает JSONB как строку
+    package_details = result['package_details']
+    if package_details:
+        try:
+            if isinstance(package_details, (str, bytes)):
+                payment_data['package_details'] = json.loads(package_details)
+            else:
+                payment_data['package_details'] = package_details
+        except Exception as e:
+            log.warning("Failed to parse package_details", user_id=user_id, error=repr(e))
+
+    return True, payment_data
+
+
+# Прогресс текущей (или последней) очистки старых сообщений
+cleanup_progress = {
+    'running': False,
+    'started_at': None,
+    'finished_at': None,
+    'cutoff': None,
+    'current_id': None,
+    'max_id': None,
+    'batches': 0,
+    'deleted': 0,
+    'dropped_partitions': 0,
+}
+
+
+def get_cleanup_progress():
+    """Снимок прогресса очистки для мониторинга."""
+    return dict(cleanup_progress)
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def cleanup_all_old_messages(days_to_keep: int = 7, batch_size: int = CLEANUP_BATCH_SIZE,
+                                   pause: float = CLEANUP_BATCH_PAUSE):
+    """
+    Удаляет сообщения старше days_to_keep дней и возвращает количество удалённых записей.
+
+    Удаление идет короткими транзакциями по диапазонам id (batch_size id за раз)
+    с паузой pause секунд между пачками, чтобы не держать долгие блокировки
+    и не создавать всплеск WAL, мешающий живым вставкам.
+    """
+    if cleanup_progress['running']:
+        log.info("Cleanup: previous run is still in progress, skipping")
+        return 0
+
+    cutoff = datetime.now() - timedelta(days=days_to_keep)
+
+    # Секционированная таблица: целые дни старше cutoff удаляются сбросом секций,
+    # пачками ниже дочищается только граничная секция
+    dropped_partitions, dropped_rows = await drop_expired_message_partitions(cutoff)
+    if dropped_partitions:
+        log.info("Cleanup: dropped expired partitions", partitions=dropped_partitions, messages=dropped_rows)
+
+    # Верхняя граница - по индексу на timestamp, нижняя - по первичному ключу
+    max_id = await _pool.fetchval("""
+        SELECT id FROM messages
+        WHERE timestamp < $1
+        ORDER BY timestamp DESC
+        LIMIT 1
+    """, cutoff)
+    min_id = await _pool.fetchval("SELECT min(id) FROM messages")
+
+    cleanup_progress.update({
+        'running': True,
+        'started_at': datetime.now(),
+        'finished_at': None,
+        'cutoff': cutoff,
+        'current_id': min_id,
+        'max_id': max_id,
+        'batches': 0,
+        'deleted': 0,
+        'dropped_partitions': dropped_partitions,
+    })
+
+    deleted = 0
+    try:
+        if max_id is not None and min_id is not None:
+            lower = min_id
+            while lower <= max_id:
+                upper = lower + batch_size
+                status = await _pool.execute("""
+                    DELETE FROM messages
+                    WHERE id >= $1 AND id < $2 AND timestamp < $3
+                """, lower, upper, cutoff)
+                # asyncpg возвращает строку статуса вида 'DELETE 42'
+                batch_deleted = int(status.split()[-1])
+
+                deleted += batch_deleted
+                lower = upper
+                cleanup_progress['current_id'] = lower
+                cleanup_progress['batches'] += 1
+                cleanup_progress['deleted'] = deleted
+
+                if cleanup_progress['batches'] % 100 == 0:
+                    log.info("Cleanup progress", id=lower, max_id=max_id, deleted=deleted)
+
+                # Пустые диапазоны (дыры в id) проходим без паузы
+                if batch_deleted and pause:
+                    await asyncio.sleep(pause)
+    finally:
+        cleanup_progress['running'] = False
+        cleanup_progress['finished_at'] = datetime.now()
+
+        # Из окон в памяти тоже должны уйти устаревшие реплики
+        _history_cache.clear()
+
+    log.info("Cleanup finished", deleted=deleted, days_to_keep=days_to_keep, batches=cleanup_progress['batches'])
+    return deleted + dropped_rows
+
+
+# ==================== KEY ROTATION ====================
+
+# Прогресс текущей (или последней) перешифровки
+reencrypt_progress = {
+    'running': False,
+    'started_at': None,
+    'finished_at': None,
+    'key_version': None,
+    'table': None,
+    'batches': 0,
+    'rotated': 0,
+    'failed': 0,
+}
+
+
+def get_reencrypt_progress():
+    """Снимок прогресса перешифровки для мониторинга."""
+    return dict(reencrypt_progress)
+
+
+async def _load_reencrypt_cursor(table, start):
+    """Последний обработанный ключ строки table для текущей версии ключа (start, если перешифровки еще не было)."""
+    last_key = await _pool.fetchval(
+        "SELECT last_key FROM reencrypt_cursor WHERE table_name = $1 AND key_version = $2",
+        table, crypto.current_version
+    )
+    return start if last_key is None else last_key
+
+
+async def _save_reencrypt_cursor(table, last_key):
+    await _pool.execute("""
+        INSERT INTO reencrypt_cursor (table_name, key_version, last_key)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (table_name)
+        DO UPDATE SET key_version = EXCLUDED.key_version, last_key = EXCLUDED.last_key
+    """, table, crypto.current_version, last_key)
+
+
+async def _rotate_rows(rows, column, key):
+    """
+    Перешифровывает значения column; возвращает [(row, новое значение)] без нерасшифровавшихся.
+    Ключи (колонка key) нерасшифровавшихся строк пишутся в лог: курсор уходит дальше,
+    и следующие запуски их больше не читают.
+    """
+    rotated = await crypto.rotate_many(row[column] for row in rows)
+    updates = [(row, value) for row, value in zip(rows, rotated) if value is not None]
+    if len(updates) < len(rows):
+        failed = [row[key] for row, value in zip(rows, rotated) if value is None]
+        log.warning("Reencrypt: rows could not be decrypted and are skipped", column=column, key=key, keys=failed)
+    reencrypt_progress['failed'] += len(rows) - len(updates)
+    reencrypt_progress['batches'] += 1
+    reencrypt_progress['rotated'] += len(updates)
+    return updates
+
+
+@metrics.timed(DB_CALL_SECONDS)
+async def reencrypt_messages(batch_size: int = REENCRYPT_BATCH_SIZE, pause: float = REENCRYPT_BATCH_PAUSE,
+                             from_start: bool = False):
+    """
+    Перешифровывает текущим ключом сообщения и сводки памяти, зашифрованные старыми ключами.
+    Идет по возрастанию ключа пачками по batch_size строк, каждая пачка - отдельный
+    короткий UPDATE, между пачками пауза pause секунд, так что бот продолжает работать.
+    Старый ключ можно убрать из ENCRYPTION_KEYS, когда перешифровка закончилась без ошибок.
+
+    Пройденная позиция сохраняется в reencrypt_cursor: следующий запуск с той же версией ключа
+    продолжает с нее и не перечитывает строки, которые не удалось расшифровать (они учтены
+    в failed прошлого запуска). from_start=True проходит таблицы заново - например, если
+    процессы со старым ключом продолжали писать после перешифровки.
+    Возвращает количество перешифрованных значений.
+    """
+    if not crypto.active:
+        return 0
+    if reencrypt_progress['running']:
+        log.info("Reencrypt: previous run is still in progress, skipping")
+        return 0
+
+    pattern = f"k{crypto.current_version}:%"
+    reencrypt_progress.update({
+        'running': True,
+        'started_at': datetime.now(),
+        'finished_at': None,
+        'key_version': crypto.current_version,
+        'table': 'messages',
+        'batches': 0,
+        'rotated': 0,
+        'failed': 0,
+    })
+
+    try:
+        # Сообщения: курсор по id, timestamp в UPDATE нужен для выбора секции
+        last_id = 0 if from_start else await _load_reencrypt_cursor('messages', 0)
+        if last_id:
+            log.info("Reencrypt: resuming messages", last_id=last_id, key_version=crypto.current_version)
+        while True:
+            rows = await _pool.fetch("""
+                SELECT id, timestamp, content FROM messages
+                WHERE id > $1 AND content NOT LIKE $2
+                ORDER BY id
+                LIMIT $3
+            """, last_id, pattern, batch_size)
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+
+            updates = await _rotate_rows(rows, 'content', 'id')
+            if updates:
+                await _pool.execute("""
+                    UPDATE messages AS m
+                    SET content = v.content
+                    FROM unnest($1::BIGINT[], $2::TIMESTAMP[], $3::TEXT[]) AS v(id, ts, content)
+                    WHERE m.id = v.id AND m.timestamp = v.ts
+                """, [row['id'] for row, _ in updates],
+                    [row['timestamp'] for row, _ in updates],
+                    [value for _, value in updates])
+            await _save_reencrypt_cursor('messages', last_id)
+
+            if reencrypt_progress['batches'] % 100 == 0:
+                log.info("Reencrypt progress", last_id=last_id, rotated=reencrypt_progress['rotated'])
+            if pause:
+                await asyncio.sleep(pause)
+
+        # Сводки памяти: курсор по user_id
+        reencrypt_progress['table'] = 'user_memory'
+        last_user_id = -1 if from_start else await _load_reencrypt_cursor('user_memory', -1)
+        while True:
+            rows = await _pool.fetch("""
+                SELECT user_id, summary FROM user_memory
+                WHERE user_id > $1 AND summary NOT LIKE $2
+                ORDER BY user_id
+                LIMIT $3
+            """, last_user_id, pattern, batch_size)
+            if not rows:
+                break
+            last_user_id = rows[-1]['user_id']
+
+            updates = await _rotate_rows(rows, 'summary', 'user_id')
+            if updates:
+                await _pool.execute("""
+                    UPDATE user_memory AS um
+                    SET summary = v.summary
+                    FROM unnest($1::BIGINT[], $2::TEXT[]) AS v(user_id, summary)
+                    WHERE um.user_id = v.user_id
+                """, [row['user_id'] for row, _ in updates], [value for _, value in updates])
+            await _save_reencrypt_cursor('user_memory', last_user_id)
+
+            if pause:
+                await asyncio.sleep(pause)
+    finally:
+        reencrypt_progress['running'] = False
+        reencrypt_progress['finished_at'] = datetime.now()
+
+    log.info("Reencrypt finished", rotated=reencrypt_progress['rotated'],
+             key_version=crypto.current_version, failed=reencrypt_progress['failed'])
+    return reencrypt_progress['rotated']
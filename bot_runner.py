@@ -1,6 +1,7 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, BotCommand 
 from telegram.ext import (
     Application,
+    SimpleUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -8,15 +9,20 @@ from telegram.ext import (
     filters,
     ContextTypes
 )
-from telegram.error import TelegramError
+from telegram.error import TelegramError, BadRequest, RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 import asyncio
+import time
+from contextlib import asynccontextmanager
 from datetime import time as dt_time
 
 # Импортируем конфиг, базу данных и AI
 from config import *
-from db_manager import (
+from async_db_manager import (
     init_db,
-    check_and_increment_limit,
+    close_db,
+    get_chat_history,
+    consume_message_quota,
     save_message,
     is_user_subscribed,
     activate_subscription,
@@ -25,21 +31,138 @@ from db_manager import (
     get_user_status,
     create_payment_intent,
     verify_and_consume_payment,
-    cleanup_all_old_messages
+    cleanup_all_old_messages,
+    ensure_message_partitions,
+    get_user_memory,
+    reencrypt_messages
 )
-from ai_service import generate_ai_response
+from ai_service import generate_ai_response_async, stream_ai_response
+from llm_scheduler import PRIORITY_SUBSCRIBER, PRIORITY_PURCHASED, PRIORITY_FREE
+from cache import TTLCache
+from coalescer import MessageCoalescer
+from memory_summarizer import ConversationSummarizer
+from vector_memory import create_vector_memory
+import metrics
+import log_service
+from log_service import get_logger
+
+log = get_logger(__name__)
+
+# ========================== МЕТРИКИ ==========================
+
+# Все вызовы Bot API (getChatMember, sendMessage, editMessageText, ...); status - HTTP-код или exception
+TELEGRAM_REQUEST_SECONDS = metrics.histogram(
+    'bot_telegram_request_seconds', 'Bot API call duration', labels=('method', 'status')
+)
+# Из чего складывается ответ на сообщение: quota, typing, history, facts, save, generate, send
+REPLY_STAGE_SECONDS = metrics.histogram(
+    'bot_reply_stage_seconds', 'Duration of reply_to_messages stages', labels=('stage',)
+)
+QUOTA_DENIALS = metrics.counter('bot_quota_denials_total', 'Messages rejected because the limit is exhausted')
+# outcome: invoice (инвойс отправлен), completed, rejected (payload не прошел проверку)
+PAYMENTS = metrics.counter('bot_payments_total', 'Payment events by outcome', labels=('type', 'outcome'))
+# Промежуточные правки стрим-сообщений, пропущенные из-за общего лимита STREAM_EDITS_PER_SECOND
+STREAM_EDITS_SKIPPED = metrics.counter(
+    'bot_stream_edits_skipped_total', 'Intermediate stream edits skipped by the global edit rate limit'
+)
+
+
+class InstrumentedRequest(BaseRequest):
+    """Обертка транспорта Bot API: длительность каждого вызова пишется в TELEGRAM_REQUEST_SECONDS."""
+
+    def __init__(self, request):
+        self._request = request
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit('/', 1)[-1]
+        status = 'exception'
+        started = time.perf_counter()
+        try:
+            code, payload = await self._request.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+            status = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, method=api_method, status=status)
+
+
+# user_id -> [asyncio.Lock, сколько задач держат или ждут блокировку]; запись удаляется, когда их нет
+_user_locks = {}
+
+
+@asynccontextmanager
+async def user_lock(user_id):
+    """
+    Обработка одного пользователя внутри процесса идет строго по одной.
+    asyncio.Lock пропускает ожидающих в порядке вызова, поэтому порядок сохраняется.
+    """
+    entry = _user_locks.get(user_id)
+    if entry is None:
+        entry = _user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _user_locks[user_id]
+
+
+class CorrelatedUpdateProcessor(SimpleUpdateProcessor):
+    """
+    Обрабатывает апдейт с привязанными correlation id и user_id: все записи логов,
+    сделанные обработчиками и запущенными из них задачами, можно собрать по апдейту.
+
+    Апдейты одного пользователя обрабатываются по одному в порядке поступления,
+    разные пользователи - параллельно. Очередь пользователя ждет до того, как занять слот
+    из max_concurrent_updates, чтобы серия сообщений одного пользователя не отнимала слоты у других.
+    """
+
+    async def process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        async with user_lock(user.id):
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        if isinstance(update, Update):
+            user = update.effective_user
+            log_service.bind(update.update_id, user.id if user else None)
+        await coroutine
 
 
 # ========================== ПРОВЕРКА ПОДПИСКИ ==========================
 
+# user_id -> подписан ли на канал. Ошибки Telegram не кэшируются.
+channel_membership_cache = TTLCache(maxsize=CHANNEL_CACHE_MAXSIZE)
+
+
 async def check_channel_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
     Проверяет, подписан ли пользователь на канал.
     Возвращает True если подписан, False если нет.
+    Результат кэшируется на CHANNEL_CACHE_POSITIVE_TTL / CHANNEL_CACHE_NEGATIVE_TTL секунд.
     """
     # Если переменные канала не заданы, пропускаем проверку
     if not CHANNEL_ID and not CHANNEL_USERNAME:
-        print("⚠️ CHANNEL_ID и CHANNEL_USERNAME не заданы. Проверка подписки отключена.")
+        log.warning("CHANNEL_ID и CHANNEL_USERNAME не заданы, проверка подписки отключена", sample=LOG_SAMPLE_RATE)
         return True
     
     try:
@@ -51,15 +174,25 @@ async def check_channel_subscription(user_id: int, context: ContextTypes.DEFAULT
             chat_id = CHANNEL_USERNAME
         else:
             return True
-            
+
+        cached = channel_membership_cache.get(user_id)
+        if cached is not None:
+            return cached
+
         member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
         # Статусы: creator, administrator, member = подписан
         # left, kicked = не подписан
         is_subscribed = member.status in ['creator', 'administrator', 'member']
         
         if not is_subscribed:
-            print(f"ℹ️ User {user_id} не подписан на канал. Статус: {member.status}")
-        
+            log.info("Пользователь не подписан на канал", sample=LOG_SAMPLE_RATE,
+                     user_id=user_id, status=member.status)
+
+        channel_membership_cache.set(
+            user_id,
+            is_subscribed,
+            ttl=CHANNEL_CACHE_POSITIVE_TTL if is_subscribed else CHANNEL_CACHE_NEGATIVE_TTL
+        )
         return is_subscribed
         
     except TelegramError as e:
@@ -67,18 +200,14 @@ async def check_channel_subscription(user_id: int, context: ContextTypes.DEFAULT
         
         # Разные типы ошибок
         if "chat not found" in error_message:
-            print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Канал не найден!")
-            print(f"   CHANNEL_ID: {CHANNEL_ID}")
-            print(f"   CHANNEL_USERNAME: {CHANNEL_USERNAME}")
-            print(f"   Проверьте:")
-            print(f"   1. Бот добавлен в администраторы канала?")
-            print(f"   2. ID канала правильный? (должен начинаться с -100)")
-            print(f"   3. Используйте @raw_data_bot для получения ID")
+            log.error("Канал не найден: бот должен быть администратором канала, "
+                      "CHANNEL_ID начинается с -100 (узнать можно через @raw_data_bot)",
+                      channel_id=CHANNEL_ID, channel_username=CHANNEL_USERNAME)
         elif "bot was kicked" in error_message:
-            print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Бота удалили из канала!")
-            print(f"   Заново добавьте бота в администраторы канала.")
+            log.error("Бота удалили из канала, заново добавьте его в администраторы",
+                      channel_id=CHANNEL_ID, channel_username=CHANNEL_USERNAME)
         else:
-            print(f"⚠️ Ошибка проверки подписки для user {user_id}: {e}")
+            log.warning("Ошибка проверки подписки", user_id=user_id, error=repr(e))
         
         # В случае ошибки пропускаем проверку, чтобы не блокировать бота
         return True
@@ -110,6 +239,10 @@ async def send_subscription_required_message(update: Update, context: ContextTyp
 
 # ========================== СЕРВИСНЫЕ ФУНКЦИИ ==========================
 
+# Типы апдейтов, которые бот реально обрабатывает (успешная оплата приходит как message)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.PRE_CHECKOUT_QUERY]
+
+
 async def set_bot_commands(application):
     """Устанавливает команды меню для бота."""
     commands = [
@@ -120,7 +253,159 @@ async def set_bot_commands(application):
         BotCommand("reset", "Очистить историю"),
     ]
     await application.bot.set_my_commands(commands)
-    print("Меню команд успешно установлено.")
+    log.info("Меню команд установлено")
+
+
+# ========================== СТРИМИНГ ОТВЕТОВ ==========================
+
+AI_ERROR_MESSAGE = "Извини, произошел технический сбой 💔 Попробуй чуть позже."
+
+# Максимальная длина текста сообщения в Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class EditRateLimiter:
+    """
+    Token bucket на правки стрим-сообщений всех чатов процесса: rate правок в секунду,
+    до burst подряд. Промежуточную правку можно пропустить (try_acquire),
+    финальная ждет своей очереди (acquire).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+stream_edit_limiter = EditRateLimiter(STREAM_EDITS_PER_SECOND / max(1, SUPERVISOR_WORKERS))
+
+
+def _split_point(text, start):
+    """
+    Где закончить сообщение, которое начинается с позиции start: по последнему переносу строки
+    или пробелу во второй половине лимита, иначе ровно по TELEGRAM_MESSAGE_LIMIT.
+    """
+    end = start + TELEGRAM_MESSAGE_LIMIT
+    if len(text) <= end:
+        return len(text)
+    for separator in ('\n', ' '):
+        cut = text.rfind(separator, start + TELEGRAM_MESSAGE_LIMIT // 2, end)
+        if cut != -1:
+            return cut + 1
+    return end
+
+
+async def _edit_streamed_message(message, text):
+    """
+    Редактирует сообщение со стримящимся ответом.
+    Возвращает паузу (сек), которую нужно выдержать перед следующим редактированием.
+    """
+    try:
+        await message.edit_text(text[:TELEGRAM_MESSAGE_LIMIT])
+    except RetryAfter as e:
+        # Telegram просит подождать: пропускаем это обновление и откладываем следующее
+        retry_after = e.retry_after
+        return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+    except BadRequest as e:
+        # Текст не изменился с прошлого редактирования - это не ошибка
+        if "message is not modified" not in str(e).lower():
+            log.warning("Не удалось обновить стрим-сообщение", error=repr(e))
+    return 0.0
+
+
+async def _finish_streamed_message(message, text, shown_text):
+    """Последняя правка сообщения: ждет общий лимит правок и повторяется после RetryAfter."""
+    if text == shown_text:
+        return
+    await stream_edit_limiter.acquire()
+    pause = await _edit_streamed_message(message, text)
+    if pause:
+        await asyncio.sleep(pause)
+        await _edit_streamed_message(message, text)
+
+
+async def stream_reply(update: Update, user_id, user_message, user_display_name, history,
+                       priority=PRIORITY_FREE, memory=None, facts=None):
+    """
+    Отправляет ответ модели по мере генерации: первое сообщение уходит с первым токеном,
+    затем редактируется не чаще STREAM_EDIT_INTERVAL и в пределах общего stream_edit_limiter.
+    Ответ длиннее TELEGRAM_MESSAGE_LIMIT продолжается следующими сообщениями.
+    Возвращает итоговый текст ответа - он отправлен пользователю целиком.
+    """
+    loop = asyncio.get_running_loop()
+    sent = None        # сообщение, которое сейчас дописывается
+    start = 0          # позиция в text, с которой начинается sent
+    text = ""
+    shown_text = ""    # что сейчас показано в sent
+    next_edit_at = 0.0
+
+    async def send_filled_parts():
+        """Отправляет новые сообщения и дописывает заполненные; в sent остается последнее."""
+        nonlocal sent, start, shown_text, next_edit_at
+        while True:
+            if sent is None:
+                if not text[start:].strip():
+                    return
+                end = _split_point(text, start)
+                sent = await update.message.reply_text(text[start:end])
+                shown_text = text[start:end]
+                next_edit_at = loop.time() + STREAM_EDIT_INTERVAL
+            if len(text) - start <= TELEGRAM_MESSAGE_LIMIT:
+                return
+            # Сообщение заполнено: фиксируем его текст, продолжение уйдет новым сообщением
+            end = _split_point(text, start)
+            await _finish_streamed_message(sent, text[start:end], shown_text)
+            sent, start = None, end
+
+    try:
+        async for delta in stream_ai_response(user_id, user_message, user_display_name,
+                                              history=history, priority=priority,
+                                              memory=memory, facts=facts):
+            text += delta
+            await send_filled_parts()
+
+            current = text[start:]
+            if sent is None or loop.time() < next_edit_at or current == shown_text:
+                continue
+            if not stream_edit_limiter.try_acquire():
+                # Общий лимит правок исчерпан: текст догонит одна из следующих правок
+                STREAM_EDITS_SKIPPED.inc()
+                continue
+            pause = await _edit_streamed_message(sent, current)
+            if not pause:
+                shown_text = current
+            next_edit_at = loop.time() + max(STREAM_EDIT_INTERVAL, pause)
+
+    except Exception as e:
+        log.error("Ошибка при стриминге ответа модели", user_id=user_id, error=repr(e))
+        if sent is None and not start:
+            text = AI_ERROR_MESSAGE
+
+    # Финальная версия текста
+    if sent is None and not start and not text.strip():
+        text = AI_ERROR_MESSAGE
+    await send_filled_parts()
+    if sent is not None:
+        await _finish_streamed_message(sent, text[start:], shown_text)
+
+    return text
 
 
 # ========================== ПЛАТЕЖИ ==========================
@@ -137,10 +422,11 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     payment_token = update.message.successful_payment.invoice_payload
     
     # Верифицируем платеж
-    valid, payment_data = verify_and_consume_payment(payment_token, user_id)
+    valid, payment_data = await verify_and_consume_payment(payment_token, user_id)
     
     if not valid:
-        print(f"SECURITY ALERT: Invalid payment attempt by user {user_id}, token: {payment_token}")
+        PAYMENTS.inc(type='unknown', outcome='rejected')
+        log.warning("Security: invalid payment attempt", user_id=user_id, payment_token=payment_token)
         await update.message.reply_text(
             "❌ Ошибка обработки платежа. Пожалуйста, обратитесь в поддержку."
         )
@@ -148,19 +434,21 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     
     # Обрабатываем платеж
     if payment_data['payment_type'] == 'subscription':
-        activate_subscription(user_id, duration_days=30)
+        await activate_subscription(user_id, duration_days=30)
         await update.message.reply_text(SUCCESS_PAYMENT_MESSAGE)
     
     elif payment_data['payment_type'] == 'messages':
         count = payment_data['package_details']['count']
-        increase_limit(user_id, count_to_add=count)
+        await increase_limit(user_id, count_to_add=count)
         
         await update.message.reply_text(
             f"✅ **Успешная покупка!** Вам добавлено **{count}** сообщений. Ваш лимит обновлен.",
             parse_mode='Markdown'
         )
     
-    print(f"Valid payment processed for user {user_id}: {payment_data}")
+    PAYMENTS.inc(type=payment_data['payment_type'], outcome='completed')
+    log.info("Payment processed", user_id=user_id, payment_type=payment_data['payment_type'],
+             amount=payment_data['amount'])
 
 
 async def send_subscription_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -168,8 +456,8 @@ async def send_subscription_invoice(update: Update, context: ContextTypes.DEFAUL
     user_id = update.effective_user.id
     
     # Проверяем, нет ли уже активной подписки
-    if is_user_subscribed(user_id):
-        days_left, _ = get_user_status(user_id)
+    if await is_user_subscribed(user_id):
+        days_left, _ = await get_user_status(user_id)
         await update.callback_query.answer(
             f"У вас уже есть активная подписка! Осталось {days_left} дней.",
             show_alert=True
@@ -177,7 +465,7 @@ async def send_subscription_invoice(update: Update, context: ContextTypes.DEFAUL
         return
     
     # Создаем защищенный токен
-    payment_token = create_payment_intent(
+    payment_token = await create_payment_intent(
         user_id=user_id,
         payment_type='subscription',
         amount=SUBSCRIPTION_PRICE_STARS
@@ -199,6 +487,7 @@ async def send_subscription_invoice(update: Update, context: ContextTypes.DEFAUL
             [InlineKeyboardButton(f"Купить за {SUBSCRIPTION_PRICE_STARS} ⭐", pay=True)]
         ])
     )
+    PAYMENTS.inc(type='subscription', outcome='invoice')
 
 
 async def _send_message_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE, count: int, price: int, payload_key: str):
@@ -206,7 +495,7 @@ async def _send_message_invoice(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.effective_user.id
     
     # Создаем защищенный токен
-    payment_token = create_payment_intent(
+    payment_token = await create_payment_intent(
         user_id=user_id,
         payment_type='messages',
         amount=price,
@@ -229,6 +518,7 @@ async def _send_message_invoice(update: Update, context: ContextTypes.DEFAULT_TY
             [InlineKeyboardButton(f"Купить за {price} ⭐", pay=True)]
         ])
     )
+    PAYMENTS.inc(type='messages', outcome='invoice')
 
 
 # ========================== НАВИГАЦИЯ ==========================
@@ -250,8 +540,8 @@ async def show_subscription_details(update: Update, context: ContextTypes.DEFAUL
         return
     
     # Проверяем наличие активной подписки
-    if is_user_subscribed(user_id):
-        days_left, _ = get_user_status(user_id)
+    if await is_user_subscribed(user_id):
+        days_left, _ = await get_user_status(user_id)
         message_text = (
             f"✅ **У вас уже активна подписка!**\n\n"
             f"До конца осталось: **{days_left}** дней.\n\n"
@@ -345,7 +635,8 @@ async def test_channel_command(update: Update, context: ContextTypes.DEFAULT_TYP
         f"📋 **Конфигурация канала:**\n\n"
         f"CHANNEL_USERNAME: `{CHANNEL_USERNAME}`\n"
         f"CHANNEL_ID: `{CHANNEL_ID}`\n"
-        f"Type: `{type(CHANNEL_ID).__name__}`\n\n"
+        f"Type: `{type(CHANNEL_ID).__name__}`\n"
+        f"Cache: `{channel_membership_cache.stats()}`\n\n"
     )
     
     # Пытаемся получить информацию о канале
@@ -433,8 +724,12 @@ async def confirm_reset_history(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     user_id = query.from_user.id
     
-    # Сначала сбросим историю
-    clear_user_history(user_id)
+    # Сначала сбросим историю (и сводку памяти, если она как раз обновляется)
+    if memory_summarizer is not None:
+        memory_summarizer.cancel(user_id)
+    await clear_user_history(user_id)
+    if vector_memory is not None:
+        await vector_memory.delete_user(user_id)
 
     # Редактируем сообщение, чтобы показать результат
     await query.edit_message_text(
@@ -466,7 +761,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Получаем статус
-    days_left, messages_info = get_user_status(user_id)
+    days_left, messages_info = await get_user_status(user_id)
 
     welcome_message = (
         "Привет! Я Алина и я здесь для тебя! 💕\n"
@@ -531,6 +826,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # ПРОВЕРКА ПОДПИСКИ НА КАНАЛ (кнопка "Я подписался")
     if data == 'check_subscription':
+        # Пользователь только что подписался - кэшированный отрицательный статус больше не актуален
+        channel_membership_cache.invalidate(user_id)
         if await check_channel_subscription(user_id, context):
             await start_command(update, context)
         else:
@@ -588,15 +885,55 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_id = update.message.from_user.id
     user_message = update.message.text
-    user_display_name = update.message.from_user.first_name
 
     # 0. Проверяем подписку на канал
     if not await check_channel_subscription(user_id, context):
         await send_subscription_required_message(update, context)
         return
 
-    # 1. Проверка подписки и лимита
-    if not is_user_subscribed(user_id) and not check_and_increment_limit(user_id, DAILY_LIMIT):
+    # Серии сообщений подряд объединяются в один запрос к модели
+    if message_coalescer is not None:
+        message_coalescer.add(user_id, user_message, update, context)
+        return
+
+    await reply_to_messages(update, context, [user_message])
+
+
+def _llm_priority(subscribed, messages_info):
+    """Класс приоритета в очереди к модели по результату списания квоты."""
+    if subscribed:
+        return PRIORITY_SUBSCRIBER
+    # Пока есть купленные сообщения, списываются они, и дневной лимит остается нетронутым
+    if messages_info and (messages_info['purchased'] > 0 or messages_info['daily'] == DAILY_LIMIT):
+        return PRIORITY_PURCHASED
+    return PRIORITY_FREE
+
+
+def _schedule_coalesced_reply(user_id, texts, update, context):
+    """Колбэк MessageCoalescer: запускает ответ на пачку сообщений (ошибки уходят в error_handler)."""
+    context.application.create_task(_reply_in_order(user_id, update, context, texts), update=update)
+
+
+async def _reply_in_order(user_id, update, context, texts):
+    """Ответ на пачку идет вне обработки апдейта, поэтому очередь пользователя берется явно."""
+    async with user_lock(user_id):
+        await reply_to_messages(update, context, texts)
+
+
+async def reply_to_messages(update: Update, context: ContextTypes.DEFAULT_TYPE, user_messages):
+    """
+    Отвечает на одно или несколько подряд идущих сообщений пользователя одним запросом к модели.
+    Квота списывается один раз, каждое сообщение сохраняется в истории отдельно.
+    """
+    user_id = update.message.from_user.id
+    user_display_name = update.message.from_user.first_name
+    user_message = "\n".join(user_messages)
+
+    # 1. Проверка подписки и лимита (один атомарный запрос к БД)
+    with REPLY_STAGE_SECONDS.time(stage='quota'):
+        allowed, subscribed, messages_info = await consume_message_quota(user_id, DAILY_LIMIT)
+    if not allowed:
+        QUOTA_DENIALS.inc()
         keyboard = [
             [InlineKeyboardButton(f"⭐ Купить безлимит ({SUBSCRIPTION_PRICE_STARS} ⭐/30 дней)", callback_data="show_sub_details")],
             [InlineKeyboardButton(
@@ -614,48 +951,96 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # 2. Индикатор "печатает..."
-    await context.bot.send_chat_action(
-        chat_id=update.effective_chat.id,
-        action="typing"
-    )
+    with REPLY_STAGE_SECONDS.time(stage='typing'):
+        await context.bot.send_chat_action(
+            chat_id=update.effective_chat.id,
+            action="typing"
+        )
     
-    # 3. Сохраняем сообщение пользователя
-    save_message(user_id, "user", user_message)
+    # 3. Загружаем историю (до сохранения текущих сообщений, они добавляются в промпт отдельно)
+    #    и сохраняем сообщения пользователя. Реплик загружается с запасом,
+    #    под бюджет токенов их обрежет ai_service. Реплики, уже свернутые в сводку памяти,
+    #    заменяются самой сводкой
+    with REPLY_STAGE_SECONDS.time(stage='history'):
+        memory, summarized_until = await get_user_memory(user_id) if SUMMARY_ENABLED else (None, None)
+        history = await get_chat_history(user_id, limit=HISTORY_MAX_MESSAGES, since=summarized_until)
+    # Факты из векторной памяти, относящиеся к текущему сообщению (поиск ограничен по времени)
+    with REPLY_STAGE_SECONDS.time(stage='facts'):
+        facts = await vector_memory.search(user_id, user_message) if vector_memory is not None else None
+    with REPLY_STAGE_SECONDS.time(stage='save'):
+        for text in user_messages:
+            await save_message(user_id, "user", text)
+
+    priority = _llm_priority(subscribed, messages_info)
+
+    # 4. Стриминг: текст появляется по мере генерации, искусственная задержка не нужна
+    if STREAMING_ENABLED:
+        # generate здесь включает и отправку: сообщение редактируется по мере генерации
+        with REPLY_STAGE_SECONDS.time(stage='generate'):
+            ai_response = await stream_reply(
+                update, user_id, user_message, user_display_name, history, priority, memory, facts
+            )
+        with REPLY_STAGE_SECONDS.time(stage='save'):
+            await save_message(user_id, "assistant", ai_response)
+        _schedule_summary(user_id, len(history) + len(user_messages) + 1)
+        return
 
-    # 4. Получаем ответ от AI
+    # 5. Получаем ответ от AI целиком
     try:
-        ai_response = generate_ai_response(user_id, user_message, user_display_name)
+        with REPLY_STAGE_SECONDS.time(stage='generate'):
+            ai_response = await generate_ai_response_async(
+                user_id, user_message, user_display_name, history=history, priority=priority,
+                memory=memory, facts=facts
+            )
     except Exception as e:
-        print(f"Критическая ошибка при вызове AI для user {user_id}: {e}")
-        ai_response = "Извини, произошел технический сбой 💔 Попробуй чуть позже."
+        log.error("Ошибка при вызове модели", user_id=user_id, error=repr(e))
+        ai_response = AI_ERROR_MESSAGE
 
-    # 5. Естественная задержка перед ответом
+    # 6. Естественная задержка перед ответом
     typing_time = len(ai_response) / 80  # 80 символов/сек
     typing_time = min(typing_time, 4)  # Максимум 4 секунды
     typing_time = max(typing_time, 0.5)  # Минимум 0.5 секунды
     
     await asyncio.sleep(typing_time)
 
-    # 6. Отправляем ответ
-    await update.message.reply_text(ai_response)
-    save_message(user_id, "assistant", ai_response)
+    # 7. Отправляем ответ
+    with REPLY_STAGE_SECONDS.time(stage='send'):
+        await update.message.reply_text(ai_response)
+    with REPLY_STAGE_SECONDS.time(stage='save'):
+        await save_message(user_id, "assistant", ai_response)
+    _schedule_summary(user_id, len(history) + len(user_messages) + 1)
+
+
+def _schedule_summary(user_id, unsummarized):
+    """Запускает фоновое сжатие старых реплик, если их накопилось достаточно."""
+    if memory_summarizer is not None:
+        memory_summarizer.maybe_schedule(user_id, unsummarized)
+
+
+# Объединение серий сообщений (COALESCE_WINDOW_SECONDS = 0 отключает)
+message_coalescer = (
+    MessageCoalescer(COALESCE_WINDOW_SECONDS, _schedule_coalesced_reply, max_messages=COALESCE_MAX_MESSAGES)
+    if COALESCE_WINDOW_SECONDS > 0 else None
+)
+
+# Долговременная память (SUMMARY_ENABLED=0 отключает)
+memory_summarizer = ConversationSummarizer(SUMMARY_TRIGGER_MESSAGES) if SUMMARY_ENABLED else None
+# Векторная память фактов: создается в post_init, чтобы supervisor не открывал базу chromadb
+vector_memory = None
 
 
 # ========================== ОБРАБОТЧИК ОШИБОК ==========================
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Глобальный обработчик ошибок."""
-    import traceback
-    
-    # Логируем ошибку
-    print(f"❌ Exception while handling an update:")
-    print(f"Update: {update}")
-    print(f"Error: {context.error}")
-    
-    # Детальный traceback для отладки
-    tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-    tb_string = ''.join(tb_list)
-    print(f"Traceback:\n{tb_string}")
+    # Сам апдейт (с текстом сообщения) не пишется: для поиска хватает correlation id и типа апдейта
+    error = context.error
+    log.error(
+        "Exception while handling an update",
+        update_id=getattr(update, 'update_id', None),
+        update_type=type(update).__name__,
+        exc_info=(type(error), error, error.__traceback__)
+    )
     
     # Пытаемся отправить сообщение пользователю (если возможно)
     try:
@@ -671,20 +1056,39 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
 # ========================== ПЛАНИРОВЩИК ЗАДАЧ ==========================
 
 async def daily_cleanup(context):
-    """Ежедневная очистка старых сообщений."""
-    from db_manager import cleanup_all_old_messages
-    
-    deleted = cleanup_all_old_messages(days_to_keep=7)
-    print(f"✅ Ежедневная очистка завершена: удалено {deleted} сообщений")
+    """Ежедневная очистка старых сообщений и подготовка секций на следующие дни."""
+    await ensure_message_partitions()
+    deleted = await cleanup_all_old_messages(days_to_keep=7)
+    log.info("Ежедневная очистка завершена", deleted=deleted)
 
 
-# ========================== MAIN ==========================
+async def reencrypt_job(context):
+    """Фоновая перешифровка старых данных текущим ключом."""
+    await reencrypt_messages()
 
-def main():
-    """Инициализация и запуск Telegram-бота."""
-    init_db()
 
-    application = Application.builder().token(TOKEN_TG).build()
+# ========================== MAIN ==========================
+
+def build_application(worker_index=WORKER_INDEX, with_updater=True, request=None):
+    """
+    Собирает Application со всеми обработчиками и хуками жизненного цикла.
+    with_updater=False - для воркеров supervisor: апдейты приходят не из Telegram,
+    а передаются в application процессом-воркером (см. supervisor._run_worker).
+    request - свой транспорт к Bot API (нагрузочный тест подставляет фейковый Telegram).
+    Вызовы Bot API в любом случае проходят через InstrumentedRequest.
+    """
+    # concurrent_updates: без него PTB обрабатывает апдейты строго по одному,
+    # и ожидание модели для одного чата задерживает все остальные
+    builder = (
+        Application.builder()
+        .token(TOKEN_TG)
+        .concurrent_updates(CorrelatedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    # 256 соединений - как у ApplicationBuilder по умолчанию
+    builder = builder.request(InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256)))
+    application = builder.build()
 
     # Команды
     application.add_handler(CommandHandler("start", start_command))
@@ -707,24 +1111,99 @@ def main():
     # Глобальный обработчик ошибок
     application.add_error_handler(error_handler)
     
-    # Запускаем ежедневную очистку в 3 утра
-    application.job_queue.run_daily(
-        daily_cleanup,
-        time=dt_time(hour=3, minute=0)
-    )
-    
-    print("🚀 AIGirl bot is running...")
+    # Запускаем ежедневную очистку в 3 утра (при нескольких воркерах - только в одном)
+    if worker_index == 0:
+        application.job_queue.run_daily(
+            daily_cleanup,
+            time=dt_time(hour=3, minute=0)
+        )
+        # Перешифровка данных новым ключом после ротации (в фоне, короткими пачками)
+        if REENCRYPT_ON_START:
+            application.job_queue.run_once(reencrypt_job, when=30)
     
-    # Устанавливаем команды меню после запуска
+    # Пул БД создается внутри event loop приложения, затем устанавливаем команды меню
+    metrics_server = None
+
     async def post_init(app):
+        global vector_memory
+        nonlocal metrics_server
+        await init_db()
+        if METRICS_PORT:
+            try:
+                metrics_server = await metrics.start_http_server(METRICS_HOST, METRICS_PORT + worker_index)
+            except OSError as e:
+                log.warning("Не удалось запустить endpoint метрик", error=repr(e))
+        vector_memory = create_vector_memory()
+        if memory_summarizer is not None:
+            memory_summarizer.vector_memory = vector_memory
         try:
             await set_bot_commands(app)
         except Exception as e:
-            print(f"⚠️ Не удалось установить команды меню: {e}")
-            print("Бот продолжит работу без меню команд")
+            log.warning("Не удалось установить команды меню, бот продолжит работу без них", error=repr(e))
     
+    async def post_stop(app):
+        # Отвечаем на сообщения, ожидающие окончания серии, пока приложение еще может отправлять
+        if message_coalescer is not None:
+            await asyncio.gather(
+                *(_reply_in_order(user_id, update, context, texts)
+                  for user_id, texts, (update, context) in message_coalescer.drain()),
+                return_exceptions=True
+            )
+        if memory_summarizer is not None:
+            await memory_summarizer.stop()
+
+    async def post_shutdown(app):
+        await close_db()
+        if metrics_server is not None:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+
     application.post_init = post_init
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.post_stop = post_stop
+    application.post_shutdown = post_shutdown
+    return application
+
+
+def main():
+    """Инициализация и запуск Telegram-бота."""
+    log_service.setup_logging()
+    if SUPERVISOR_WORKERS > 0:
+        # Этот процесс только принимает апдейты и раздает их воркерам
+        from supervisor import run_supervisor
+        run_supervisor(SUPERVISOR_WORKERS)
+        return
+
+    application = build_application()
+    log.info("AIGirl bot is running", mode=BOT_MODE, worker=WORKER_INDEX)
+
+    if BOT_MODE == 'webhook':
+        run_webhook(application)
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+
+def run_webhook(application):
+    """
+    Запускает бота в режиме webhook на встроенном HTTP-сервере PTB.
+    Запросы без правильного X-Telegram-Bot-Api-Secret-Token отклоняются сервером (403).
+    Воркеры с разными WORKER_INDEX слушают соседние порты и регистрируют один и тот же URL,
+    поэтому их можно поставить за один балансировщик.
+    """
+    if not WEBHOOK_URL or not WEBHOOK_SECRET_TOKEN:
+        raise RuntimeError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL и WEBHOOK_SECRET_TOKEN")
+
+    port = WEBHOOK_PORT + WORKER_INDEX
+    log.info("Webhook listener started", listen=WEBHOOK_LISTEN, port=port, path=WEBHOOK_PATH)
+
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=port,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET_TOKEN,
+        allowed_updates=ALLOWED_UPDATES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
 
 
 if __name__ == '__main__':
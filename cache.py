@@ -0,0 +1,204 @@
+# cache.py - In-memory кэши для горячих путей бота
+import time
+from collections import OrderedDict, deque
+
+
+class TTLCache:
+    """
+    LRU-кэш с ограничением по числу записей и TTL у каждой записи.
+    Рассчитан на использование из одного event loop, блокировок нет.
+    """
+
+    def __init__(self, maxsize, default_ttl=None):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()  # key -> (value, expires_at | None)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Возвращает значение или default, если записи нет или она устарела."""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Сохраняет значение. ttl (сек) переопределяет default_ttl; None - без срока."""
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+
+        # Вытесняем самые давно использованные записи
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Удаляет запись, если она есть."""
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Счетчики попаданий/промахов для мониторинга."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class ConversationWindowCache:
+    """
+    Кэш последних реплик диалога для каждого пользователя.
+    Для каждого user_id хранится кольцевой буфер из window_size реплик;
+    общий объем текста ограничен max_bytes, при превышении вытесняются
+    пользователи, к которым дольше всего не обращались (LRU).
+    ttl (сек) - через сколько после загрузки из БД окно перечитывается (None - без срока);
+    max_bytes=0 выключает кэш.
+    """
+
+    def __init__(self, max_bytes, window_size, ttl=None):
+        self.max_bytes = max_bytes
+        self.window_size = window_size
+        self.ttl = ttl
+        # user_id -> {'turns': deque[(role, content, size, timestamp)], 'bytes': int, 'complete': bool,
+        #             'expires_at': float | None}
+        # complete=True: в буфере вся история пользователя (в БД меньше window_size сообщений)
+        self._data = OrderedDict()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _size(content):
+        return len(content.encode('utf-8'))
+
+    def get(self, user_id, limit, since=None):
+        """
+        Последние limit реплик в формате chat completions или None при промахе.
+        since - вернуть только реплики новее этого момента (уже учтенные в сводке пропускаются).
+        """
+        entry = self._data.get(user_id)
+        if entry is not None and entry['expires_at'] is not None and entry['expires_at'] <= time.monotonic():
+            self.invalidate(user_id)
+            self.expirations += 1
+            entry = None
+        if entry is None or not self._covers(entry, limit, since):
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        turns = list(entry['turns'])[-limit:] if limit else []
+        return [
+            {"role": role, "content": content}
+            for role, content, _, timestamp in turns
+            if since is None or timestamp is None or timestamp > since
+        ]
+
+    @staticmethod
+    def _covers(entry, limit, since):
+        """Хватает ли окна в кэше, чтобы ответить без БД."""
+        turns = entry['turns']
+        if len(turns) >= limit or entry['complete']:
+            return True
+        # Самая старая реплика окна уже в сводке - все более новые в кэше есть
+        oldest = turns[0][3] if turns else None
+        return since is not None and oldest is not None and oldest <= since
+
+    def put(self, user_id, history, complete):
+        """
+        Заменяет окно пользователя историей, загруженной из БД (от старых к новым).
+        Элементы history - словари с role, content и необязательным timestamp.
+        """
+        self.invalidate(user_id)
+        if not self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        entry = {'turns': deque(maxlen=self.window_size), 'bytes': 0, 'complete': complete, 'expires_at': expires_at}
+        self._data[user_id] = entry
+        for message in history[-self.window_size:]:
+            self._push(entry, message['role'], message['content'], message.get('timestamp'))
+        self._evict()
+
+    def append(self, user_id, role, content, timestamp=None):
+        """Добавляет новую реплику, если окно пользователя уже в кэше."""
+        entry = self._data.get(user_id)
+        if entry is None:
+            return
+        self._push(entry, role, content, timestamp)
+        self._data.move_to_end(user_id)
+        self._evict()
+
+    def reset(self, user_id):
+        """История пользователя очищена: запоминаем пустое полное окно."""
+        self.put(user_id, [], complete=True)
+
+    def invalidate(self, user_id):
+        entry = self._data.pop(user_id, None)
+        if entry is not None:
+            self.total_bytes -= entry['bytes']
+
+    def clear(self):
+        self._data.clear()
+        self.total_bytes = 0
+
+    def _push(self, entry, role, content, timestamp=None):
+        turns = entry['turns']
+        if len(turns) == turns.maxlen:
+            _, _, dropped, _ = turns.popleft()
+            entry['bytes'] -= dropped
+            self.total_bytes -= dropped
+        size = self._size(content)
+        turns.append((role, content, size, timestamp))
+        entry['bytes'] += size
+        self.total_bytes += size
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._data:
+            _, entry = self._data.popitem(last=False)
+            self.total_bytes -= entry['bytes']
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'users': len(self._data),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,71 @@
+# coalescer.py - Объединение серий коротких сообщений пользователя
+import asyncio
+
+
+class MessageCoalescer:
+    """
+    Per-user debounce для входящих сообщений.
+    Сообщения одного пользователя, пришедшие с интервалом меньше window секунд,
+    копятся в одну пачку; когда пользователь замолкает на window секунд
+    (или пачка достигла max_messages), вызывается on_flush(user_id, texts, *args)
+    с аргументами последнего сообщения. on_flush - обычная функция, которая
+    сама планирует асинхронную обработку.
+    """
+
+    def __init__(self, window, on_flush, max_messages=10):
+        self.window = window
+        self.on_flush = on_flush
+        self.max_messages = max_messages
+        self._pending = {}  # user_id -> {'texts': [...], 'args': (...), 'timer': TimerHandle}
+
+        self.batches = 0
+        self.messages = 0
+
+    def add(self, user_id, text, *args):
+        """Добавляет сообщение в пачку пользователя и перезапускает таймер."""
+        batch = self._pending.get(user_id)
+        if batch is None:
+            batch = {'texts': [], 'args': args, 'timer': None}
+            self._pending[user_id] = batch
+        else:
+            batch['timer'].cancel()
+            # Отвечаем на последнее сообщение серии
+            batch['args'] = args
+
+        batch['texts'].append(text)
+        self.messages += 1
+
+        if len(batch['texts']) >= self.max_messages:
+            self._flush(user_id)
+            return
+
+        loop = asyncio.get_running_loop()
+        batch['timer'] = loop.call_later(self.window, self._flush, user_id)
+
+    def _flush(self, user_id):
+        batch = self._pending.pop(user_id, None)
+        if batch is None:
+            return
+        self.batches += 1
+        self.on_flush(user_id, batch['texts'], *batch['args'])
+
+    def drain(self):
+        """
+        Забирает все накопленные пачки без вызова on_flush (например, при остановке,
+        когда их нужно обработать синхронно). Возвращает список (user_id, texts, args).
+        """
+        drained = []
+        for user_id, batch in self._pending.items():
+            batch['timer'].cancel()
+            drained.append((user_id, batch['texts'], batch['args']))
+        self.batches += len(drained)
+        self._pending.clear()
+        return drained
+
+    def stats(self):
+        return {
+            'pending_users': len(self._pending),
+            'messages': self.messages,
+            'batches': self.batches,
+            'avg_batch': round(self.messages / self.batches, 2) if self.batches else 0.0,
+        }
@@ -1,5 +1,5 @@
 # config.py
-import os, base64
+import os, base64, json
 from dotenv import load_dotenv
 from datetime import datetime
 
@@ -11,11 +11,28 @@ TOKEN_TG = base64.b64decode(os.getenv('TOKEN_TG')).decode("utf-8")
 DEEPSEEK_API_KEY = base64.b64decode(os.getenv('DEEPSEEK_API_KEY')).decode("utf-8")
 PAYMENT_PROVIDER_TOKEN = os.getenv('PAYMENT_PROVIDER_TOKEN')
 ENCRYPTION_KEY = base64.b64decode(os.getenv('ENCRYPTION_KEY')).decode("utf-8")
+# Ротация ключей: ENCRYPTION_KEYS - base64 от списка "версия:ключ" через запятую, например "2:<key2>,1:<key1>".
+# ENCRYPTION_KEY считается версией 1, если она не задана в списке явно.
+# Новые данные шифруются версией ENCRYPTION_KEY_VERSION (0 - самая старшая из заданных)
+ENCRYPTION_KEYS = base64.b64decode(os.getenv('ENCRYPTION_KEYS', '')).decode("utf-8")
+ENCRYPTION_KEY_VERSION = int(os.getenv('ENCRYPTION_KEY_VERSION', '0'))
+# Пачки от CRYPTO_OFFLOAD_MIN_BATCH значений шифруются/расшифровываются в пуле из CRYPTO_THREADS потоков
+CRYPTO_THREADS = int(os.getenv('CRYPTO_THREADS', '4'))
+CRYPTO_OFFLOAD_MIN_BATCH = int(os.getenv('CRYPTO_OFFLOAD_MIN_BATCH', '16'))
+# Перешифровка старых данных текущим ключом: строк на транзакцию и пауза между пачками (сек)
+REENCRYPT_ON_START = os.getenv('REENCRYPT_ON_START', '0') == '1'
+REENCRYPT_BATCH_SIZE = int(os.getenv('REENCRYPT_BATCH_SIZE', '1000'))
+REENCRYPT_BATCH_PAUSE = float(os.getenv('REENCRYPT_BATCH_PAUSE', '0.1'))
 
 # --- ОБЯЗАТЕЛЬНАЯ ПОДПИСКА НА КАНАЛ ---
 CHANNEL_USERNAME =base64.b64decode(os.getenv('CHANNEL_USERNAME')).decode("utf-8")
 CHANNEL_ID = int (base64.b64decode((os.getenv('CHANNEL_ID', '0'))).decode("utf-8")) if base64.b64decode(os.getenv('CHANNEL_ID')).decode("utf-8") else None
 
+# Кэш статуса подписки на канал (сек): подписанных перепроверяем реже, чем неподписанных
+CHANNEL_CACHE_POSITIVE_TTL = int(os.getenv('CHANNEL_CACHE_POSITIVE_TTL', '600'))
+CHANNEL_CACHE_NEGATIVE_TTL = int(os.getenv('CHANNEL_CACHE_NEGATIVE_TTL', '30'))
+CHANNEL_CACHE_MAXSIZE = int(os.getenv('CHANNEL_CACHE_MAXSIZE', '50000'))
+
 # --- Database Configuration (Supabase PostgreSQL) ---
 DB_CONFIG = {
     'host': base64.b64decode(os.getenv('DB_HOST')).decode("utf-8"),
@@ -25,13 +42,196 @@ DB_CONFIG = {
     'password': base64.b64decode(os.getenv('DB_PASSWORD')).decode("utf-8")
 }
 
+# --- Async Connection Pool (asyncpg) ---
+# require для Supabase; disable - для локального PostgreSQL без TLS (например, в нагрузочном тесте)
+DB_SSL_MODE = os.getenv('DB_SSL_MODE', 'require')
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+# Таймаут выполнения запроса на стороне сервера (мс) и на стороне клиента (сек)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000'))
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '10'))
+# Для Supabase pooler в transaction mode (порт 6543) нужно выставить 0
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+# Соединение пересоздается после стольких запросов и закрывается, если простояло без дела дольше (сек; 0 - не закрывать)
+DB_POOL_MAX_QUERIES = int(os.getenv('DB_POOL_MAX_QUERIES', '50000'))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_POOL_MAX_INACTIVE_LIFETIME', '300'))
+# Сколько пользователей держать в кэше состояния (подписка + счетчик лимита)
+USER_STATE_CACHE_SIZE = int(os.getenv('USER_STATE_CACHE_SIZE', '100000'))
+# Максимальный срок жизни записи (сек), 0 - до полуночи. Изменения из других процессов
+# (например, оплата через другой воркер) видны не позже чем через этот срок
+USER_STATE_CACHE_TTL = int(os.getenv('USER_STATE_CACHE_TTL', '300'))
+# Write-behind для сообщений: пачка пишется одним COPY по размеру или по таймеру (сек)
+MESSAGE_WRITE_BEHIND = os.getenv('MESSAGE_WRITE_BEHIND', '1') == '1'
+MESSAGE_FLUSH_BATCH_SIZE = int(os.getenv('MESSAGE_FLUSH_BATCH_SIZE', '200'))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_FLUSH_INTERVAL', '0.5'))
+# Предел буфера: при заполнении save_message сам ждет записи (backpressure), а не копит дальше
+MESSAGE_BUFFER_MAX_SIZE = int(os.getenv('MESSAGE_BUFFER_MAX_SIZE', '10000'))
+# Сколько раз подряд пачка может не записаться, прежде чем она пишется по одной строке
+MESSAGE_FLUSH_MAX_RETRIES = int(os.getenv('MESSAGE_FLUSH_MAX_RETRIES', '5'))
+# Кэш расшифрованного окна диалога: реплик на пользователя и общий объем текста (байт)
+HISTORY_WINDOW_SIZE = int(os.getenv('HISTORY_WINDOW_SIZE', '20'))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv('HISTORY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Срок жизни окна диалога и сводки памяти в кэше (сек), после него они перечитываются из БД
+HISTORY_CACHE_TTL = int(os.getenv('HISTORY_CACHE_TTL', '300'))
+# Контекст для модели: бюджет токенов на весь промпт (системный + история + сообщение).
+# История набирается от новых реплик к старым, пока помещается, но не больше HISTORY_MAX_MESSAGES
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '4000'))
+HISTORY_MAX_MESSAGES = min(int(os.getenv('HISTORY_MAX_MESSAGES', '20')), HISTORY_WINDOW_SIZE)
+# Путь к tokenizer.json модели (HuggingFace tokenizers). Без него токены оцениваются по длине текста
+PROMPT_TOKENIZER_PATH = os.getenv('PROMPT_TOKENIZER_PATH', '')
+# Сводка памяти: когда в окне набирается SUMMARY_TRIGGER_MESSAGES реплик, не вошедших в сводку,
+# все, кроме SUMMARY_KEEP_RECENT последних, сворачиваются моделью в короткую запись о собеседнике
+SUMMARY_ENABLED = os.getenv('SUMMARY_ENABLED', '1') == '1'
+SUMMARY_TRIGGER_MESSAGES = min(int(os.getenv('SUMMARY_TRIGGER_MESSAGES', '16')), HISTORY_MAX_MESSAGES)
+SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', '6'))
+SUMMARY_MAX_BATCH = int(os.getenv('SUMMARY_MAX_BATCH', '60'))
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '400'))
+# Векторная память фактов (chromadb): факты из сводок сохраняются с эмбеддингами,
+# в промпт попадают только VECTOR_MEMORY_TOP_K самых близких к текущему сообщению
+VECTOR_MEMORY_ENABLED = os.getenv('VECTOR_MEMORY_ENABLED', '1') == '1'
+# Локальная база chromadb годится для одного процесса; для нескольких воркеров нужен сервер chroma
+VECTOR_MEMORY_PATH = os.getenv('VECTOR_MEMORY_PATH', 'vector_memory')
+VECTOR_MEMORY_HOST = os.getenv('VECTOR_MEMORY_HOST', '')
+VECTOR_MEMORY_PORT = int(os.getenv('VECTOR_MEMORY_PORT', '8000'))
+# hashing - локальный детерминированный эмбеддер без модели, sentence-transformers - модель VECTOR_MEMORY_MODEL
+VECTOR_MEMORY_EMBEDDER = os.getenv('VECTOR_MEMORY_EMBEDDER', 'hashing')
+VECTOR_MEMORY_MODEL = os.getenv('VECTOR_MEMORY_MODEL', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+VECTOR_MEMORY_TOP_K = int(os.getenv('VECTOR_MEMORY_TOP_K', '4'))
+# Сколько максимум ждать поиска (сек): не успели - отвечаем без фактов
+VECTOR_MEMORY_TIMEOUT = float(os.getenv('VECTOR_MEMORY_TIMEOUT', '0.3'))
+VECTOR_MEMORY_MAX_FACTS = int(os.getenv('VECTOR_MEMORY_MAX_FACTS', '500'))
+# Очистка старых сообщений: размер диапазона id на одну транзакцию и пауза между пачками (сек)
+CLEANUP_BATCH_SIZE = int(os.getenv('CLEANUP_BATCH_SIZE', '5000'))
+CLEANUP_BATCH_PAUSE = float(os.getenv('CLEANUP_BATCH_PAUSE', '0.2'))
+# На сколько дней вперед заранее создавать дневные секции таблицы messages
+MESSAGES_PARTITION_AHEAD_DAYS = int(os.getenv('MESSAGES_PARTITION_AHEAD_DAYS', '7'))
+
 # --- Model Settings ---
-DEEPSEEK_API_BASE = "https://openrouter.ai/api/v1" 
+DEEPSEEK_API_BASE = os.getenv('DEEPSEEK_API_BASE', "https://openrouter.ai/api/v1")
 MODEL_NAME = "deepseek/deepseek-chat-v3.1"
 
+# --- LLM Concurrency ---
+# Сколько запросов к модели может выполняться одновременно (на процесс)
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '32'))
+# Таймаут одного запроса к модели и ожидания свободного слота (сек)
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', '60'))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '30'))
+# Веса классов в очереди к модели: из 10 освободившихся слотов подписчики получают ~6
+LLM_PRIORITY_WEIGHTS = {
+    'subscriber': int(os.getenv('LLM_WEIGHT_SUBSCRIBER', '6')),
+    'purchased': int(os.getenv('LLM_WEIGHT_PURCHASED', '3')),
+    'free': int(os.getenv('LLM_WEIGHT_FREE', '1')),
+}
+# Сколько запросов одного пользователя может выполняться одновременно
+LLM_PER_USER_MAX_IN_FLIGHT = int(os.getenv('LLM_PER_USER_MAX_IN_FLIGHT', '1'))
+
+# --- LLM Failover ---
+# Запасные OpenAI-совместимые провайдеры после DEEPSEEK_API_BASE/MODEL_NAME, по порядку:
+# base64 от JSON-списка [{"name": "...", "base_url": "...", "model": "...", "api_key": "..."}].
+# Без api_key используется DEEPSEEK_API_KEY
+LLM_FALLBACK_BACKENDS = json.loads(base64.b64decode(os.getenv('LLM_FALLBACK_BACKENDS', '')).decode("utf-8") or '[]')
+# Попыток на один запрос (включая переключения на другого провайдера) и таймаут одной попытки (сек);
+# весь запрос по-прежнему ограничен LLM_REQUEST_TIMEOUT
+LLM_MAX_ATTEMPTS = int(os.getenv('LLM_MAX_ATTEMPTS', '3'))
+LLM_ATTEMPT_TIMEOUT = float(os.getenv('LLM_ATTEMPT_TIMEOUT', '30'))
+# Пауза перед повтором на том же провайдере: случайная от 0 до base * 2^n, не больше max (сек)
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', '0.25'))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', '2'))
+# Circuit breaker: после стольких ошибок подряд провайдер отключается на LLM_BREAKER_RESET_SECONDS
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', '5'))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv('LLM_BREAKER_RESET_SECONDS', '30'))
+
+# --- LLM Hedging ---
+# LLM_HEDGE_ENABLED=1: если ответа (или первого фрагмента при стриминге) нет дольше LLM_HEDGE_PERCENTILE
+# недавних задержек, отправляется дубль запроса, побеждает первый ответ. Дублей в среднем не больше
+# LLM_HEDGE_BUDGET от всех запросов. Дубль не занимает слот llm_scheduler: LLM_MAX_CONCURRENCY
+# может быть превышен ровно на число дублей в работе
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', '0') == '1'
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '0.95'))
+# Не дублировать раньше чем через столько секунд и пока не набралось LLM_HEDGE_MIN_SAMPLES замеров
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '1.0'))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '50'))
+LLM_HEDGE_BUDGET = float(os.getenv('LLM_HEDGE_BUDGET', '0.05'))
+
+# Сколько апдейтов Telegram обрабатывается параллельно
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '256'))
+
+# --- Update Delivery (polling / webhook) ---
+# BOT_MODE=webhook: Telegram присылает апдейты на встроенный HTTP-сервер вместо long polling
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный HTTPS-адрес, на который Telegram шлет апдейты (без пути), например https://bot.example.com
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (base64, как и остальные секреты)
+WEBHOOK_SECRET_TOKEN = base64.b64decode(os.getenv('WEBHOOK_SECRET_TOKEN', '')).decode("utf-8")
+# Несколько воркеров за одним балансировщиком: воркер N слушает порт WEBHOOK_PORT + N,
+# фоновые задачи (очистка и т.п.) выполняет только воркер 0
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', '0'))
+
+# --- Supervisor (несколько процессов) ---
+# SUPERVISOR_WORKERS > 0: главный процесс только принимает апдейты (polling или webhook)
+# и раздает их N процессам-воркерам по user_id. У каждого воркера свой пул БД,
+# поэтому всего соединений до SUPERVISOR_WORKERS * DB_POOL_MAX_SIZE
+SUPERVISOR_WORKERS = int(os.getenv('SUPERVISOR_WORKERS', '0'))
+SUPERVISOR_QUEUE_SIZE = int(os.getenv('SUPERVISOR_QUEUE_SIZE', '1000'))
+# Виртуальных узлов на воркер в кольце consistent hashing
+SUPERVISOR_VIRTUAL_NODES = int(os.getenv('SUPERVISOR_VIRTUAL_NODES', '64'))
+# Сколько секунд ждать, пока воркер доработает очередь при остановке
+SUPERVISOR_DRAIN_TIMEOUT = int(os.getenv('SUPERVISOR_DRAIN_TIMEOUT', '30'))
+# Сколько секунд ждать места в очереди воркера, прежде чем отбросить апдейт (другие воркеры при этом не ждут)
+SUPERVISOR_DISPATCH_TIMEOUT = float(os.getenv('SUPERVISOR_DISPATCH_TIMEOUT', '5'))
+# Пауза перед перезапуском упавшего воркера (сек): удваивается при каждом падении подряд до MAX_DELAY
+SUPERVISOR_RESTART_BASE_DELAY = float(os.getenv('SUPERVISOR_RESTART_BASE_DELAY', '1'))
+SUPERVISOR_RESTART_MAX_DELAY = float(os.getenv('SUPERVISOR_RESTART_MAX_DELAY', '60'))
+
+# --- Кэши в памяти процесса ---
+# Кэши состояния пользователя, окна диалога и сводки памяти верны, только если все апдейты
+# пользователя обрабатывает один процесс: polling (получатель апдейтов всегда один) или supervisor
+# (шардинг по user_id). Несколько webhook-воркеров за балансировщиком без привязки пользователя
+# к воркеру - кэши выключены. USER_AFFINITY=1 включает их явно (один webhook-воркер или
+# балансировщик, закрепляющий пользователя за воркером), USER_AFFINITY=0 - выключает
+USER_AFFINITY = os.getenv('USER_AFFINITY', '1' if BOT_MODE == 'polling' or SUPERVISOR_WORKERS > 0 else '0') == '1'
+
+# --- Metrics (Prometheus) ---
+# Endpoint /metrics слушает METRICS_HOST:METRICS_PORT + WORKER_INDEX (у каждого воркера свой).
+# METRICS_PORT=0 отключает endpoint
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# --- Logging ---
+# Записи пишутся в stdout отдельным потоком; LOG_FORMAT=json (для сборщика логов) или text
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# При переполнении очереди новые записи отбрасываются (метрика bot_log_dropped_total)
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Доля записей частых событий (обрезка промпта, отмена запроса к модели и т.п.), которые пишутся
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))
+# Тексты сообщений пользователей в логах заменяются длиной; 0 - писать как есть (только для отладки)
+LOG_REDACT_CONTENT = os.getenv('LOG_REDACT_CONTENT', '1') == '1'
+
+# --- Streaming Replies ---
+# Ответ показывается по мере генерации: первое сообщение отправляется сразу,
+# затем редактируется не чаще одного раза в STREAM_EDIT_INTERVAL секунд
+STREAMING_ENABLED = os.getenv('STREAMING_ENABLED', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+# Общий лимит правок стрим-сообщений на бота (в секунду, все чаты вместе): Telegram ограничивает
+# частоту запросов бота целиком. При supervisor лимит делится поровну между воркерами
+STREAM_EDITS_PER_SECOND = float(os.getenv('STREAM_EDITS_PER_SECOND', '20'))
+
+# --- Message Coalescing ---
+# Сообщения пользователя с паузой меньше окна (сек) объединяются в один запрос к модели.
+# Окно добавляется к времени каждого ответа, поэтому по умолчанию выключено (0); например, 1.5
+COALESCE_WINDOW_SECONDS = float(os.getenv('COALESCE_WINDOW_SECONDS', '0'))
+COALESCE_MAX_MESSAGES = int(os.getenv('COALESCE_MAX_MESSAGES', '5'))
+
 # --- Bot Logic & Monetization ---
 DAILY_LIMIT = 50                
 SUBSCRIPTION_PRICE_STARS = 10     # Цена подписки в Stars за 30 дней
+# Время жизни платежного токена (мин): у пользователя есть 10 минут на завершение платежа
+PAYMENT_EXPIRATION_MINUTES = 10
 
 # --- ПЕРЕМЕННЫЕ ДЛЯ РАЗОВОЙ ПОКУПКИ ---
 MESSAGE_PACKAGES = {
@@ -161,6 +361,14 @@ SYSTEM_PROMPT = """💖 PROMPT: AIGIRL — Реалистичное Поведе
 Имя собеседника: {user_name}
 """
 
+# Промпт для сжатия старых реплик в долговременную память
+SUMMARY_PROMPT = """Ты ведешь короткую заметку-память о собеседнике для персонажа-девушки из чата.
+Тебе дают прежнюю заметку (может быть пустой) и новые реплики диалога.
+Обнови заметку: имя, возраст, город, работа/учеба, интересы, важные события и планы,
+что собеседнику нравится и не нравится, о чем договорились, общий тон отношений.
+Пиши кратко, по фактам, списком, на русском, не больше 150 слов.
+Не выдумывай и не пересказывай диалог дословно. Верни только текст заметки."""
+
 # Сообщения для UX
 LIMIT_EXCEEDED_MESSAGE = (
     "Ой, кажется, мне пора бежать💔\n\n"
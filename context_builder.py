@@ -0,0 +1,91 @@
+# context_builder.py - Сборка истории диалога под бюджет токенов
+import math
+from collections import deque
+
+from config import PROMPT_TOKENIZER_PATH
+from log_service import get_logger
+
+log = get_logger(__name__)
+
+# Служебные токены на каждое сообщение (роль, разделители шаблона чата)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_tokenizer = None
+if PROMPT_TOKENIZER_PATH:
+    try:
+        from tokenizers import Tokenizer
+        _tokenizer = Tokenizer.from_file(PROMPT_TOKENIZER_PATH)
+    except Exception as e:
+        log.warning("Не удалось загрузить токенайзер, токены оцениваются по длине текста",
+                    path=PROMPT_TOKENIZER_PATH, error=repr(e))
+
+
+def estimate_tokens(text):
+    """
+    Число токенов в тексте. Без токенайзера - оценка сверху: ~4 байта UTF-8 на токен
+    (латиница ~4 символа на токен, кириллица ~2).
+    """
+    if _tokenizer is not None:
+        return len(_tokenizer.encode(text, add_special_tokens=False).ids)
+    return math.ceil(len(text.encode('utf-8')) / 4)
+
+
+def message_tokens(message):
+    return estimate_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+
+def build_context(system_prompt, history, user_message, budget, session_context=None):
+    """
+    Собирает сообщения для chat completions: системный промпт, история,
+    session_context (второе системное сообщение, если задан) и текущее сообщение.
+    История берется от новых реплик к старым, пока весь промпт помещается в budget токенов;
+    остальные части включаются всегда.
+    Возвращает (messages, prompt_tokens, dropped) - dropped реплик истории не поместилось.
+    """
+    system = {"role": "system", "content": system_prompt}
+    current = {"role": "user", "content": user_message}
+    tail = [current]
+    if session_context:
+        tail.insert(0, {"role": "system", "content": session_context})
+    used = message_tokens(system) + sum(message_tokens(message) for message in tail)
+
+    selected = []
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if used + cost > budget:
+            break
+        selected.append(message)
+        used += cost
+    selected.reverse()
+
+    return [system, *selected, *tail], used, len(history) - len(selected)
+
+
+class PromptSizeStats:
+    """Размеры промптов последних запросов (в токенах) для мониторинга."""
+
+    def __init__(self, samples=1000):
+        self._sizes = deque(maxlen=samples)
+        self.requests = 0
+        self.truncated = 0
+        self.max_tokens = 0
+
+    def record(self, prompt_tokens, dropped):
+        self._sizes.append(prompt_tokens)
+        self.requests += 1
+        if dropped:
+            self.truncated += 1
+        self.max_tokens = max(self.max_tokens, prompt_tokens)
+
+    def stats(self):
+        ordered = sorted(self._sizes)
+        return {
+            'requests': self.requests,
+            'truncated': self.truncated,
+            'avg_tokens': round(sum(ordered) / len(ordered), 1) if ordered else 0.0,
+            'p95_tokens': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0,
+            'max_tokens': self.max_tokens,
+        }
+
+
+prompt_size_stats = PromptSizeStats()
@@ -0,0 +1,166 @@
+# crypto_service.py - Шифрование данных пользователей с версиями ключей
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet, MultiFernet
+
+import metrics
+from log_service import get_logger
+from config import (
+    ENCRYPTION_KEY,
+    ENCRYPTION_KEYS,
+    ENCRYPTION_KEY_VERSION,
+    CRYPTO_THREADS,
+    CRYPTO_OFFLOAD_MIN_BATCH,
+    LOG_SAMPLE_RATE
+)
+
+log = get_logger(__name__)
+
+# Зашифрованное значение: "k<версия>:<Fernet token>". Старые данные без префикса
+# расшифровываются перебором всех ключей (MultiFernet)
+_VERSION_PREFIX = re.compile(r'^k(\d+):')
+
+
+def parse_keys(keys_spec, legacy_key=None):
+    """Разбирает "2:<key2>,1:<key1>" в {версия: ключ}. legacy_key становится версией 1."""
+    keys = {}
+    for item in keys_spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        version, _, key = item.partition(':')
+        keys[int(version)] = key.strip()
+    if legacy_key and 1 not in keys:
+        keys[1] = legacy_key
+    return keys
+
+
+class CryptoService:
+    """
+    Fernet-шифрование с несколькими версиями ключей.
+    Новые значения шифруются текущей версией и помечаются ее номером, так что
+    при расшифровке ключ выбирается сразу; старые ключи остаются для чтения,
+    пока reencrypt-задача не перепишет данные (см. async_db_manager.reencrypt_messages).
+    Пачки значений обрабатываются в пуле потоков, чтобы не занимать event loop.
+    """
+
+    def __init__(self, keys, current_version=0, threads=4, offload_min_batch=16):
+        self._fernets = {}
+        for version, key in keys.items():
+            try:
+                self._fernets[version] = Fernet(key)
+            except Exception as e:
+                log.error("Failed to initialize Fernet cipher", key_version=version, error=repr(e))
+
+        self.current_version = current_version or max(self._fernets, default=0)
+        self._current = self._fernets.get(self.current_version)
+        if self._fernets and self._current is None:
+            log.error("Current encryption key version is not configured", key_version=self.current_version)
+
+        # Для данных без префикса версии: текущий ключ пробуется первым
+        ordered = sorted(self._fernets.items(), key=lambda item: item[0] != self.current_version)
+        self._legacy = MultiFernet([fernet for _, fernet in ordered]) if ordered else None
+
+        self.offload_min_batch = offload_min_batch
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='crypto')
+
+        self.decrypt_failures = 0
+
+    @property
+    def active(self):
+        return self._current is not None
+
+    def encrypt(self, data: str) -> str:
+        """Шифрует строку текущим ключом."""
+        if not self.active:
+            # Если шифрование не активно, просто сохраняем данные как есть (для отладки)
+            return data
+        token = self._current.encrypt(data.encode('utf-8')).decode('utf-8')
+        return f"k{self.current_version}:{token}"
+
+    def _decrypt(self, encrypted_data: str) -> str:
+        """Расшифровывает ключом нужной версии; KeyError/InvalidToken, если это невозможно."""
+        match = _VERSION_PREFIX.match(encrypted_data)
+        if match:
+            fernet = self._fernets[int(match.group(1))]
+            token = encrypted_data[match.end():]
+        else:
+            fernet = self._legacy
+            token = encrypted_data
+        return fernet.decrypt(token.encode('utf-8')).decode('utf-8')
+
+    def _decrypt_failed(self, encrypted_data, error):
+        # Если ключ удален из конфига или данные повреждены. При пачке битых строк
+        # ошибок много, общее число - в метрике bot_decrypt_failures_total
+        self.decrypt_failures += 1
+        log.error("Decryption failed", sample=LOG_SAMPLE_RATE, error=repr(error), data=encrypted_data)
+
+    def decrypt(self, encrypted_data: str) -> str:
+        """Расшифровывает строку ключом нужной версии."""
+        if not self.active:
+            return encrypted_data
+
+        try:
+            return self._decrypt(encrypted_data)
+        except Exception as e:
+            self._decrypt_failed(encrypted_data, e)
+            return f"[DECRYPTION FAILED: {encrypted_data[:10]}...]"
+
+    def rotate(self, encrypted_data: str):
+        """Перешифровывает значение текущим ключом. None - если расшифровать не удалось."""
+        if not self.active:
+            return encrypted_data
+        # Ошибка определяется по этому вызову: rotate_many работает в нескольких потоках,
+        # и общий счетчик decrypt_failures мог вырасти из-за другого значения
+        try:
+            plain = self._decrypt(encrypted_data)
+        except Exception as e:
+            self._decrypt_failed(encrypted_data, e)
+            return None
+        return self.encrypt(plain)
+
+    async def _map(self, func, values):
+        values = list(values)
+        if len(values) < self.offload_min_batch:
+            # На маленьких пачках передача в поток дороже самой расшифровки
+            return [func(value) for value in values]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: [func(value) for value in values])
+
+    async def encrypt_many(self, values):
+        return await self._map(self.encrypt, values)
+
+    async def decrypt_many(self, values):
+        return await self._map(self.decrypt, values)
+
+    async def rotate_many(self, values):
+        return await self._map(self.rotate, values)
+
+    def stats(self):
+        return {
+            'key_versions': sorted(self._fernets),
+            'current_version': self.current_version,
+            'decrypt_failures': self.decrypt_failures,
+        }
+
+
+crypto = CryptoService(
+    parse_keys(ENCRYPTION_KEYS, ENCRYPTION_KEY),
+    ENCRYPTION_KEY_VERSION,
+    threads=CRYPTO_THREADS,
+    offload_min_batch=CRYPTO_OFFLOAD_MIN_BATCH,
+)
+
+# Рост счетчика - повод проверить ENCRYPTION_KEYS: возможно, удален ключ, которым еще зашифрованы данные
+metrics.counter(
+    'bot_decrypt_failures_total', 'Values that could not be decrypted with any configured key',
+    function=lambda: crypto.decrypt_failures
+)
+
+if crypto.active:
+    log.info("Encryption active", key_version=crypto.current_version)
+
+encrypt_data = crypto.encrypt
+decrypt_data = crypto.decrypt
@@ -0,0 +1,433 @@
+# llm_gateway.py - Несколько OpenAI-совместимых провайдеров: ретраи, circuit breaker, выбор по задержке
+import asyncio
+import math
+import time
+from collections import deque
+
+import backoff
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
+
+import metrics
+from log_service import get_logger
+
+log = get_logger(__name__)
+
+# outcome: ok / timeout / error / rejected (ошибка запроса, ретраить бессмысленно)
+LLM_BACKEND_REQUESTS = metrics.counter(
+    'bot_llm_backend_requests_total', 'LLM attempts by backend and outcome', labels=('backend', 'outcome')
+)
+LLM_RETRIES = metrics.counter('bot_llm_retries_total', 'LLM attempts after the first one within a request')
+LLM_UNAVAILABLE = metrics.counter(
+    'bot_llm_unavailable_total', 'Requests rejected at once because every backend circuit was open'
+)
+# outcome: primary (первый запрос успел раньше), hedge (выиграл дублирующий), failed (оба с ошибкой),
+# budget (пора было дублировать, но бюджет исчерпан)
+LLM_HEDGES = metrics.counter(
+    'bot_llm_hedges_total', 'Hedged LLM requests by kind and outcome', labels=('kind', 'outcome')
+)
+
+# Коды, при которых пробуем еще раз или другого провайдера (плюс все 5xx и ошибки соединения).
+# Остальные 4xx - ошибка самого запроса или ключа: повтор ее не исправит
+RETRYABLE_STATUSES = {408, 429}
+
+
+class LLMUnavailableError(Exception):
+    """Все провайдеры отключены circuit breaker'ом: запрос отклонен без ожидания."""
+
+
+class EmptyStreamError(Exception):
+    """Провайдер закрыл поток, не прислав ни одного фрагмента."""
+
+
+def is_retryable(error):
+    if isinstance(error, (asyncio.TimeoutError, APIConnectionError, EmptyStreamError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code >= 500 or error.status_code in RETRYABLE_STATUSES
+    return False
+
+
+class CircuitBreaker:
+    """
+    После failure_threshold ошибок подряд провайдер отключается на reset_timeout секунд (open),
+    затем пропускается один пробный запрос (half-open): успех включает провайдера, ошибка - снова open.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def available(self):
+        """Можно ли сейчас отправить запрос (без учета уже идущей пробы)."""
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        return True
+
+    def allow(self):
+        """Как available, но занимает пробный запрос в состоянии half-open."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Попытка завершилась без вердикта о здоровье провайдера (отмена, ошибка запроса)."""
+        self._probe_in_flight = False
+
+
+class LLMBackend:
+    """Один провайдер: клиент, модель, circuit breaker и скользящая оценка задержки."""
+
+    def __init__(self, name, base_url, api_key, model, breaker, latency_alpha=0.2):
+        self.name = name
+        self.model = model
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.breaker = breaker
+        self.latency_alpha = latency_alpha
+        # kind ('complete' - весь ответ, 'stream' - до первого фрагмента) -> EWMA задержки, сек
+        self.latency = {}
+
+    def record_latency(self, kind, seconds):
+        previous = self.latency.get(kind)
+        self.latency[kind] = seconds if previous is None else previous + self.latency_alpha * (seconds - previous)
+
+
+class GatewayStream:
+    """Поток фрагментов с выбранного провайдера; первый фрагмент уже получен при переключении."""
+
+    def __init__(self, gateway, backend, stream, chunks, first):
+        self.backend = backend
+        self._gateway = gateway
+        self._stream = stream
+        self._chunks = chunks
+        self._first = first
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is not None:
+            chunk, self._first = self._first, None
+            return chunk
+        try:
+            return await self._chunks.__anext__()
+        except (StopAsyncIteration, asyncio.CancelledError, asyncio.TimeoutError):
+            raise
+        except Exception as e:
+            # Обрыв посреди ответа: на другого провайдера уже не переключиться
+            self._gateway._record_failure(self.backend, e)
+            raise
+
+    async def close(self):
+        await self._stream.close()
+
+
+class HedgePolicy:
+    """
+    Когда дублировать запрос и сколько дублей можно себе позволить.
+    Задержка - percentile последних window задержек этого вида запроса (не меньше min_delay);
+    пока замеров меньше min_samples, запросы не дублируются.
+    Бюджет - token bucket: каждый запрос добавляет budget_ratio дубля (не больше burst),
+    поэтому дублей в среднем не больше budget_ratio от всех запросов.
+    """
+
+    def __init__(self, percentile=0.95, min_delay=1.0, budget_ratio=0.05, burst=10.0,
+                 window=500, min_samples=50, recompute_every=20):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.budget_ratio = budget_ratio
+        self.burst = burst
+        self.min_samples = min_samples
+        self._window = window
+        self.recompute_every = recompute_every
+        self.tokens = burst
+        self._latencies = {}
+        self._delays = {}
+        self._since_recompute = {}
+
+    def record(self, kind, seconds):
+        latencies = self._latencies.get(kind)
+        if latencies is None:
+            latencies = self._latencies[kind] = deque(maxlen=self._window)
+        latencies.append(seconds)
+        # Перцентиль пересчитывается не на каждый запрос: сортировка окна стоит дороже самого замера
+        self._since_recompute[kind] = self._since_recompute.get(kind, 0) + 1
+        if len(latencies) >= self.min_samples and (
+                kind not in self._delays or self._since_recompute[kind] >= self.recompute_every):
+            ordered = sorted(latencies)
+            value = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+            self._delays[kind] = max(self.min_delay, value)
+            self._since_recompute[kind] = 0
+
+    def delay(self, kind):
+        """Через сколько секунд дублировать запрос; None - не дублировать."""
+        return self._delays.get(kind)
+
+    def on_request(self):
+        self.tokens = min(self.burst, self.tokens + self.budget_ratio)
+
+    def try_spend(self):
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+    def stats(self):
+        return {
+            'delays': {kind: round(value, 3) for kind, value in self._delays.items()},
+            'samples': {kind: len(values) for kind, values in self._latencies.items()},
+            'budget_tokens': round(self.tokens, 2),
+        }
+
+
+class LLMGateway:
+    """
+    Упорядоченный список провайдеров. Запрос идет к самому быстрому из доступных
+    (по EWMA задержки; еще не измеренные пробуются в порядке списка), при ошибке - к следующему.
+    Всего не больше max_attempts попыток; перед повтором на уже опробованном провайдере -
+    пауза с полным джиттером. Если у всех провайдеров circuit open, запрос сразу отклоняется.
+    С hedge_policy медленный запрос дублируется (см. HedgePolicy), побеждает первый ответ.
+    """
+
+    def __init__(self, backends, max_attempts=3, attempt_timeout=30.0, base_delay=0.25, max_delay=2.0,
+                 hedge_policy=None):
+        if not backends:
+            raise ValueError("LLMGateway needs at least one backend")
+        self.backends = list(backends)
+        self.max_attempts = max_attempts
+        self.attempt_timeout = attempt_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_policy = hedge_policy
+
+    def route(self, kind):
+        """Доступные провайдеры в порядке предпочтения."""
+        available = [backend for backend in self.backends if backend.breaker.available()]
+        # Провайдер без замеров идет после измеренных, а не считается самым быстрым.
+        # sorted стабилен: при равной оценке сохраняется порядок из конфигурации
+        return sorted(available, key=lambda backend: backend.latency.get(kind, math.inf))
+
+    def _record_failure(self, backend, error):
+        outcome = 'timeout' if isinstance(error, asyncio.TimeoutError) else 'error'
+        LLM_BACKEND_REQUESTS.inc(backend=backend.name, outcome=outcome)
+        was_open = backend.breaker.state == CircuitBreaker.OPEN
+        backend.breaker.record_failure()
+        log.warning("LLM backend attempt failed", backend=backend.name, outcome=outcome, error=repr(error))
+        if not was_open and backend.breaker.state == CircuitBreaker.OPEN:
+            log.error("LLM backend circuit opened", backend=backend.name,
+                      failures=backend.breaker.failures, reset_timeout=backend.breaker.reset_timeout)
+
+    async def _attempts(self, kind, timeout, offset=0):
+        """
+        Выдает (провайдер, таймаут попытки) с паузами между повторами.
+        offset - первая попытка идет к offset-му провайдеру по предпочтению (для дубля).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        tried = set()
+        attempt = 0
+        while attempt < self.max_attempts:
+            candidates = [backend for backend in self.route(kind) if backend.breaker.allow()]
+            if not candidates:
+                if attempt == 0:
+                    LLM_UNAVAILABLE.inc()
+                    raise LLMUnavailableError("all LLM backends are unavailable (circuit open)")
+                return
+            fresh = [backend for backend in candidates if backend.name not in tried]
+            choice = fresh or candidates
+            backend = choice[0] if attempt else choice[min(offset, len(choice) - 1)]
+            # Пробный запрос half-open занят только у выбранного провайдера
+            for other in candidates:
+                if other is not backend:
+                    other.breaker.release()
+
+            if attempt:
+                LLM_RETRIES.inc()
+                if not fresh:
+                    delay = backoff.full_jitter(min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                    await asyncio.sleep(min(delay, max(0.0, deadline - loop.time())))
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                backend.breaker.release()
+                raise asyncio.TimeoutError()
+            tried.add(backend.name)
+            attempt += 1
+            yield backend, min(self.attempt_timeout, remaining)
+
+    async def _hedged(self, kind, timeout, start):
+        """
+        Запускает start(timeout, offset) и, если ответа нет дольше задержки политики,
+        дубль к следующему по предпочтению провайдеру. Проигравший отменяется.
+        """
+        policy = self.hedge_policy
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        policy.on_request()
+        delay = policy.delay(kind)
+
+        primary = asyncio.ensure_future(start(timeout, 0))
+        tasks = [primary]
+        winner = None
+        try:
+            if delay is not None and delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    if policy.try_spend():
+                        tasks.append(asyncio.ensure_future(start(timeout - (loop.time() - started), 1)))
+                    else:
+                        LLM_HEDGES.inc(kind=kind, outcome='budget')
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and not task.cancelled() and task.exception() is None:
+                        winner = task
+                        break
+                if winner is not None:
+                    break
+
+            if len(tasks) > 1:
+                outcome = 'failed' if winner is None else ('primary' if winner is primary else 'hedge')
+                LLM_HEDGES.inc(kind=kind, outcome=outcome)
+            if winner is None:
+                # Ошибка первого запроса информативнее: дубль мог упасть из-за его отмены по таймауту
+                return primary.result()
+            # Замер - задержка, которую увидел пользователь (с учетом выигравшего дубля)
+            policy.record(kind, loop.time() - started)
+            return winner.result()
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    task.cancel()
+            losers = [task for task in tasks if task is not winner]
+            for result in await asyncio.gather(*losers, return_exceptions=True):
+                # Поток, открывшийся одновременно с победителем, тоже нужно закрыть
+                if isinstance(result, GatewayStream):
+                    await result.close()
+
+    async def complete(self, timeout, kind='complete', hedge=True, **kwargs):
+        """
+        chat.completions.create с переключением провайдеров. kwargs - все, кроме model.
+        hedge=False - не дублировать запрос, даже если задана hedge_policy.
+        """
+        if self.hedge_policy is None or not hedge:
+            return await self._complete(timeout, kind, 0, **kwargs)
+        return await self._hedged(kind, timeout, lambda left, offset: self._complete(left, kind, offset, **kwargs))
+
+    async def _complete(self, timeout, kind, offset, **kwargs):
+        last_error = None
+        async for backend, attempt_timeout in self._attempts(kind, timeout, offset):
+            started = time.perf_counter()
+            try:
+                completion = await asyncio.wait_for(
+                    backend.client.chat.completions.create(model=backend.model, **kwargs),
+                    timeout=attempt_timeout
+                )
+            except asyncio.CancelledError:
+                backend.breaker.release()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    LLM_BACKEND_REQUESTS.inc(backend=backend.name, outcome='rejected')
+                    backend.breaker.release()
+                    raise
+                if isinstance(e, asyncio.TimeoutError):
+                    # Зависший провайдер опускается в очереди так же, как медленный
+                    backend.record_latency(kind, attempt_timeout)
+                self._record_failure(backend, e)
+                last_error = e
+                continue
+
+            backend.record_latency(kind, time.perf_counter() - started)
+            backend.breaker.record_success()
+            LLM_BACKEND_REQUESTS.inc(backend=backend.name, outcome='ok')
+            return completion
+        raise last_error
+
+    async def open_stream(self, timeout, hedge=True, **kwargs):
+        """
+        Открывает поток (stream=True) и ждет первый фрагмент. Переключение на другого провайдера
+        (и дубль запроса) возможно, только пока пользователю ничего не показано. Возвращает GatewayStream.
+        """
+        if self.hedge_policy is None or not hedge:
+            return await self._open_stream(timeout, 0, **kwargs)
+        return await self._hedged('stream', timeout, lambda left, offset: self._open_stream(left, offset, **kwargs))
+
+    async def _open_stream(self, timeout, offset, **kwargs):
+        last_error = None
+        async for backend, attempt_timeout in self._attempts('stream', timeout, offset):
+            started = time.perf_counter()
+            stream = None
+            try:
+                stream = await asyncio.wait_for(
+                    backend.client.chat.completions.create(model=backend.model, stream=True, **kwargs),
+                    timeout=attempt_timeout
+                )
+                chunks = stream.__aiter__()
+                first = await asyncio.wait_for(
+                    chunks.__anext__(), timeout=max(0.0, attempt_timeout - (time.perf_counter() - started))
+                )
+            except asyncio.CancelledError:
+                backend.breaker.release()
+                if stream is not None:
+                    await stream.close()
+                raise
+            except Exception as e:
+                if stream is not None:
+                    await stream.close()
+                if isinstance(e, StopAsyncIteration):
+                    e = EmptyStreamError(backend.name)
+                if not is_retryable(e):
+                    LLM_BACKEND_REQUESTS.inc(backend=backend.name, outcome='rejected')
+                    backend.breaker.release()
+                    raise
+                if isinstance(e, asyncio.TimeoutError):
+                    backend.record_latency('stream', attempt_timeout)
+                self._record_failure(backend, e)
+                last_error = e
+                continue
+
+            backend.record_latency('stream', time.perf_counter() - started)
+            backend.breaker.record_success()
+            LLM_BACKEND_REQUESTS.inc(backend=backend.name, outcome='ok')
+            return GatewayStream(self, backend, stream, chunks, first)
+        raise last_error
+
+    def stats(self):
+        return {
+            backend.name: {
+                'model': backend.model,
+                'circuit': backend.breaker.state,
+                'failures': backend.breaker.failures,
+                'latency': {kind: round(value, 3) for kind, value in backend.latency.items()},
+            }
+            for backend in self.backends
+        }
@@ -0,0 +1,159 @@
+# llm_scheduler.py - Очередь запросов к модели с приоритетами
+import asyncio
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+
+# Классы приоритета
+PRIORITY_SUBSCRIBER = 'subscriber'
+PRIORITY_PURCHASED = 'purchased'
+PRIORITY_FREE = 'free'
+
+
+class LLMScheduler:
+    """
+    Ограничивает число одновременных запросов к провайдеру и решает,
+    кто получит освободившийся слот.
+
+    - Классы приоритета обслуживаются взвешенным round-robin (smooth WRR):
+      при весах 6/3/1 из 10 слотов подписчики получат 6, но и бесплатные
+      пользователи не голодают.
+    - Внутри класса пользователи обслуживаются по кругу, и у одного
+      пользователя не может быть больше per_user_limit запросов в работе.
+    - Для каждого класса копится статистика ожидания в очереди.
+    """
+
+    def __init__(self, max_in_flight, weights, per_user_limit=1, wait_samples=1000):
+        self.max_in_flight = max_in_flight
+        self.weights = dict(weights)
+        self.per_user_limit = per_user_limit
+
+        # класс -> OrderedDict(user_id -> deque[(future, enqueued_at)])
+        self._queues = {cls: OrderedDict() for cls in self.weights}
+        self._current_weight = {cls: 0 for cls in self.weights}
+        self._in_flight = 0
+        self._user_in_flight = defaultdict(int)
+
+        self._waits = {cls: deque(maxlen=wait_samples) for cls in self.weights}
+        self._granted = {cls: 0 for cls in self.weights}
+        self._max_wait = {cls: 0.0 for cls in self.weights}
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @asynccontextmanager
+    async def slot(self, user_id, priority, timeout=None):
+        """Занимает слот на время блока with. timeout ограничивает ожидание в очереди."""
+        await self.acquire(user_id, priority, timeout)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    async def acquire(self, user_id, priority, timeout=None):
+        if priority not in self._queues:
+            priority = min(self.weights, key=self.weights.get)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queues[priority].setdefault(user_id, deque()).append((future, loop.time()))
+        self._dispatch()
+
+        try:
+            if timeout is None:
+                await future
+            else:
+                await asyncio.wait_for(future, timeout)
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # Слот успели выдать одновременно с отменой - возвращаем его
+                self.release(user_id)
+            else:
+                future.cancel()
+                self._remove_waiter(priority, user_id, future)
+            raise
+
+    def release(self, user_id):
+        self._in_flight -= 1
+        self._user_in_flight[user_id] -= 1
+        if self._user_in_flight[user_id] <= 0:
+            del self._user_in_flight[user_id]
+        self._dispatch()
+
+    def _remove_waiter(self, priority, user_id, future):
+        waiters = self._queues[priority].get(user_id)
+        if not waiters:
+            return
+        for item in waiters:
+            if item[0] is future:
+                waiters.remove(item)
+                break
+        if not waiters:
+            del self._queues[priority][user_id]
+
+    def _eligible_user(self, priority):
+        """Первый по кругу пользователь класса, у которого есть ожидающие и не исчерпан личный лимит."""
+        for user_id, waiters in self._queues[priority].items():
+            if waiters and self._user_in_flight.get(user_id, 0) < self.per_user_limit:
+                return user_id
+        return None
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+
+        while self._in_flight < self.max_in_flight:
+            candidates = {}
+            for cls in self._queues:
+                user_id = self._eligible_user(cls)
+                if user_id is not None:
+                    candidates[cls] = user_id
+            if not candidates:
+                return
+
+            # Smooth weighted round-robin среди классов, где есть кого обслужить
+            total = 0
+            for cls in candidates:
+                self._current_weight[cls] += self.weights[cls]
+                total += self.weights[cls]
+            chosen = max(candidates, key=lambda c: self._current_weight[c])
+            self._current_weight[chosen] -= total
+
+            user_id = candidates[chosen]
+            queue = self._queues[chosen]
+            future, enqueued_at = queue[user_id].popleft()
+            # Пользователь уходит в конец круга своего класса
+            if queue[user_id]:
+                queue.move_to_end(user_id)
+            else:
+                del queue[user_id]
+
+            if future.done():
+                continue
+
+            self._in_flight += 1
+            self._user_in_flight[user_id] += 1
+
+            waited = loop.time() - enqueued_at
+            self._waits[chosen].append(waited)
+            self._granted[chosen] += 1
+            self._max_wait[chosen] = max(self._max_wait[chosen], waited)
+
+            future.set_result(None)
+
+    def stats(self):
+        """Ожидание в очереди по классам (сек) и текущая загрузка."""
+        classes = {}
+        for cls, waits in self._waits.items():
+            ordered = sorted(waits)
+            classes[cls] = {
+                'waiting': sum(len(w) for w in self._queues[cls].values()),
+                'granted': self._granted[cls],
+                'avg_wait': round(sum(ordered) / len(ordered), 4) if ordered else 0.0,
+                'p95_wait': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4) if ordered else 0.0,
+                'max_wait': round(self._max_wait[cls], 4),
+            }
+        return {
+            'in_flight': self._in_flight,
+            'max_in_flight': self.max_in_flight,
+            'classes': classes,
+        }
@@ -0,0 +1 @@
+# loadtest - Нагрузочный тест бота: фейковый Telegram, заглушка модели, счетчик запросов к БД
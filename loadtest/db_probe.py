@@ -0,0 +1,112 @@
+# loadtest/db_probe.py - Подсчет обращений к PostgreSQL на один апдейт
+import contextvars
+import time
+from collections import defaultdict
+
+# Апдейт, в контексте которого выполняется запрос (задачи наследуют значение от создателя)
+current_update = contextvars.ContextVar('current_update', default=None)
+
+_QUERY_METHODS = ('execute', 'executemany', 'fetch', 'fetchrow', 'fetchval', 'copy_records_to_table')
+
+
+class RoundTripCounter:
+    """Счетчик запросов к БД по апдейтам; запросы вне апдейта (фоновые задачи) идут в background."""
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.per_update = defaultdict(int)
+        self.background = 0
+        self.total = 0
+
+    def count(self, method, elapsed):
+        self.total += 1
+        self.recorder.record(f"db.{method}", elapsed)
+        update_id = current_update.get()
+        if update_id is None:
+            self.background += 1
+        else:
+            self.per_update[update_id] += 1
+
+
+class _Timed:
+    """Обертка метода запроса: считает вызов и его длительность."""
+
+    def __init__(self, counter, method, func):
+        self._counter = counter
+        self._method = method
+        self._func = func
+
+    async def __call__(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self._func(*args, **kwargs)
+        finally:
+            self._counter.count(self._method, time.perf_counter() - started)
+
+
+class _TransactionProxy:
+    """BEGIN и COMMIT/ROLLBACK - еще два обращения к серверу."""
+
+    def __init__(self, counter, transaction):
+        self._counter = counter
+        self._transaction = transaction
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        result = await self._transaction.__aenter__()
+        self._counter.count('begin', time.perf_counter() - started)
+        return result
+
+    async def __aexit__(self, *exc_info):
+        started = time.perf_counter()
+        try:
+            return await self._transaction.__aexit__(*exc_info)
+        finally:
+            self._counter.count('commit', time.perf_counter() - started)
+
+
+class _ConnectionProxy:
+    def __init__(self, counter, connection):
+        self._counter = counter
+        self._connection = connection
+
+    def transaction(self, *args, **kwargs):
+        return _TransactionProxy(self._counter, self._connection.transaction(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self._connection, name)
+        if name in _QUERY_METHODS:
+            return _Timed(self._counter, name, attr)
+        return attr
+
+
+class _AcquireProxy:
+    def __init__(self, counter, acquire):
+        self._counter = counter
+        self._acquire = acquire
+
+    async def __aenter__(self):
+        return _ConnectionProxy(self._counter, await self._acquire.__aenter__())
+
+    async def __aexit__(self, *exc_info):
+        return await self._acquire.__aexit__(*exc_info)
+
+
+class CountingPool:
+    """
+    Прокси asyncpg.Pool: все запросы через pool.* и pool.acquire() считаются и
+    приписываются текущему апдейту. Подменяет async_db_manager._pool после init_db.
+    """
+
+    def __init__(self, pool, counter):
+        self._pool = pool
+        self._counter = counter
+
+    def acquire(self, *args, **kwargs):
+        return _AcquireProxy(self._counter, self._pool.acquire(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self._pool, name)
+        if name in _QUERY_METHODS:
+            return _Timed(self._counter, name, attr)
+        return attr
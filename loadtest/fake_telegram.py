@@ -0,0 +1,150 @@
+# loadtest/fake_telegram.py - Фейковый Bot API и синтетические апдейты
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "Алина", "username": "aigirl_loadtest_bot"}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Транспорт Bot API без сети: отвечает на вызовы бота правдоподобными объектами
+    после задержки api_latency (имитация RTT до api.telegram.org).
+    Все вызовы считаются по методам, их длительность пишется в recorder (этап telegram.<метод>).
+    on_send(chat_id, method, parameters) вызывается для sendMessage/sendInvoice/editMessageText.
+    """
+
+    def __init__(self, recorder, api_latency=0.05, channel_status="member", on_send=None):
+        self.recorder = recorder
+        self.api_latency = api_latency
+        self.channel_status = channel_status
+        self.on_send = on_send
+        self.calls = defaultdict(int)
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        self.calls[api_method] += 1
+
+        started = time.perf_counter()
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        result = self._result(api_method, parameters)
+        self.recorder.record(f"telegram.{api_method}", time.perf_counter() - started)
+
+        if self.on_send is not None and api_method in ('sendMessage', 'sendInvoice', 'editMessageText'):
+            self.on_send(parameters.get('chat_id'), api_method, parameters)
+
+        return 200, json.dumps({"ok": True, "result": result}).encode('utf-8')
+
+    def _message(self, parameters):
+        chat_id = int(parameters.get('chat_id') or 0)
+        message = {
+            "message_id": int(parameters.get('message_id') or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if 'text' in parameters:
+            message["text"] = parameters['text']
+        return message
+
+    def _result(self, api_method, parameters):
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method == 'getChatMember':
+            return {
+                "status": self.channel_status,
+                "user": {"id": int(parameters['user_id']), "is_bot": False, "first_name": "User"},
+            }
+        if api_method in ('sendMessage', 'editMessageText', 'sendInvoice'):
+            return self._message(parameters)
+        # sendChatAction, answerCallbackQuery, answerPreCheckoutQuery, setMyCommands и т.п.
+        return True
+
+
+class UpdateFactory:
+    """Словари апдейтов в формате Bot API для Update.de_json."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+        self._query_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+
+    def _message(self, user_id, **fields):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **fields,
+        }
+
+    def text(self, user_id, text):
+        return {"update_id": next(self._update_ids), "message": self._message(user_id, text=text)}
+
+    def command(self, user_id, command):
+        text = f"/{command}"
+        return {
+            "update_id": next(self._update_ids),
+            "message": self._message(
+                user_id, text=text,
+                entities=[{"type": "bot_command", "offset": 0, "length": len(text)}]
+            ),
+        }
+
+    def callback(self, user_id, data):
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._query_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {**self._message(user_id, text="menu"), "from": BOT_USER},
+            },
+        }
+
+    def pre_checkout(self, user_id, payload, amount):
+        return {
+            "update_id": next(self._update_ids),
+            "pre_checkout_query": {
+                "id": str(next(self._query_ids)),
+                "from": self._user(user_id),
+                "currency": "XTR",
+                "total_amount": amount,
+                "invoice_payload": payload,
+            },
+        }
+
+    def successful_payment(self, user_id, payload, amount):
+        return {
+            "update_id": next(self._update_ids),
+            "message": self._message(user_id, successful_payment={
+                "currency": "XTR",
+                "total_amount": amount,
+                "invoice_payload": payload,
+                "telegram_payment_charge_id": f"tg-{user_id}-{time.time_ns()}",
+                "provider_payment_charge_id": f"pr-{user_id}-{time.time_ns()}",
+            }),
+        }
@@ -0,0 +1,202 @@
+# loadtest/llm_stub.py - Локальная OpenAI-совместимая заглушка модели
+# Отдельный запуск: python -m loadtest.llm_stub --port 8089 --latency 0.8 --tokens-per-sec 40
+import argparse
+import asyncio
+import json
+import random
+import time
+
+_WORDS = ["ахах", "мм", "поняла", "а", "ты", "как", "сегодня", "день", "прошел", "расскажи", "мне", "смешно)"]
+
+
+class LLMStubServer:
+    """
+    Минимальный HTTP/1.1 сервер на asyncio streams, отвечающий на POST .../chat/completions
+    в формате OpenAI (обычный ответ и stream=True через SSE). Задержка до первого токена -
+    latency ± jitter секунд, дальше reply_tokens токенов со скоростью tokens_per_sec.
+    Соединения keep-alive, как у httpx-клиента openai.
+    Если задан recorder, длительность каждого ответа пишется в этап llm.completion.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8089, latency=0.8, jitter=0.3,
+                 tokens_per_sec=40.0, reply_tokens=30, error_rate=0.0, recorder=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.recorder = recorder
+        self._server = None
+
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                path, body = request
+                await self._handle_request(path, body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        if not head:
+            return None
+        lines = head.decode('latin-1').split("\r\n")
+        _, path, _ = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', '0'))
+        body = await reader.readexactly(length) if length else b""
+        return path, body
+
+    async def _handle_request(self, path, body, writer):
+        if not path.rstrip('/').endswith('/chat/completions'):
+            await self._send_json(writer, 404, {"error": {"message": "not found"}})
+            return
+
+        payload = json.loads(body or b"{}")
+        started = time.perf_counter()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+            if random.random() < self.error_rate:
+                self.errors += 1
+                await self._send_json(writer, 503, {"error": {"message": "stub overloaded"}})
+                return
+
+            tokens = [random.choice(_WORDS) + " " for _ in range(self.reply_tokens)]
+            prompt_tokens = sum(len(m.get('content', '')) for m in payload.get('messages', [])) // 4
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(tokens),
+                "total_tokens": prompt_tokens + len(tokens),
+                "prompt_tokens_details": {"cached_tokens": 0},
+            }
+
+            if payload.get('stream'):
+                await self._stream(writer, payload, tokens, usage)
+            else:
+                await asyncio.sleep(len(tokens) / self.tokens_per_sec)
+                await self._send_json(writer, 200, {
+                    "id": f"stub-{self.requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": payload.get('model', 'stub'),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(tokens).strip()},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+        finally:
+            self.in_flight -= 1
+            if self.recorder is not None:
+                self.recorder.record('llm.completion', time.perf_counter() - started)
+
+    async def _stream(self, writer, payload, tokens, usage):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: keep-alive\r\n\r\n"
+        )
+
+        def chunk(data):
+            event = f"data: {data}\n\n".encode('utf-8')
+            writer.write(f"{len(event):x}\r\n".encode('ascii') + event + b"\r\n")
+
+        base = {"id": f"stub-{self.requests}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": payload.get('model', 'stub')}
+        delay = 1.0 / self.tokens_per_sec
+        for token in tokens:
+            chunk(json.dumps({**base, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}))
+            await writer.drain()
+            await asyncio.sleep(delay)
+
+        chunk(json.dumps({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            chunk(json.dumps({**base, "choices": [], "usage": usage}))
+        chunk("[DONE]")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def _send_json(writer, status, data):
+        body = json.dumps(data).encode('utf-8')
+        reason = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: keep-alive\r\n\r\n".encode('ascii') + body
+        )
+        await writer.drain()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'max_in_flight': self.max_in_flight,
+        }
+
+
+def add_arguments(parser):
+    parser.add_argument('--llm-latency', type=float, default=0.8, help="задержка до первого токена, сек")
+    parser.add_argument('--llm-jitter', type=float, default=0.3, help="разброс задержки, сек")
+    parser.add_argument('--tokens-per-sec', type=float, default=40.0)
+    parser.add_argument('--reply-tokens', type=int, default=30)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help="доля ответов 503")
+
+
+def from_arguments(args, host='127.0.0.1', port=8089, recorder=None):
+    return LLMStubServer(
+        host=host, port=port, recorder=recorder,
+        latency=args.llm_latency, jitter=args.llm_jitter,
+        tokens_per_sec=args.tokens_per_sec, reply_tokens=args.reply_tokens,
+        error_rate=args.llm_error_rate,
+    )
+
+
+async def _serve(args):
+    server = from_arguments(args, port=args.port)
+    await server.start()
+    print(f"🤖 LLM stub listening on {server.base_url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="OpenAI-compatible LLM stub")
+    parser.add_argument('--port', type=int, default=8089)
+    add_arguments(parser)
+    asyncio.run(_serve(parser.parse_args()))
@@ -0,0 +1,61 @@
+# loadtest/report.py - Сбор задержек по этапам и вывод отчета
+from collections import defaultdict
+
+
+def percentile(ordered, q):
+    """q-й перцентиль (0..100) уже отсортированного списка, nearest-rank."""
+    if not ordered:
+        return 0.0
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class LatencyRecorder:
+    """Длительности (сек) по этапам: update.*, reply.*, db.*, telegram.*, llm.*"""
+
+    def __init__(self):
+        self._samples = defaultdict(list)
+
+    def record(self, stage, seconds):
+        self._samples[stage].append(seconds)
+
+    def summary(self):
+        result = {}
+        for stage, samples in sorted(self._samples.items()):
+            ordered = sorted(samples)
+            result[stage] = {
+                'count': len(ordered),
+                'p50_ms': round(percentile(ordered, 50) * 1000, 1),
+                'p95_ms': round(percentile(ordered, 95) * 1000, 1),
+                'p99_ms': round(percentile(ordered, 99) * 1000, 1),
+                'max_ms': round(ordered[-1] * 1000, 1),
+            }
+        return result
+
+
+def print_report(wall_time, processed, recorder, counter, update_kinds, extra):
+    total_updates = sum(processed.values())
+    print("\n================ LOAD TEST REPORT ================")
+    print(f"Wall time: {wall_time:.1f}s, updates: {total_updates}, "
+          f"throughput: {total_updates / wall_time:.1f} updates/s")
+    for kind, count in sorted(processed.items()):
+        print(f"  {kind:<20} {count:>8}  ({count / wall_time:.1f}/s)")
+
+    print("\nLatency by stage:")
+    print(f"  {'stage':<34}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, row in recorder.summary().items():
+        print(f"  {stage:<34}{row['count']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+              f"{row['p99_ms']:>10}{row['max_ms']:>10}")
+
+    print("\nDB round trips:")
+    print(f"  total: {counter.total}, background (write-behind, summaries): {counter.background}")
+    by_kind = defaultdict(list)
+    for update_id, kind in update_kinds.items():
+        by_kind[kind].append(counter.per_update.get(update_id, 0))
+    for kind, trips in sorted(by_kind.items()):
+        print(f"  per {kind:<16} avg {sum(trips) / len(trips):.2f}, max {max(trips)}")
+    if total_updates:
+        print(f"  overall per update (incl. background): {counter.total / total_updates:.2f}")
+
+    for title, value in extra.items():
+        print(f"\n{title}: {value}")
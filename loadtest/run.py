@@ -0,0 +1,207 @@
+# loadtest/run.py - Нагрузочный тест бота: фейковый Telegram, заглушка модели, реальный PostgreSQL
+#
+# Запуск из корня репозитория (БД - отдельная тестовая база, DB_* как в .env, в base64):
+#   DB_SSL_MODE=disable python -m loadtest.run --users 2000 --messages 5 --think-time 3
+#
+# Все обработчики, кэши, планировщик модели и пул БД - настоящие, из bot_runner.
+# Подменяются только транспорт Bot API (loadtest.fake_telegram) и адрес модели (loadtest.llm_stub).
+import argparse
+import asyncio
+import base64
+import os
+import random
+import time
+from collections import defaultdict
+
+from dotenv import load_dotenv
+
+from loadtest import llm_stub
+from loadtest.db_probe import RoundTripCounter, CountingPool, current_update
+from loadtest.fake_telegram import FakeTelegramRequest, UpdateFactory
+from loadtest.report import LatencyRecorder, print_report
+
+_MESSAGES = [
+    "привет", "как дела?", "что делаешь?", "расскажи что-нибудь интересное",
+    "я сегодня устал на работе", "ахах", "а ты любишь музыку?", "спокойной ночи",
+]
+
+
+def _b64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def _prepare_environment(args):
+    """Переменные окружения до импорта config: секреты-заглушки и адрес заглушки модели."""
+    load_dotenv()
+    from cryptography.fernet import Fernet
+
+    os.environ.setdefault('TOKEN_TG', _b64('100000:LOADTEST'))
+    os.environ.setdefault('DEEPSEEK_API_KEY', _b64('loadtest'))
+    os.environ.setdefault('ENCRYPTION_KEY', _b64(Fernet.generate_key().decode('ascii')))
+    os.environ.setdefault('CHANNEL_USERNAME', _b64('@loadtest_channel'))
+    os.environ.setdefault('CHANNEL_ID', _b64('-1001'))
+    # Модель - всегда локальная заглушка, векторная память и перешифровка не нужны
+    os.environ['DEEPSEEK_API_BASE'] = f"http://127.0.0.1:{args.llm_port}/v1"
+    os.environ['VECTOR_MEMORY_ENABLED'] = '0'
+    # Логи бота не должны смешиваться с отчетом: только предупреждения и ошибки
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('LOG_FORMAT', 'text')
+    os.environ['REENCRYPT_ON_START'] = '0'
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.recorder = LatencyRecorder()
+        self.counter = RoundTripCounter(self.recorder)
+        self.factory = UpdateFactory()
+        self.random = random.Random(args.seed)
+
+        self.processed = defaultdict(int)
+        self.update_kinds = {}      # update_id -> вид апдейта (для DB round trips)
+        self._awaiting_reply = {}   # chat_id -> время отправки сообщения
+        self._invoices = {}         # chat_id -> Future с (payload, amount) из sendInvoice
+
+        self.llm = llm_stub.from_arguments(args, port=args.llm_port, recorder=self.recorder)
+        self.telegram = FakeTelegramRequest(
+            self.recorder,
+            api_latency=args.api_latency,
+            channel_status=args.channel_status,
+            on_send=self._on_send,
+        )
+        self.application = None
+
+    def _on_send(self, chat_id, method, parameters):
+        chat_id = int(chat_id)
+        if method == 'sendInvoice':
+            future = self._invoices.pop(chat_id, None)
+            if future is not None and not future.done():
+                prices = parameters.get('prices') or [{}]
+                future.set_result((parameters['payload'], prices[0].get('amount', 0)))
+            return
+        # Первое видимое сообщение ответа (при стриминге дальше идут editMessageText)
+        sent_at = self._awaiting_reply.pop(chat_id, None)
+        if sent_at is not None:
+            self.recorder.record('reply.first_visible', time.perf_counter() - sent_at)
+
+    async def _dispatch(self, kind, data):
+        from telegram import Update
+
+        update = Update.de_json(data, self.application.bot)
+        self.update_kinds[update.update_id] = kind
+        token = current_update.set(update.update_id)
+        started = time.perf_counter()
+        try:
+            await self.application.process_update(update)
+        finally:
+            self.recorder.record(f"update.{kind}", time.perf_counter() - started)
+            current_update.reset(token)
+            self.processed[kind] += 1
+
+    async def _think(self):
+        if self.args.think_time > 0:
+            await asyncio.sleep(self.random.expovariate(1 / self.args.think_time))
+
+    async def _purchase(self, user_id):
+        """Покупка пакета сообщений: кнопка -> инвойс -> pre_checkout -> успешная оплата."""
+        invoice = asyncio.get_running_loop().create_future()
+        self._invoices[user_id] = invoice
+        await self._dispatch('callback', self.factory.callback(user_id, 'buy_msg_package_20'))
+        try:
+            payload, amount = await asyncio.wait_for(invoice, timeout=10)
+        except asyncio.TimeoutError:
+            self._invoices.pop(user_id, None)
+            print(f"⚠️ Invoice was not sent to user {user_id}")
+            return
+        await self._dispatch('pre_checkout', self.factory.pre_checkout(user_id, payload, amount))
+        await self._dispatch('payment', self.factory.successful_payment(user_id, payload, amount))
+
+    async def _simulate_user(self, user_id):
+        args = self.args
+        # Пользователи приходят не одновременно, а в течение ramp-up
+        await asyncio.sleep(self.random.uniform(0, args.ramp_up))
+        await self._dispatch('command', self.factory.command(user_id, 'start'))
+
+        for _ in range(args.messages):
+            await self._think()
+            self._awaiting_reply[user_id] = time.perf_counter()
+            await self._dispatch('message', self.factory.text(user_id, self.random.choice(_MESSAGES)))
+
+            if self.random.random() < args.menu_rate:
+                await self._dispatch('callback', self.factory.callback(user_id, 'show_sub_details'))
+                await self._dispatch('callback', self.factory.callback(user_id, 'back_to_status'))
+
+        if self.random.random() < args.purchase_rate:
+            await self._think()
+            await self._purchase(user_id)
+
+    async def run(self):
+        import ai_service
+        import async_db_manager
+        import bot_runner
+
+        await self.llm.start()
+        self.application = bot_runner.build_application(
+            worker_index=1, with_updater=False, request=self.telegram
+        )
+        application = self.application
+
+        await application.initialize()
+        await application.post_init(application)
+        # Пул создан в post_init, дальше все запросы к БД считаются
+        async_db_manager._pool = CountingPool(async_db_manager._pool, self.counter)
+        await application.start()
+
+        users = [self.args.user_id_base + i for i in range(self.args.users)]
+        print(f"🚀 Load test: {len(users)} users, {self.args.messages} messages each, LLM stub at {self.llm.base_url}")
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(self._simulate_user(user_id) for user_id in users))
+            # Ответы на последние серии сообщений еще в coalescer и фоновых задачах
+            await application.stop()
+            await application.post_stop(application)
+        finally:
+            wall_time = time.perf_counter() - started
+            await application.shutdown()
+            await application.post_shutdown(application)
+            await self.llm.stop()
+
+        print_report(wall_time, self.processed, self.recorder, self.counter, self.update_kinds, {
+            'Telegram API calls': dict(self.telegram.calls),
+            'LLM stub': {'requests': self.llm.requests, 'errors': self.llm.errors,
+                         'max_in_flight': self.llm.max_in_flight},
+            'LLM scheduler': ai_service.llm_scheduler.stats(),
+            'LLM backends': ai_service.get_llm_backend_stats(),
+            'LLM hedging': ai_service.get_llm_hedge_stats(),
+            'Prompt sizes': ai_service.get_prompt_size_stats(),
+            'User state cache': async_db_manager.get_user_state_cache_stats(),
+            'History cache': async_db_manager.get_history_cache_stats(),
+            'Message write buffer': async_db_manager.get_message_buffer_stats(),
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the bot against fake Telegram and an LLM stub")
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=5, help="сообщений от каждого пользователя")
+    parser.add_argument('--think-time', type=float, default=3.0, help="средняя пауза между сообщениями, сек")
+    parser.add_argument('--ramp-up', type=float, default=30.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument('--menu-rate', type=float, default=0.1, help="доля сообщений, после которых открывается меню")
+    parser.add_argument('--purchase-rate', type=float, default=0.05, help="доля пользователей, покупающих пакет")
+    parser.add_argument('--api-latency', type=float, default=0.05, help="задержка фейкового Bot API, сек")
+    parser.add_argument('--channel-status', default='member', help="статус в канале для getChatMember")
+    parser.add_argument('--user-id-base', type=int, default=9_000_000_000,
+                        help="id синтетических пользователей, чтобы не пересекаться с настоящими")
+    parser.add_argument('--llm-port', type=int, default=8089)
+    parser.add_argument('--seed', type=int, default=1)
+    llm_stub.add_arguments(parser)
+    args = parser.parse_args()
+
+    _prepare_environment(args)
+    import log_service
+    log_service.setup_logging()
+    asyncio.run(LoadTest(args).run())
+
+
+if __name__ == '__main__':
+    main()
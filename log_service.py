@@ -0,0 +1,235 @@
+# log_service.py - Структурированные логи (JSON) через очередь, без блокировки event loop
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import traceback
+from datetime import datetime, timezone
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_REDACT_CONTENT
+
+# Привязка записей к апдейту: задается на время обработки (см. bot_runner.CorrelatedUpdateProcessor),
+# задачи, созданные из обработчика, наследуют значения
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+current_user_id = contextvars.ContextVar('current_user_id', default=None)
+
+# Поля, которые никогда не пишутся как есть: тексты пользователей и секреты
+_CONTENT_FIELDS = {'content', 'text', 'user_message', 'summary', 'data'}
+_SECRET_FIELDS = {'payload', 'payment_token', 'token', 'api_key', 'password'}
+
+_SECRET_PATTERNS = [
+    (re.compile(r'(?<!\d)\d{6,12}:[A-Za-z0-9_-]{30,}'), '<bot-token>'),        # токен бота (в т.ч. в URL Bot API)
+    (re.compile(r'\b(?:k\d+:)?gAAAAA[A-Za-z0-9_=-]{20,}'), '<fernet>'),     # зашифрованные данные
+    (re.compile(r'\bsk-[A-Za-z0-9_-]{16,}'), '<api-key>'),
+    (re.compile(r'(?i)\bbearer\s+[A-Za-z0-9._~+/=-]{16,}'), 'Bearer <api-key>'),
+]
+
+
+def bind(update_id=None, user_id=None):
+    """Задает correlation id (u<update_id>) и пользователя для записей текущего контекста."""
+    correlation_id.set(f"u{update_id}" if update_id is not None else None)
+    current_user_id.set(user_id)
+
+
+def redact(text):
+    for pattern, replacement in _SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _redact_field(name, value):
+    if name in _SECRET_FIELDS:
+        return '<redacted>'
+    if name in _CONTENT_FIELDS and LOG_REDACT_CONTENT and isinstance(value, str):
+        return f'<redacted {len(value)} chars>'
+    if isinstance(value, str):
+        return redact(value)
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return redact(str(value))
+
+
+class StructLogger:
+    """
+    Тонкая обертка над logging.Logger: сообщение - постоянная строка, изменяемое - в полях.
+        log.info("Payment intent created", user_id=user_id, amount=amount)
+    sample - доля записей, которые реально пишутся (для частых событий);
+    отброшенные не создают даже LogRecord.
+    """
+
+    def __init__(self, logger):
+        self._logger = logger
+
+    def _log(self, level, msg, exc_info=None, sample=None, **fields):
+        if not self._logger.isEnabledFor(level):
+            return
+        if sample is not None and sample < 1.0 and random.random() >= sample:
+            return
+        extra = {'fields': fields}
+        if sample is not None:
+            extra['sample_rate'] = sample
+        self._logger.log(level, msg, exc_info=exc_info, extra=extra, stacklevel=3)
+
+    def debug(self, msg, **fields):
+        self._log(logging.DEBUG, msg, **fields)
+
+    def info(self, msg, **fields):
+        self._log(logging.INFO, msg, **fields)
+
+    def warning(self, msg, **fields):
+        self._log(logging.WARNING, msg, **fields)
+
+    def error(self, msg, **fields):
+        self._log(logging.ERROR, msg, **fields)
+
+    def exception(self, msg, **fields):
+        """error с traceback текущего исключения (или переданного в exc_info)."""
+        fields.setdefault('exc_info', True)
+        self._log(logging.ERROR, msg, **fields)
+
+
+def get_logger(name):
+    return StructLogger(logging.getLogger(name))
+
+
+# ========================== PIPELINE ==========================
+
+class _ContextFilter(logging.Filter):
+    """Копирует contextvars в запись: дальше она обрабатывается в другом потоке."""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        record.user_id = current_user_id.get()
+        return True
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладет запись в ограниченную очередь и сразу возвращается. Если поток записи
+    не успевает (stdout заблокирован), новые записи отбрасываются и считаются в dropped.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Форматирование - в потоке QueueListener; здесь только фиксируем текст,
+        # пока аргументы не изменились
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _record_fields(record):
+    fields = {}
+    for name, value in getattr(record, 'fields', {}).items():
+        fields[name] = _redact_field(name, value)
+    return fields
+
+
+def _format_exception(record):
+    if not record.exc_info:
+        return None
+    return redact(''.join(traceback.format_exception(*record.exc_info)).rstrip())
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': redact(record.msg),
+        }
+        if record.correlation_id is not None:
+            entry['correlation_id'] = record.correlation_id
+        if record.user_id is not None:
+            entry['user_id'] = record.user_id
+        entry.update(_record_fields(record))
+        if getattr(record, 'sample_rate', None) is not None:
+            entry['sample_rate'] = record.sample_rate
+        exc = _format_exception(record)
+        if exc:
+            entry['exc'] = exc
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Читаемый формат для локального запуска (LOG_FORMAT=text)."""
+
+    def format(self, record):
+        parts = [
+            datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S'),
+            record.levelname,
+            record.name,
+        ]
+        if record.correlation_id is not None:
+            parts.append(f"[{record.correlation_id}]")
+        parts.append(redact(record.msg))
+        fields = _record_fields(record)
+        if record.user_id is not None:
+            fields.setdefault('user_id', record.user_id)
+        parts.extend(f"{name}={value}" for name, value in fields.items())
+        line = ' '.join(str(part) for part in parts)
+        exc = _format_exception(record)
+        return f"{line}\n{exc}" if exc else line
+
+
+_handler = None
+_listener = None
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """
+    Настраивает корневой логгер: записи уходят в очередь, в stdout их пишет
+    отдельный поток QueueListener. Повторный вызов ничего не делает.
+    """
+    global _handler, _listener
+    if _listener is not None:
+        return
+    first_setup = _handler is None
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if fmt == 'text' else JsonFormatter())
+
+    _handler = _NonBlockingQueueHandler(log_queue)
+    _handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [_handler]
+    root.setLevel(level)
+    # httpx пишет каждый запрос на INFO (вместе с URL, где токен бота), apscheduler - каждый запуск задачи
+    for noisy in ('httpx', 'httpcore', 'apscheduler'):
+        logging.getLogger(noisy).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    if first_setup:
+        import metrics
+        metrics.counter(
+            'bot_log_dropped_total', 'Log records dropped because the log queue was full',
+            function=lambda: _handler.dropped
+        )
+
+
+def shutdown_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток записи."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
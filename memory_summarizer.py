@@ -0,0 +1,88 @@
+# memory_summarizer.py - Фоновое сжатие старых реплик в долговременную память
+import asyncio
+
+from async_db_manager import get_user_memory, save_user_memory, get_messages_to_summarize
+from ai_service import summarize_conversation
+from vector_memory import split_facts
+from log_service import get_logger
+from config import LOG_SAMPLE_RATE
+
+log = get_logger(__name__)
+
+
+class ConversationSummarizer:
+    """
+    Когда у пользователя набирается trigger_messages реплик, не вошедших в сводку,
+    в фоне запускается сжатие: старые реплики вместе с прежней сводкой сворачиваются
+    моделью в новую запись user_memory. В промпт после этого идет сводка и только
+    реплики новее нее. Для одного пользователя одновременно идет не больше одной сводки.
+    Если задан vector_memory, строки сводки сохраняются еще и как отдельные факты,
+    чтобы не потеряться, когда следующая сводка их вытеснит.
+    """
+
+    def __init__(self, trigger_messages, vector_memory=None):
+        self.trigger_messages = trigger_messages
+        self.vector_memory = vector_memory
+        self._tasks = {}  # user_id -> asyncio.Task
+
+        self.completed = 0
+        self.failed = 0
+        self.summarized_messages = 0
+
+    def maybe_schedule(self, user_id, unsummarized):
+        """unsummarized - сколько реплик пользователя сейчас вне сводки."""
+        if unsummarized < self.trigger_messages or user_id in self._tasks:
+            return
+        task = asyncio.create_task(self._summarize(user_id))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda done: self._forget(user_id, done))
+
+    def _forget(self, user_id, task):
+        # После cancel() для пользователя уже может идти новая сводка
+        if self._tasks.get(user_id) is task:
+            del self._tasks[user_id]
+
+    def cancel(self, user_id):
+        """Отменяет сводку пользователя (например, перед /reset)."""
+        task = self._tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _summarize(self, user_id):
+        try:
+            summary, summarized_until = await get_user_memory(user_id)
+            turns = await get_messages_to_summarize(user_id, since=summarized_until)
+            if not turns:
+                return
+
+            new_summary = await summarize_conversation(user_id, summary, turns)
+            if not new_summary:
+                return
+
+            await save_user_memory(user_id, new_summary, turns[-1]['timestamp'])
+            if self.vector_memory is not None:
+                await self.vector_memory.add_facts(user_id, split_facts(new_summary))
+            self.completed += 1
+            self.summarized_messages += len(turns)
+            log.info("Memory updated", sample=LOG_SAMPLE_RATE, user_id=user_id, summarized=len(turns))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            log.warning("Не удалось обновить память пользователя", user_id=user_id, error=repr(e))
+
+    async def stop(self):
+        """Отменяет незавершенные сводки (они повторятся при следующих сообщениях)."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def stats(self):
+        return {
+            'running': len(self._tasks),
+            'completed': self.completed,
+            'failed': self.failed,
+            'summarized_messages': self.summarized_messages,
+        }
@@ -0,0 +1,28 @@
+# migrate_messages.py - Обслуживание таблицы messages
+# Запуск:
+#   python migrate_messages.py               - перевод на секционирование по дням (можно при работающем
+#                                              боте: копирование пачками, блокировка - только на замену таблиц)
+#   python migrate_messages.py --index-only  - только индекс по timestamp для очистки несекционированной таблицы
+import argparse
+import asyncio
+from log_service import setup_logging
+from async_db_manager import init_db, close_db, migrate_messages_to_partitioned, build_messages_timestamp_index
+
+
+async def main(args):
+    await init_db()
+    try:
+        if args.index_only:
+            await build_messages_timestamp_index()
+        else:
+            await migrate_messages_to_partitioned(days_to_keep=7)
+    finally:
+        await close_db()
+
+
+if __name__ == '__main__':
+    setup_logging(fmt='text')
+    parser = argparse.ArgumentParser(description="Maintenance of the messages table")
+    parser.add_argument('--index-only', action='store_true',
+                        help="только построить индекс messages(timestamp), без секционирования")
+    asyncio.run(main(parser.parse_args()))
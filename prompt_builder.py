@@ -0,0 +1,115 @@
+# prompt_builder.py - Системный промпт с неизменяемым префиксом для кэширования у провайдера
+from datetime import datetime
+from string import Formatter
+
+from config import SYSTEM_PROMPT
+
+
+class PromptTemplate:
+    """
+    Шаблон str.format, разобранный один раз при загрузке:
+    render только склеивает готовые куски, без повторного разбора строки.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self._parts = []  # (текст, имя поля | None)
+        for literal, field, spec, conversion in Formatter().parse(template):
+            if spec or conversion:
+                raise ValueError(f"Форматирование полей в шаблоне промпта не поддерживается: {{{field}}}")
+            self._parts.append((literal, field))
+        self.fields = {field for _, field in self._parts if field is not None}
+
+    def render(self, **values):
+        return ''.join(
+            literal + (str(values[field]) if field is not None else '')
+            for literal, field in self._parts
+        )
+
+
+def split_static_prefix(template):
+    """
+    Делит шаблон на статический префикс (до первой строки с полем) и хвост с полями.
+    Префикс не зависит ни от пользователя, ни от даты.
+    """
+    lines = template.splitlines(keepends=True)
+    for index, line in enumerate(lines):
+        if PromptTemplate(line).fields:
+            prefix = PromptTemplate(''.join(lines[:index]).rstrip()).render()
+            return prefix, PromptTemplate(''.join(lines[index:]).strip())
+    return PromptTemplate(template.rstrip()).render(), PromptTemplate('')
+
+
+# Компилируется один раз при запуске. PERSONA_PREFIX - первое сообщение каждого запроса,
+# побайтно одинаковое для всех пользователей и дней, поэтому провайдер может кэшировать его
+PERSONA_PREFIX, _PERSONA_FIELDS = split_static_prefix(SYSTEM_PROMPT)
+
+_ISOLATION_TEMPLATE = PromptTemplate(
+    "[КОНТЕКСТ СЕССИИ: User ID {user_id}. Это приватный диалог только с {user_name}. "
+    "Забудь все предыдущие разговоры с другими людьми.]"
+)
+_MEMORY_TEMPLATE = PromptTemplate("[ЧТО ТЫ ПОМНИШЬ О СОБЕСЕДНИКЕ ИЗ ПРОШЛЫХ РАЗГОВОРОВ:\n{memory}]")
+_FACTS_TEMPLATE = PromptTemplate("[ЕЩЕ ВСПОМНИЛОСЬ ПО ТЕМЕ:\n{facts}]")
+
+
+def build_session_context(user_id, user_display_name, memory=None, facts=None, now=None):
+    """
+    Изменчивая часть системного промпта: дата, имя, изоляция сессии, память.
+    Идет отдельным системным сообщением в конце, перед сообщением пользователя,
+    чтобы не ломать общий префикс (персона + история).
+    """
+    now = now or datetime.now()
+    segments = [
+        _PERSONA_FIELDS.render(date=now.strftime('%d.%m.%Y'), user_name=user_display_name),
+        _ISOLATION_TEMPLATE.render(user_id=user_id, user_name=user_display_name),
+    ]
+    # Долговременная память заменяет старые реплики, которые уже не попадают в историю
+    if memory:
+        segments.append(_MEMORY_TEMPLATE.render(memory=memory))
+    if facts:
+        segments.append(_FACTS_TEMPLATE.render(facts="\n".join(f"- {fact}" for fact in facts)))
+    return "\n\n".join(segment for segment in segments if segment)
+
+
+def cached_tokens_from_usage(usage):
+    """
+    Сколько токенов промпта провайдер взял из кэша. OpenAI/OpenRouter отдают
+    usage.prompt_tokens_details.cached_tokens, DeepSeek - usage.prompt_cache_hit_tokens.
+    """
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+    return cached or 0
+
+
+class PromptCacheStats:
+    """Доля токенов промпта, обслуженных из кэша провайдера."""
+
+    def __init__(self):
+        self.requests = 0
+        self.requests_with_hit = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, usage):
+        if usage is None:
+            return
+        cached = cached_tokens_from_usage(usage)
+        self.requests += 1
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.cached_tokens += cached
+        if cached:
+            self.requests_with_hit += 1
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'requests_with_hit': self.requests_with_hit,
+            'prompt_tokens': self.prompt_tokens,
+            'cached_tokens': self.cached_tokens,
+            'cached_ratio': round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+        }
+
+
+prompt_cache_stats = PromptCacheStats()
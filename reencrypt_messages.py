@@ -0,0 +1,22 @@
+# reencrypt_messages.py - Перешифровка сообщений и сводок памяти текущим ключом
+# Запуск: python reencrypt_messages.py (можно при работающем боте, идет короткими пачками)
+import argparse
+import asyncio
+from log_service import setup_logging
+from async_db_manager import init_db, close_db, reencrypt_messages
+
+
+async def main(args):
+    await init_db()
+    try:
+        await reencrypt_messages(from_start=args.from_start)
+    finally:
+        await close_db()
+
+
+if __name__ == '__main__':
+    setup_logging(fmt='text')
+    parser = argparse.ArgumentParser(description="Re-encrypt stored data with the current key")
+    parser.add_argument('--from-start', action='store_true',
+                        help="пройти таблицы заново, а не продолжать с сохраненной позиции")
+    asyncio.run(main(parser.parse_args()))
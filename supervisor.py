@@ -0,0 +1,427 @@
+# supervisor.py - Раздача апдейтов нескольким процессам-воркерам
+import asyncio
+import bisect
+import collections
+import hashlib
+import json
+import multiprocessing
+import queue as queue_module
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+from log_service import get_logger, setup_logging
+from config import (
+    TOKEN_TG,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_SECRET_TOKEN,
+    SUPERVISOR_QUEUE_SIZE,
+    SUPERVISOR_VIRTUAL_NODES,
+    SUPERVISOR_DRAIN_TIMEOUT,
+    SUPERVISOR_DISPATCH_TIMEOUT,
+    SUPERVISOR_RESTART_BASE_DELAY,
+    SUPERVISOR_RESTART_MAX_DELAY
+)
+
+# Тот же список, что и в bot_runner (сам bot_runner в supervisor не импортируется)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.PRE_CHECKOUT_QUERY]
+
+log = get_logger(__name__)
+
+
+class HashRing:
+    """
+    Consistent hashing: каждый узел представлен vnodes точками на кольце,
+    ключ попадает на первый узел по часовой стрелке. При изменении числа
+    воркеров переезжает только ~1/N пользователей, а не все.
+    """
+
+    def __init__(self, nodes, vnodes=64):
+        self._points = []
+        self._nodes = []
+        ring = sorted(
+            (self._hash(f"{node}#{replica}"), node)
+            for node in nodes
+            for replica in range(vnodes)
+        )
+        for point, node in ring:
+            self._points.append(point)
+            self._nodes.append(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+    def node_for(self, key):
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[index]
+
+
+def _routing_key(update):
+    """Апдейты одного пользователя всегда идут в один воркер."""
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+# ========================== ВОРКЕР ==========================
+
+def _worker_main(index, updates, acks):
+    """Точка входа процесса-воркера."""
+    # Сигналы остановки обрабатывает supervisor: он дает воркеру доработать очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Процесс запущен через spawn: логирование настраивается заново
+    setup_logging()
+    asyncio.run(_run_worker(index, updates, acks))
+
+
+async def _run_worker(index, updates, acks):
+    """
+    Читает пары (seq, апдейт) из updates и сообщает supervisor'у через acks:
+    ('taken', seq) - апдейт взят из очереди, ('done', seq) - обработан.
+    """
+    # Импорт внутри процесса: каждый воркер создает свой пул БД, кэши и очередь к модели
+    from bot_runner import build_application
+
+    application = build_application(worker_index=index, with_updater=False)
+    loop = asyncio.get_running_loop()
+
+    async def handle(seq, update):
+        # То же, что PTB делает с апдейтом из update_queue, плюс подтверждение об обработке
+        try:
+            await application.update_processor.process_update(update, application.process_update(update))
+        finally:
+            acks.send(('done', seq))
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    log.info("Worker started", worker=index)
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, updates.get)
+            if item is None:
+                break
+            seq, data = item
+            acks.send(('taken', seq))
+            try:
+                update = Update.de_json(json.loads(data), application.bot)
+            except Exception as e:
+                log.error("Не удалось разобрать апдейт", worker=index, error=repr(e))
+                acks.send(('done', seq))
+                continue
+            application.create_task(handle(seq, update), update=update)
+    finally:
+        # stop() дожидается задач create_task, то есть обработки уже принятых апдейтов
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        log.info("Worker stopped", worker=index)
+
+
+# ========================== SUPERVISOR ==========================
+
+class Supervisor:
+    """
+    Принимает апдейты из Telegram (polling или webhook) и раздает их воркерам
+    по consistent hashing от user_id. Порядок апдейтов одного пользователя
+    сохраняется: у каждого воркера одна FIFO-очередь и одна задача, которая ее наполняет.
+    Переполненная очередь одного воркера не задерживает остальных: апдейт ждет места
+    не дольше SUPERVISOR_DISPATCH_TIMEOUT и отбрасывается.
+
+    Упавший воркер перезапускается с паузой, которая растет при падениях подряд, и с новой
+    очередью: старую процесс мог оставить заблокированной, если умер внутри get.
+    Апдейты, которые он не успел взять, переносятся в новую очередь. Апдейты, которые он уже
+    обрабатывал, не повторяются (обработчик мог успеть, например, провести оплату) и пишутся в лог.
+    """
+
+    def __init__(self, workers, queue_size=SUPERVISOR_QUEUE_SIZE, vnodes=SUPERVISOR_VIRTUAL_NODES):
+        self._ctx = multiprocessing.get_context('spawn')
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queues = [None] * workers
+        self.processes = [None] * workers
+        self.ring = HashRing(range(workers), vnodes)
+
+        # Апдейт воркера проходит outbox -> очередь процесса (_pending) -> обработка (_in_flight)
+        self._outboxes = [asyncio.Queue(queue_size) for _ in range(workers)]
+        self._pending = [collections.deque() for _ in range(workers)]  # (seq, update_id, data)
+        self._in_flight = [{} for _ in range(workers)]  # seq -> update_id
+        self._seq = 0
+        # Чтение подтверждений и ожидание места в очередях: свои потоки, по два на воркер
+        # и один на остановку, чтобы зависший воркер не занял общий executor
+        self._io = ThreadPoolExecutor(max_workers=2 * workers + 1, thread_name_prefix='supervisor-io')
+        self._tasks = set()
+
+        self.dispatched = [0] * workers
+        self.dropped = [0] * workers
+        self.lost = [0] * workers
+        self.restarts = [0] * workers
+        self._failures = [0] * workers
+        self._started_at = [0.0] * workers
+        self._stopping = False
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _start_worker(self, index):
+        reader, writer = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self.queues[index], writer),
+            name=f"aigirl-worker-{index}",
+        )
+        process.start()
+        # Пишущий конец остается только у воркера: после его завершения чтение получит EOF
+        writer.close()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        self._spawn(self._watch(index, process, reader))
+
+    def _new_queue(self, index):
+        old = self.queues[index]
+        self.queues[index] = self._ctx.Queue(self.queue_size)
+        if old is not None:
+            old.cancel_join_thread()
+            old.close()
+
+    def _ack(self, index, kind, seq):
+        if kind == 'taken':
+            pending = self._pending[index]
+            while pending and pending[0][0] <= seq:
+                taken_seq, update_id, _ = pending.popleft()
+                if taken_seq == seq:
+                    self._in_flight[index][seq] = update_id
+        else:
+            self._in_flight[index].pop(seq, None)
+
+    async def dispatch(self, update):
+        index = self.ring.node_for(_routing_key(update))
+        try:
+            self._outboxes[index].put_nowait((update.update_id, update.to_json()))
+        except asyncio.QueueFull:
+            self.dropped[index] += 1
+            log.error("Worker outbox is full, update dropped", worker=index, update_id=update.update_id)
+            return
+        self.dispatched[index] += 1
+
+    async def _forward(self, update_queue):
+        while True:
+            update = await update_queue.get()
+            try:
+                await self.dispatch(update)
+            except Exception as e:
+                log.error("Не удалось передать апдейт воркеру", update_id=update.update_id, error=repr(e))
+            finally:
+                update_queue.task_done()
+
+    async def _feed(self, index):
+        """Переносит апдейты из outbox воркера в очередь его процесса."""
+        loop = asyncio.get_running_loop()
+        outbox = self._outboxes[index]
+        while True:
+            update_id, data = await outbox.get()
+            try:
+                self._seq += 1
+                seq = self._seq
+                self._pending[index].append((seq, update_id, data))
+                updates = self.queues[index]
+                try:
+                    updates.put_nowait((seq, data))
+                except queue_module.Full:
+                    await loop.run_in_executor(
+                        self._io, updates.put, (seq, data), True, SUPERVISOR_DISPATCH_TIMEOUT
+                    )
+            except (queue_module.Full, ValueError):
+                # Если очередь за это время заменили, апдейт уже перенесен в новую
+                if updates is self.queues[index]:
+                    self._pending[index].pop()
+                    self.dropped[index] += 1
+                    log.error("Worker queue is full, update dropped", worker=index, update_id=update_id,
+                              timeout=SUPERVISOR_DISPATCH_TIMEOUT)
+            finally:
+                outbox.task_done()
+
+    async def _watch(self, index, process, reader):
+        """
+        Читает подтверждения воркера. EOF значит, что процесс завершился
+        и все его подтверждения уже прочитаны - тогда воркер перезапускается.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    kind, seq = await loop.run_in_executor(self._io, reader.recv)
+                except (EOFError, OSError):
+                    break
+                self._ack(index, kind, seq)
+        finally:
+            reader.close()
+        await loop.run_in_executor(self._io, process.join)
+        if not self._stopping:
+            await self._restart_worker(index, process)
+
+    async def _restart_worker(self, index, process):
+        self.restarts[index] += 1
+        # Воркер, проработавший дольше максимальной паузы, считается здоровым
+        if time.monotonic() - self._started_at[index] > SUPERVISOR_RESTART_MAX_DELAY:
+            self._failures[index] = 0
+        self._failures[index] += 1
+        delay = min(SUPERVISOR_RESTART_MAX_DELAY,
+                    SUPERVISOR_RESTART_BASE_DELAY * 2 ** min(self._failures[index] - 1, 16))
+
+        in_flight = self._in_flight[index]
+        if in_flight:
+            self.lost[index] += len(in_flight)
+            log.error("Worker exited while handling updates, they are not retried", worker=index,
+                      count=len(in_flight), update_ids=list(in_flight.values()))
+            in_flight.clear()
+
+        self._new_queue(index)
+        pending = self._pending[index]
+        requeued = 0
+        for seq, update_id, data in pending:
+            try:
+                self.queues[index].put_nowait((seq, data))
+            except queue_module.Full:
+                break
+            requeued += 1
+        overflow = len(pending) - requeued
+        if overflow:
+            self.dropped[index] += overflow
+            log.error("Worker queue is full, updates dropped on restart", worker=index, count=overflow)
+            for _ in range(overflow):
+                pending.pop()
+
+        log.warning("Worker exited, restarting", worker=index, exit_code=process.exitcode,
+                    restarts=self.restarts[index], delay=delay, requeued=requeued)
+        await asyncio.sleep(delay)
+        if not self._stopping:
+            self._start_worker(index)
+
+    async def _drain_workers(self):
+        """Сигнализирует воркерам остановиться после текущей очереди и ждет их."""
+        loop = asyncio.get_running_loop()
+        running = []
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                if self._pending[index]:
+                    log.warning("Worker is not running, its queued updates are lost", worker=index,
+                                count=len(self._pending[index]))
+                continue
+            try:
+                await loop.run_in_executor(
+                    self._io, self.queues[index].put, None, True, SUPERVISOR_DRAIN_TIMEOUT
+                )
+            except queue_module.Full:
+                log.warning("Worker queue did not drain in time", worker=index, timeout=SUPERVISOR_DRAIN_TIMEOUT)
+            running.append(index)
+
+        for index in running:
+            process = self.processes[index]
+            await loop.run_in_executor(self._io, process.join, SUPERVISOR_DRAIN_TIMEOUT)
+            if process.is_alive():
+                log.warning("Worker did not stop in time, terminating", worker=index,
+                            timeout=SUPERVISOR_DRAIN_TIMEOUT)
+                process.terminate()
+                await loop.run_in_executor(self._io, process.join)
+
+    async def _start_intake(self, updater):
+        if BOT_MODE == 'webhook':
+            if not WEBHOOK_URL or not WEBHOOK_SECRET_TOKEN:
+                raise RuntimeError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL и WEBHOOK_SECRET_TOKEN")
+            log.info("Supervisor webhook listener started", listen=WEBHOOK_LISTEN,
+                     port=WEBHOOK_PORT, path=WEBHOOK_PATH)
+            await updater.start_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            await updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stop_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass
+
+        for index in range(self.workers):
+            self._new_queue(index)
+            self._start_worker(index)
+        feeders = [asyncio.create_task(self._feed(index)) for index in range(self.workers)]
+
+        update_queue = asyncio.Queue()
+        updater = Updater(bot=Bot(TOKEN_TG), update_queue=update_queue)
+        forwarder = asyncio.create_task(self._forward(update_queue))
+
+        log.info("AIGirl supervisor is running", mode=BOT_MODE, workers=self.workers)
+        try:
+            async with updater:
+                await self._start_intake(updater)
+                await stop_event.wait()
+                log.info("Supervisor stopping: draining workers")
+                await updater.stop()
+        finally:
+            self._stopping = True
+            # Отдаем воркерам все, что уже получили от Telegram
+            await update_queue.join()
+            forwarder.cancel()
+            for outbox in self._outboxes:
+                await outbox.join()
+            for feeder in feeders:
+                feeder.cancel()
+            await self._drain_workers()
+            # Воркеры завершены: остались чтение их последних подтверждений и паузы перед перезапуском
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._io.shutdown(wait=False)
+            log.info("Supervisor stopped", dispatched=self.dispatched, dropped=self.dropped,
+                     lost=self.lost, restarts=self.restarts)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'alive': sum(1 for p in self.processes if p is not None and p.is_alive()),
+            'dispatched': list(self.dispatched),
+            'dropped': list(self.dropped),
+            'lost': list(self.lost),
+            'pending': [len(pending) for pending in self._pending],
+            'restarts': list(self.restarts),
+        }
+
+
+def run_supervisor(workers):
+    """Запускает supervisor с workers процессами-воркерами (блокирует до остановки)."""
+    asyncio.run(Supervisor(workers).run())
+
+
+if __name__ == '__main__':
+    from config import SUPERVISOR_WORKERS
+    setup_logging()
+    run_supervisor(max(1, SUPERVISOR_WORKERS))
@@ -0,0 +1,30 @@
+# conftest.py - Окружение для тестов: config.py читает обязательные переменные при импорте
+import base64
+import os
+import sys
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _b64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+
+_TEST_ENV = {
+    'TOKEN_TG': _b64('123456789:AAEtesttokentesttokentesttokentest'),
+    'DEEPSEEK_API_KEY': _b64('sk-test'),
+    'ENCRYPTION_KEY': _b64(Fernet.generate_key().decode('ascii')),
+    'CHANNEL_USERNAME': _b64('@test_channel'),
+    'CHANNEL_ID': _b64('-1001234567890'),
+    'DB_HOST': _b64('localhost'),
+    'DB_PORT': _b64('5432'),
+    'DB_NAME': _b64('test'),
+    'DB_USER': _b64('test'),
+    'DB_PASSWORD': _b64('test'),
+    'LOG_LEVEL': 'WARNING',
+}
+
+for name, value in _TEST_ENV.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import cache
+from cache import ConversationWindowCache, TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, 'time', SimpleNamespace(monotonic=clock))
+    return clock
+
+
+def _history(*contents):
+    base = datetime(2026, 1, 1, 12, 0)
+    return [
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': content, 'timestamp': base + timedelta(minutes=i)}
+        for i, content in enumerate(contents)
+    ]
+
+
+# ==================== TTLCache ====================
+
+def test_ttl_cache_expires_entries(clock):
+    ttl_cache = TTLCache(maxsize=10, default_ttl=5)
+    ttl_cache.set('a', 1)
+    ttl_cache.set('b', 2, ttl=60)
+
+    clock.now += 5
+    assert ttl_cache.get('a') is None
+    assert ttl_cache.get('b') == 2
+    assert ttl_cache.stats()['expirations'] == 1
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    ttl_cache = TTLCache(maxsize=2)
+    ttl_cache.set('a', 1)
+    ttl_cache.set('b', 2)
+    assert ttl_cache.get('a') == 1
+
+    ttl_cache.set('c', 3)
+    assert ttl_cache.get('b') is None
+    assert ttl_cache.get('a') == 1 and ttl_cache.get('c') == 3
+    assert ttl_cache.stats()['evictions'] == 1
+
+
+def test_ttl_cache_with_zero_size_stores_nothing(clock):
+    ttl_cache = TTLCache(maxsize=0)
+    ttl_cache.set('a', 1)
+    assert ttl_cache.get('a') is None and len(ttl_cache) == 0
+
+
+# ==================== ConversationWindowCache ====================
+
+def test_window_keeps_last_turns():
+    window = ConversationWindowCache(max_bytes=10_000, window_size=3)
+    window.put(1, _history('m0', 'm1', 'm2', 'm3'), complete=False)
+    window.append(1, 'assistant', 'm4')
+
+    assert [m['content'] for m in window.get(1, limit=3)] == ['m2', 'm3', 'm4']
+    # Окно неполное, а просят больше, чем в нем есть - промах
+    assert window.get(1, limit=5) is None
+
+
+def test_complete_window_answers_any_limit():
+    window = ConversationWindowCache(max_bytes=10_000, window_size=5)
+    window.put(1, _history('m0', 'm1'), complete=True)
+    assert [m['content'] for m in window.get(1, limit=10)] == ['m0', 'm1']
+
+
+def test_window_skips_turns_already_in_the_summary():
+    window = ConversationWindowCache(max_bytes=10_000, window_size=3)
+    history = _history('m0', 'm1', 'm2')
+    window.put(1, history, complete=False)
+
+    since = history[0]['timestamp']
+    assert [m['content'] for m in window.get(1, limit=10, since=since)] == ['m1', 'm2']
+
+
+def test_window_evicts_least_recently_used_users_by_bytes():
+    window = ConversationWindowCache(max_bytes=10, window_size=5)
+    window.put(1, _history('aaaa'), complete=True)
+    window.put(2, _history('bbbb'), complete=True)
+    assert window.get(1, limit=1) is not None
+
+    window.put(3, _history('cccc'), complete=True)
+    assert window.get(2, limit=1) is None
+    assert window.get(1, limit=1) is not None and window.get(3, limit=1) is not None
+    assert window.total_bytes == 8 and window.stats()['evictions'] == 1
+
+
+def test_window_expires_after_ttl(clock):
+    window = ConversationWindowCache(max_bytes=10_000, window_size=5, ttl=300)
+    window.put(1, _history('m0'), complete=True)
+
+    clock.now += 299
+    assert window.get(1, limit=1) is not None
+    clock.now += 1
+    assert window.get(1, limit=1) is None
+    assert window.total_bytes == 0 and window.stats()['expirations'] == 1
+
+
+def test_disabled_window_stores_nothing():
+    window = ConversationWindowCache(max_bytes=0, window_size=5)
+    window.reset(1)
+    window.append(1, 'user', 'hello')
+    assert window.get(1, limit=1) is None and window.stats()['users'] == 0
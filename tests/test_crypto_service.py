@@ -0,0 +1,115 @@
+import asyncio
+from datetime import datetime
+
+from cryptography.fernet import Fernet
+
+import async_db_manager
+from crypto_service import CryptoService, parse_keys
+
+OLD_KEY = Fernet.generate_key().decode('ascii')
+NEW_KEY = Fernet.generate_key().decode('ascii')
+
+
+def test_parse_keys_keeps_legacy_key_as_version_one():
+    assert parse_keys(f"2:{NEW_KEY}", OLD_KEY) == {2: NEW_KEY, 1: OLD_KEY}
+    assert parse_keys(f"1:{NEW_KEY}", OLD_KEY) == {1: NEW_KEY}
+
+
+def test_new_values_use_the_current_version():
+    crypto = CryptoService({1: OLD_KEY, 2: NEW_KEY})
+    encrypted = crypto.encrypt("привет")
+    assert encrypted.startswith("k2:")
+    assert crypto.decrypt(encrypted) == "привет"
+
+
+def test_values_encrypted_with_an_old_key_are_still_readable():
+    old = CryptoService({1: OLD_KEY})
+    versioned = old.encrypt("старое")
+    legacy = Fernet(OLD_KEY).encrypt("без версии".encode('utf-8')).decode('utf-8')
+
+    rotated = CryptoService({1: OLD_KEY, 2: NEW_KEY})
+    assert rotated.decrypt(versioned) == "старое"
+    assert rotated.decrypt(legacy) == "без версии"
+
+
+def test_rotate_reencrypts_with_the_current_key():
+    old_value = CryptoService({1: OLD_KEY}).encrypt("факт")
+    crypto = CryptoService({1: OLD_KEY, 2: NEW_KEY})
+
+    rotated = crypto.rotate(old_value)
+    assert rotated.startswith("k2:")
+    # После удаления старого ключа значение читается только новым
+    assert CryptoService({2: NEW_KEY}).decrypt(rotated) == "факт"
+
+
+def test_rotate_reports_failures_per_value():
+    good = CryptoService({1: OLD_KEY}).encrypt("ok")
+    lost = CryptoService({3: Fernet.generate_key().decode('ascii')}).encrypt("lost")
+    crypto = CryptoService({1: OLD_KEY, 2: NEW_KEY}, offload_min_batch=1)
+
+    values = [good, lost, "corrupted"] * 20
+    rotated = asyncio.run(crypto.rotate_many(values))
+    assert all(value is not None for value in rotated[0::3])
+    assert rotated[1::3] == [None] * 20
+    assert rotated[2::3] == [None] * 20
+    assert crypto.decrypt_failures == 40
+
+
+def test_decrypt_failure_returns_a_marker():
+    crypto = CryptoService({1: OLD_KEY})
+    assert crypto.decrypt("k9:broken").startswith("[DECRYPTION FAILED")
+    assert crypto.decrypt_failures == 1
+
+
+# ==================== reencrypt_messages ====================
+
+class FakePool:
+    """Таблицы messages, user_memory и reencrypt_cursor в памяти - ровно то, что читает перешифровка."""
+
+    def __init__(self, contents):
+        self.messages = {i: content for i, content in enumerate(contents, start=1)}
+        self.cursor = {}
+        self.scanned = []
+
+    async def fetch(self, query, last_key, pattern, limit):
+        if 'user_memory' in query:
+            return []
+        prefix = pattern.rstrip('%')
+        ids = sorted(i for i, content in self.messages.items() if i > last_key and not content.startswith(prefix))
+        self.scanned.extend(ids[:limit])
+        return [{'id': i, 'timestamp': datetime(2026, 1, 1), 'content': self.messages[i]} for i in ids[:limit]]
+
+    async def fetchval(self, query, table, key_version):
+        last_key, version = self.cursor.get(table, (None, None))
+        return last_key if version == key_version else None
+
+    async def execute(self, query, *args):
+        if 'reencrypt_cursor' in query:
+            table, key_version, last_key = args
+            self.cursor[table] = (last_key, key_version)
+        else:
+            ids, _, contents = args
+            self.messages.update(zip(ids, contents))
+
+
+def test_reencrypt_resumes_after_rows_it_could_not_decrypt(monkeypatch):
+    old = CryptoService({1: OLD_KEY})
+    lost = CryptoService({3: Fernet.generate_key().decode('ascii')}).encrypt("lost")
+    crypto = CryptoService({1: OLD_KEY, 2: NEW_KEY})
+    pool = FakePool([old.encrypt("a"), lost, old.encrypt("b")])
+    monkeypatch.setattr(async_db_manager, 'crypto', crypto)
+    monkeypatch.setattr(async_db_manager, '_pool', pool)
+
+    assert asyncio.run(async_db_manager.reencrypt_messages(batch_size=2, pause=0)) == 2
+    assert async_db_manager.get_reencrypt_progress()['failed'] == 1
+    assert [crypto.decrypt(pool.messages[i]) for i in (1, 3)] == ["a", "b"]
+
+    # Повторный запуск продолжает с сохраненной позиции и не трогает нерасшифровавшуюся строку
+    pool.messages[4] = old.encrypt("c")
+    pool.scanned.clear()
+    assert asyncio.run(async_db_manager.reencrypt_messages(batch_size=2, pause=0)) == 1
+    assert pool.scanned == [4] and crypto.decrypt_failures == 1
+
+    pool.scanned.clear()
+    asyncio.run(async_db_manager.reencrypt_messages(batch_size=2, pause=0, from_start=True))
+    assert pool.scanned == [2]
@@ -0,0 +1,262 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import APIStatusError
+
+import llm_gateway
+from llm_gateway import CircuitBreaker, HedgePolicy, LLMBackend, LLMGateway, LLMUnavailableError, is_retryable
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Подменяется только время модуля: часы event loop должны идти как обычно
+    clock = FakeClock()
+    monkeypatch.setattr(llm_gateway, 'time', SimpleNamespace(monotonic=clock, perf_counter=time.perf_counter))
+    return clock
+
+
+def _status_error(status):
+    request = httpx.Request('POST', 'https://llm.test/v1/chat/completions')
+    return APIStatusError('error', response=httpx.Response(status, request=request), body=None)
+
+
+def _backend(name, create):
+    backend = LLMBackend(name, 'https://llm.test/v1', 'key', 'model', CircuitBreaker(2, 30.0))
+    backend.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    return backend
+
+
+# ==================== CircuitBreaker ====================
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30.0)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.available() and not breaker.allow()
+
+
+def test_breaker_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open_allows_a_single_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30.0)
+    breaker.record_failure()
+    clock.now += 30.0
+
+    assert breaker.available()
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    # Проба не дала вердикта (отмена) - следующий запрос снова может стать пробой
+    breaker.release()
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.failures == 0
+
+
+def test_breaker_failed_probe_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30.0)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 30.0
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.opened_at == clock.now
+    assert not breaker.allow()
+
+
+@pytest.mark.parametrize('status, retryable', [
+    (400, False), (401, False), (403, False), (404, False), (409, False),
+    (408, True), (429, True), (500, True), (503, True),
+])
+def test_retryable_statuses(status, retryable):
+    assert is_retryable(_status_error(status)) is retryable
+
+
+def test_timeouts_are_retryable():
+    assert is_retryable(asyncio.TimeoutError())
+    assert not is_retryable(ValueError())
+
+
+# ==================== LLMGateway ====================
+
+def test_gateway_fails_over_and_prefers_the_measured_backend(clock):
+    calls = []
+
+    async def broken(**kwargs):
+        calls.append('primary')
+        raise _status_error(503)
+
+    async def healthy(**kwargs):
+        calls.append('fallback')
+        return 'answer'
+
+    gateway = LLMGateway([_backend('primary', broken), _backend('fallback', healthy)], base_delay=0)
+
+    async def scenario():
+        assert await gateway.complete(5.0, messages=[]) == 'answer'
+        assert await gateway.complete(5.0, messages=[]) == 'answer'
+
+    asyncio.run(scenario())
+    # У primary нет ни одного замера: он идет после fallback, а не первым
+    assert calls == ['primary', 'fallback', 'fallback']
+    assert [backend.name for backend in gateway.route('complete')] == ['fallback', 'primary']
+
+
+def test_route_orders_measured_backends_by_latency(clock):
+    async def unused(**kwargs):
+        raise AssertionError("route must not call backends")
+
+    slow, fast, new = _backend('slow', unused), _backend('fast', unused), _backend('new', unused)
+    slow.record_latency('complete', 2.0)
+    fast.record_latency('complete', 0.5)
+    gateway = LLMGateway([new, slow, fast])
+
+    assert [backend.name for backend in gateway.route('complete')] == ['fast', 'slow', 'new']
+    # Для другого kind замеров нет ни у кого - порядок из конфигурации
+    assert [backend.name for backend in gateway.route('stream')] == ['new', 'slow', 'fast']
+
+
+def test_gateway_opens_the_circuit_after_repeated_failures(clock):
+    calls = []
+
+    async def broken(**kwargs):
+        calls.append('primary')
+        raise _status_error(503)
+
+    gateway = LLMGateway([_backend('primary', broken)], max_attempts=2, base_delay=0)
+    with pytest.raises(APIStatusError):
+        asyncio.run(gateway.complete(5.0, messages=[]))
+    assert calls == ['primary', 'primary']
+    assert gateway.backends[0].breaker.state == CircuitBreaker.OPEN
+    assert gateway.route('complete') == []
+
+
+def test_gateway_does_not_retry_request_errors(clock):
+    calls = []
+
+    async def rejected(**kwargs):
+        calls.append('primary')
+        raise _status_error(401)
+
+    async def healthy(**kwargs):
+        calls.append('fallback')
+        return 'answer'
+
+    gateway = LLMGateway([_backend('primary', rejected), _backend('fallback', healthy)])
+    with pytest.raises(APIStatusError):
+        asyncio.run(gateway.complete(5.0, messages=[]))
+    assert calls == ['primary']
+    assert gateway.backends[0].breaker.state == CircuitBreaker.CLOSED
+
+
+def test_gateway_rejects_immediately_when_all_circuits_are_open(clock):
+    async def unused(**kwargs):
+        raise AssertionError("open circuit must not be called")
+
+    backend = _backend('primary', unused)
+    backend.breaker.record_failure()
+    backend.breaker.record_failure()
+    gateway = LLMGateway([backend])
+    with pytest.raises(LLMUnavailableError):
+        asyncio.run(gateway.complete(5.0, messages=[]))
+
+
+# ==================== HedgePolicy ====================
+
+def test_hedge_delay_needs_enough_samples():
+    policy = HedgePolicy(percentile=0.9, min_delay=0.5, min_samples=10, recompute_every=1)
+    for _ in range(9):
+        policy.record('complete', 2.0)
+    assert policy.delay('complete') is None
+
+    policy.record('complete', 2.0)
+    assert policy.delay('complete') == 2.0
+
+
+def test_hedge_delay_is_a_percentile_with_a_floor():
+    policy = HedgePolicy(percentile=0.9, min_delay=0.5, min_samples=10, recompute_every=1)
+    for seconds in range(1, 11):
+        policy.record('complete', seconds / 10)
+    assert policy.delay('complete') == 1.0
+
+    fast = HedgePolicy(percentile=0.9, min_delay=0.5, min_samples=10, recompute_every=1)
+    for _ in range(10):
+        fast.record('stream', 0.01)
+    assert fast.delay('stream') == 0.5
+
+
+def test_hedge_budget_limits_the_share_of_duplicates():
+    policy = HedgePolicy(budget_ratio=0.25, burst=2.0)
+    assert policy.try_spend() and policy.try_spend()
+    assert not policy.try_spend()
+
+    for _ in range(3):
+        policy.on_request()
+    assert not policy.try_spend()
+    policy.on_request()
+    assert policy.try_spend()
+
+    for _ in range(1000):
+        policy.on_request()
+    assert policy.tokens == 2.0
+
+
+def _hedging_gateway(burst):
+    started, cancelled = [], []
+
+    async def slow(**kwargs):
+        started.append('slow')
+        try:
+            await asyncio.sleep(0.2)
+        except asyncio.CancelledError:
+            cancelled.append('slow')
+            raise
+        return 'slow answer'
+
+    async def fast(**kwargs):
+        started.append('fast')
+        return 'fast answer'
+
+    policy = HedgePolicy(min_delay=0.01, min_samples=1, recompute_every=1, burst=burst, budget_ratio=0.0)
+    policy.record('complete', 0.01)
+    gateway = LLMGateway([_backend('slow', slow), _backend('fast', fast)], hedge_policy=policy)
+    return gateway, started, cancelled
+
+
+def test_gateway_hedge_wins_and_the_slow_request_is_cancelled(clock):
+    gateway, started, cancelled = _hedging_gateway(burst=1.0)
+    assert asyncio.run(gateway.complete(5.0, messages=[])) == 'fast answer'
+    assert started == ['slow', 'fast']
+    assert cancelled == ['slow']
+    assert gateway.hedge_policy.tokens == 0.0
+
+
+def test_gateway_does_not_hedge_without_budget(clock):
+    gateway, started, cancelled = _hedging_gateway(burst=0.0)
+    assert asyncio.run(gateway.complete(5.0, messages=[])) == 'slow answer'
+    assert started == ['slow']
+    assert cancelled == []
@@ -0,0 +1,106 @@
+import asyncio
+from collections import Counter
+
+import pytest
+
+from llm_scheduler import LLMScheduler, PRIORITY_SUBSCRIBER, PRIORITY_PURCHASED, PRIORITY_FREE
+
+WEIGHTS = {PRIORITY_SUBSCRIBER: 6, PRIORITY_PURCHASED: 3, PRIORITY_FREE: 1}
+
+
+def test_weighted_round_robin_shares_slots_by_weight():
+    async def scenario():
+        scheduler = LLMScheduler(1, WEIGHTS)
+        await scheduler.acquire('holder', PRIORITY_FREE)
+        granted = []
+
+        async def request(user_id, priority):
+            await scheduler.acquire(user_id, priority)
+            granted.append(priority)
+            await asyncio.sleep(0)
+            scheduler.release(user_id)
+
+        tasks = [
+            asyncio.create_task(request(f"{priority}-{i}", priority))
+            for priority in WEIGHTS for i in range(20)
+        ]
+        await asyncio.sleep(0)
+        scheduler.release('holder')
+        await asyncio.gather(*tasks)
+        return granted
+
+    granted = asyncio.run(scenario())
+    assert Counter(granted[:10]) == {PRIORITY_SUBSCRIBER: 6, PRIORITY_PURCHASED: 3, PRIORITY_FREE: 1}
+    # Бесплатные пользователи не голодают: первый из них получает слот в первом же круге
+    assert PRIORITY_FREE in granted[:10]
+
+
+def test_users_of_one_class_are_served_in_turn():
+    async def scenario():
+        scheduler = LLMScheduler(1, WEIGHTS)
+        await scheduler.acquire('holder', PRIORITY_FREE)
+        granted = []
+
+        async def request(user_id):
+            await scheduler.acquire(user_id, PRIORITY_FREE)
+            granted.append(user_id)
+            await asyncio.sleep(0)
+            scheduler.release(user_id)
+
+        tasks = [asyncio.create_task(request(user_id)) for user_id in ('a', 'a', 'a', 'b', 'c')]
+        await asyncio.sleep(0)
+        scheduler.release('holder')
+        await asyncio.gather(*tasks)
+        return granted
+
+    assert asyncio.run(scenario()) == ['a', 'b', 'c', 'a', 'a']
+
+
+def test_per_user_limit_lets_other_users_go_first():
+    async def scenario():
+        scheduler = LLMScheduler(2, WEIGHTS, per_user_limit=1)
+        await scheduler.acquire('u', PRIORITY_SUBSCRIBER)
+        second = asyncio.create_task(scheduler.acquire('u', PRIORITY_SUBSCRIBER))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(scheduler.acquire('v', PRIORITY_FREE), timeout=1)
+        assert not second.done()
+
+        scheduler.release('u')
+        await asyncio.wait_for(second, timeout=1)
+        return scheduler.in_flight
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_timed_out_waiter_leaves_the_queue():
+    async def scenario():
+        scheduler = LLMScheduler(1, WEIGHTS)
+        await scheduler.acquire('holder', PRIORITY_FREE)
+        with pytest.raises(asyncio.TimeoutError):
+            await scheduler.acquire('late', PRIORITY_SUBSCRIBER, timeout=0.01)
+        assert scheduler.stats()['classes'][PRIORITY_SUBSCRIBER]['waiting'] == 0
+
+        waiter = asyncio.create_task(scheduler.acquire('next', PRIORITY_FREE))
+        await asyncio.sleep(0)
+        scheduler.release('holder')
+        await asyncio.wait_for(waiter, timeout=1)
+        return scheduler.in_flight
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_slot_granted_to_a_cancelled_waiter_is_returned():
+    async def scenario():
+        scheduler = LLMScheduler(1, WEIGHTS)
+        await scheduler.acquire('holder', PRIORITY_FREE)
+        waiter = asyncio.create_task(scheduler.acquire('w', PRIORITY_FREE))
+        await asyncio.sleep(0)
+
+        # Слот выдан, но задача отменена раньше, чем успела его забрать
+        scheduler.release('holder')
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return scheduler.in_flight
+
+    assert asyncio.run(scenario()) == 0
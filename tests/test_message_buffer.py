@@ -0,0 +1,153 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import asyncpg
+import pytest
+
+import async_db_manager
+from async_db_manager import MessageWriteBuffer
+from cache import ConversationWindowCache
+from crypto_service import crypto
+
+BASE = datetime(2026, 1, 1, 12, 0)
+
+
+class FakePool:
+    """Таблица messages в памяти: COPY и INSERT дописывают строки, fetch отдает последние."""
+
+    def __init__(self):
+        self.rows = []
+        self.copy_errors = []
+        self.rejected_users = set()
+        self.available = True
+
+    async def copy_records_to_table(self, table, records, columns):
+        if self.copy_errors:
+            raise self.copy_errors.pop(0)
+        self.rows.extend(records)
+
+    async def execute(self, query, user_id, role, content, timestamp):
+        if not self.available:
+            raise asyncpg.PostgresConnectionError("connection refused")
+        if user_id in self.rejected_users:
+            raise asyncpg.DataError("invalid input")
+        self.rows.append((user_id, role, content, timestamp))
+
+    async def fetch(self, query, user_id, limit):
+        rows = [
+            {'role': role, 'content': content, 'timestamp': timestamp}
+            for row_user, role, content, timestamp in self.rows if row_user == user_id
+        ]
+        return list(reversed(rows))[:limit]
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(async_db_manager, '_pool', pool)
+    return pool
+
+
+def _stored(pool):
+    return [(user_id, role, crypto.decrypt(content)) for user_id, role, content, _ in pool.rows]
+
+
+def _at(minutes):
+    return BASE + timedelta(minutes=minutes)
+
+
+def test_flush_writes_one_encrypted_batch(pool):
+    buffer = MessageWriteBuffer(batch_size=10, flush_interval=60)
+    buffer.add(1, 'user', 'привет', _at(0))
+    buffer.add(1, 'assistant', 'здравствуй', _at(1))
+
+    assert asyncio.run(buffer.flush()) == 2
+    assert all(content.startswith('k') for _, _, content, _ in pool.rows)
+    assert _stored(pool) == [(1, 'user', 'привет'), (1, 'assistant', 'здравствуй')]
+    assert buffer.stats()['pending'] == 0 and buffer.flushed_batches == 1
+
+
+def test_transient_error_requeues_the_batch_in_order(pool):
+    buffer = MessageWriteBuffer(batch_size=10, flush_interval=60, max_retries=3)
+    buffer.add(1, 'user', 'first', _at(0))
+    pool.copy_errors.append(asyncpg.PostgresConnectionError("connection reset"))
+
+    assert asyncio.run(buffer.flush()) == 0
+    buffer.add(1, 'user', 'second', _at(1))
+    assert [content for _, _, content, _ in buffer.pending_for(1)] == ['first', 'second']
+
+    assert asyncio.run(buffer.flush()) == 2
+    assert _stored(pool) == [(1, 'user', 'first'), (1, 'user', 'second')]
+
+
+def test_rejected_rows_are_dropped_and_the_rest_written(pool):
+    buffer = MessageWriteBuffer(batch_size=10, flush_interval=60)
+    buffer.add(1, 'user', 'ok', _at(0))
+    buffer.add(2, 'user', 'bad', _at(1))
+    buffer.add(3, 'user', 'ok too', _at(2))
+    pool.copy_errors.append(asyncpg.DataError("invalid input"))
+    pool.rejected_users.add(2)
+
+    assert asyncio.run(buffer.flush()) == 2
+    assert _stored(pool) == [(1, 'user', 'ok'), (3, 'user', 'ok too')]
+    assert buffer.dropped_messages == 1 and buffer.stats()['pending'] == 0
+
+
+def test_batch_goes_row_by_row_after_max_retries(pool):
+    buffer = MessageWriteBuffer(batch_size=10, flush_interval=60, max_retries=2)
+    buffer.add(1, 'user', 'hello', _at(0))
+    pool.copy_errors.extend([asyncpg.PostgresConnectionError("down")] * 2)
+
+    async def scenario():
+        assert await buffer.flush() == 0
+        assert await buffer.flush() == 1
+
+    asyncio.run(scenario())
+    assert _stored(pool) == [(1, 'user', 'hello')]
+    assert buffer.row_fallbacks == 1
+
+
+def test_rows_wait_while_the_database_is_down(pool):
+    buffer = MessageWriteBuffer(batch_size=10, flush_interval=60, max_retries=1)
+    buffer.add(1, 'user', 'a', _at(0))
+    buffer.add(1, 'user', 'b', _at(1))
+    pool.copy_errors.append(asyncpg.PostgresConnectionError("down"))
+    pool.available = False
+
+    assert asyncio.run(buffer.flush()) == 0
+    assert [content for _, _, content, _ in buffer.pending_for(1)] == ['a', 'b']
+    assert buffer.dropped_messages == 0
+
+
+def test_full_buffer_reports_backpressure():
+    buffer = MessageWriteBuffer(batch_size=10, flush_interval=60, max_size=2)
+    buffer.add(1, 'user', 'a')
+    assert not buffer.full
+    buffer.add(1, 'user', 'b')
+    assert buffer.full
+
+
+def test_chat_history_merges_unflushed_messages(pool, monkeypatch):
+    buffer = MessageWriteBuffer(batch_size=10, flush_interval=60)
+    monkeypatch.setattr(async_db_manager, '_message_buffer', buffer)
+    monkeypatch.setattr(async_db_manager, '_history_cache', ConversationWindowCache(0, 20))
+
+    pool.rows = [
+        (1, 'user', crypto.encrypt('m0'), _at(0)),
+        (1, 'assistant', crypto.encrypt('m1'), _at(1)),
+        (2, 'user', crypto.encrypt('other user'), _at(1)),
+    ]
+    # m1 уже записан, но еще числится в буфере (запрос попал между COPY и очисткой) - дубля быть не должно
+    buffer.add(1, 'assistant', 'm1', _at(1))
+    buffer.add(1, 'user', 'm2', _at(2))
+    buffer.add(2, 'user', 'not mine', _at(3))
+
+    history = asyncio.run(async_db_manager.get_chat_history(1, limit=10))
+    assert history == [
+        {'role': 'user', 'content': 'm0'},
+        {'role': 'assistant', 'content': 'm1'},
+        {'role': 'user', 'content': 'm2'},
+    ]
+
+    recent = asyncio.run(async_db_manager.get_chat_history(1, limit=2))
+    assert [message['content'] for message in recent] == ['m1', 'm2']
@@ -0,0 +1,72 @@
+import asyncio
+
+from vector_memory import CollectionNotFoundError, HashingEmbedder, VectorMemoryStore
+
+
+class FakeCollection:
+    def __init__(self):
+        self.items = {}  # id -> (embedding, document, metadata)
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        for item in zip(ids, embeddings, documents, metadatas):
+            self.items[item[0]] = item[1:]
+
+    def count(self):
+        return len(self.items)
+
+    def get(self, include):
+        return {'ids': list(self.items), 'metadatas': [item[2] for item in self.items.values()]}
+
+    def delete(self, ids):
+        for fact_id in ids:
+            self.items.pop(fact_id, None)
+
+    def query(self, query_embeddings, n_results, include):
+        query = query_embeddings[0]
+        ranked = sorted(
+            self.items.values(),
+            key=lambda item: -sum(a * b for a, b in zip(query, item[0]))
+        )
+        return {'documents': [[document for _, document, _ in ranked[:n_results]]]}
+
+
+class FakeClient:
+    def __init__(self):
+        self.collections = {}
+
+    def get_or_create_collection(self, name, metadata=None, embedding_function=None):
+        return self.collections.setdefault(name, FakeCollection())
+
+    def get_collection(self, name, embedding_function=None):
+        if name not in self.collections:
+            raise CollectionNotFoundError(f"Collection {name} does not exist")
+        return self.collections[name]
+
+    def delete_collection(self, name):
+        del self.collections[name]
+
+
+def test_hashing_embedder_is_deterministic_and_normalized():
+    first, second = HashingEmbedder(64), HashingEmbedder(64)
+    vector = first.embed(["Люблю кофе по утрам"])[0]
+    assert vector == second.embed(["Люблю кофе по утрам"])[0]
+    assert abs(sum(v * v for v in vector) - 1.0) < 1e-9
+
+
+def test_search_does_not_create_collections():
+    client = FakeClient()
+    memory = VectorMemoryStore(client, HashingEmbedder(), timeout=5)
+    assert asyncio.run(memory.search(1, "что я люблю?")) == []
+    assert client.collections == {}
+
+
+def test_search_returns_the_closest_facts():
+    client = FakeClient()
+    memory = VectorMemoryStore(client, HashingEmbedder(), top_k=1, timeout=5)
+
+    async def scenario():
+        await memory.add_facts(1, ["Пользователь любит кофе", "У пользователя есть собака Бим"])
+        return await memory.search(1, "какая у меня собака?")
+
+    assert asyncio.run(scenario()) == ["У пользователя есть собака Бим"]
+    assert list(client.collections) == ["user_1"]
@@ -0,0 +1,231 @@
+# vector_memory.py - Векторная долговременная память фактов о пользователе (chromadb)
+import asyncio
+import hashlib
+import math
+import re
+import time
+
+try:
+    import chromadb
+except ImportError:
+    chromadb = None
+
+try:
+    from chromadb.errors import NotFoundError as CollectionNotFoundError
+except ImportError:
+    # Старые версии chromadb бросают ValueError, если коллекции нет
+    CollectionNotFoundError = ValueError
+
+# Шифрование остается общим с остальными данными пользователя
+from crypto_service import encrypt_data, decrypt_data
+from log_service import get_logger
+from config import (
+    VECTOR_MEMORY_ENABLED,
+    VECTOR_MEMORY_PATH,
+    VECTOR_MEMORY_HOST,
+    VECTOR_MEMORY_PORT,
+    VECTOR_MEMORY_EMBEDDER,
+    VECTOR_MEMORY_MODEL,
+    VECTOR_MEMORY_TOP_K,
+    VECTOR_MEMORY_TIMEOUT,
+    VECTOR_MEMORY_MAX_FACTS
+)
+
+log = get_logger(__name__)
+
+
+# ========================== ЭМБЕДДЕРЫ ==========================
+
+class HashingEmbedder:
+    """
+    Локальный детерминированный эмбеддер: признаки (слова и их 3-граммы) хэшируются
+    в вектор фиксированной длины. Не требует модели и дает одинаковый результат
+    в любом процессе, поэтому подходит для тестов и небольших инсталляций.
+    """
+
+    def __init__(self, dimension=256):
+        self.dimension = dimension
+
+    def _features(self, text):
+        for word in re.findall(r'\w+', text.lower()):
+            yield word
+            padded = f"<{word}>"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3]
+
+    def embed(self, texts):
+        vectors = []
+        for text in texts:
+            vector = [0.0] * self.dimension
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+                sign = 1.0 if digest & 1 else -1.0
+                vector[(digest >> 1) % self.dimension] += sign
+            norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+            vectors.append([v / norm for v in vector])
+        return vectors
+
+
+class SentenceTransformerEmbedder:
+    """Эмбеддинги моделью sentence-transformers (загружается при первом использовании)."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._model = None
+
+    def embed(self, texts):
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+            self._model = SentenceTransformer(self.model_name)
+        return self._model.encode(list(texts), normalize_embeddings=True).tolist()
+
+
+def create_embedder(name=VECTOR_MEMORY_EMBEDDER):
+    if name == 'sentence-transformers':
+        return SentenceTransformerEmbedder(VECTOR_MEMORY_MODEL)
+    return HashingEmbedder()
+
+
+# ========================== ХРАНИЛИЩЕ ==========================
+
+def split_facts(summary):
+    """Разбивает сводку памяти на отдельные факты (по строкам, без маркеров списка)."""
+    facts = []
+    for line in summary.splitlines():
+        fact = line.strip().lstrip('-•*–').strip()
+        if len(fact) >= 3:
+            facts.append(fact)
+    return facts
+
+
+class VectorMemoryStore:
+    """
+    Факты о пользователе с эмбеддингами в chromadb, по коллекции на пользователя,
+    чтобы поиск никогда не смешивал разных людей. Текст фактов хранится зашифрованным.
+    Все вызовы chromadb и эмбеддера выполняются в пуле потоков; поиск ограничен timeout,
+    и при превышении ответ строится без фактов.
+    """
+
+    def __init__(self, client, embedder, top_k=4, timeout=0.3, max_facts=500):
+        self.client = client
+        self.embedder = embedder
+        self.top_k = top_k
+        self.timeout = timeout
+        self.max_facts = max_facts
+
+        self.searches = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.facts_added = 0
+
+    @staticmethod
+    def _collection_name(user_id):
+        return f"user_{user_id}"
+
+    def _collection(self, user_id):
+        """Коллекция пользователя; создается при первой записи фактов."""
+        return self.client.get_or_create_collection(
+            name=self._collection_name(user_id),
+            metadata={"hnsw:space": "cosine"},
+            embedding_function=None,
+        )
+
+    def _add(self, user_id, facts):
+        collection = self._collection(user_id)
+        now = time.time()
+        # id - хэш текста: повторяющиеся в сводках факты не дублируются, а обновляют время
+        collection.upsert(
+            ids=[hashlib.sha1(fact.encode('utf-8')).hexdigest() for fact in facts],
+            embeddings=self.embedder.embed(facts),
+            documents=[encrypt_data(fact) for fact in facts],
+            metadatas=[{"created_at": now} for _ in facts],
+        )
+
+        # Старые факты вытесняются, чтобы коллекция не росла бесконечно
+        excess = collection.count() - self.max_facts
+        if excess > 0:
+            stored = collection.get(include=["metadatas"])
+            oldest = sorted(zip(stored["ids"], stored["metadatas"]), key=lambda item: item[1]["created_at"])
+            collection.delete(ids=[fact_id for fact_id, _ in oldest[:excess]])
+
+    def _search(self, user_id, query, k):
+        # Поиск не создает коллекцию: у большинства пользователей фактов еще нет
+        try:
+            collection = self.client.get_collection(self._collection_name(user_id), embedding_function=None)
+        except CollectionNotFoundError:
+            return []
+        stored = collection.count()
+        if stored == 0:
+            return []
+        result = collection.query(
+            query_embeddings=self.embedder.embed([query]),
+            n_results=min(k, stored),
+            include=["documents"],
+        )
+        return [decrypt_data(document) for document in result["documents"][0]]
+
+    async def add_facts(self, user_id, facts):
+        if not facts:
+            return
+        try:
+            await asyncio.to_thread(self._add, user_id, facts)
+            self.facts_added += len(facts)
+        except Exception as e:
+            self.errors += 1
+            log.warning("Vector memory: не удалось сохранить факты", user_id=user_id, error=repr(e))
+
+    async def search(self, user_id, query, k=None):
+        """До k фактов пользователя, ближайших по смыслу к query. При ошибке или таймауте - []."""
+        self.searches += 1
+        try:
+            return await asyncio.wait_for(
+                asyncio.to_thread(self._search, user_id, query, k or self.top_k),
+                timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            log.warning("Vector memory search timeout", user_id=user_id, timeout=self.timeout)
+        except Exception as e:
+            self.errors += 1
+            log.warning("Vector memory search error", user_id=user_id, error=repr(e))
+        return []
+
+    async def delete_user(self, user_id):
+        """Удаляет все факты пользователя (при /reset)."""
+        def _delete():
+            try:
+                self.client.delete_collection(self._collection_name(user_id))
+            except Exception:
+                pass  # коллекции еще не было
+
+        await asyncio.to_thread(_delete)
+
+    def stats(self):
+        return {
+            'searches': self.searches,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'facts_added': self.facts_added,
+        }
+
+
+def create_vector_memory():
+    """Создает хранилище по настройкам из config или возвращает None, если оно выключено."""
+    if not VECTOR_MEMORY_ENABLED:
+        return None
+    if chromadb is None:
+        log.warning("chromadb не установлен, векторная память отключена")
+        return None
+
+    if VECTOR_MEMORY_HOST:
+        client = chromadb.HttpClient(host=VECTOR_MEMORY_HOST, port=VECTOR_MEMORY_PORT)
+    else:
+        client = chromadb.PersistentClient(path=VECTOR_MEMORY_PATH)
+
+    return VectorMemoryStore(
+        client,
+        create_embedder(),
+        top_k=VECTOR_MEMORY_TOP_K,
+        timeout=VECTOR_MEMORY_TIMEOUT,
+        max_facts=VECTOR_MEMORY_MAX_FACTS,
+    )